@@ -0,0 +1,99 @@
+"""
+import_time.py
+
+Measures how long importing `hww_tools` takes for the typical uses of the
+package, with `python -X importtime` in a fresh interpreter for every case:
+- `package`: `import hww_tools` alone.
+- `worker`: What a worker needs to process a file (`Processor.warm_up`
+  imports every module used by a task).
+- `driver`: The notebook/command line side (`execute_analysis`).
+- `everything`: `from hww_tools import *` (the former eager import).
+
+For every case it prints the total import time and the packages that take the
+longest (self time of all their modules, wherever they are imported from),
+and writes the summary to import_time.md next to this script.
+
+Usage (from the Run_analysis directory):
+    python benchmarks/import_time.py [--repeat 3] [--top 8]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+RUN_ANALYSIS_DIR = HERE.parent
+
+CASES = {
+    "package": "import hww_tools",
+    "worker": "import hww_tools\nhww_tools.Processor(golden_json={}).warm_up()",
+    "driver": "import hww_tools\nhww_tools.execute_analysis",
+    "everything": "from hww_tools import *",
+}
+
+_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+\d+\s+\|\s*(\S+)")
+
+def measure(code):
+    """
+    Runs `code` with -X importtime in a new interpreter.
+
+    Returns
+    -------
+    total : float
+        Sum of the self times of all the imports, in seconds.
+    packages : dict
+        Top-level package -> self import time of all its modules, in seconds.
+    """
+    env = dict(os.environ, HWW_TOOLS_QUIET="1")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=RUN_ANALYSIS_DIR, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Import failed:\n{proc.stderr[-2000:]}")
+
+    packages = {}
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match is not None:
+            package = match.group(2).split(".")[0]
+            packages[package] = packages.get(package, 0.0) + int(match.group(1)) / 1e6
+    return sum(packages.values()), packages
+
+def run(repeat=3, top=8):
+    """Measures every case (best of `repeat` runs) and returns the markdown summary."""
+    lines = [
+        "# hww_tools import time",
+        "",
+        f"Generated by `benchmarks/import_time.py` (Python {sys.version.split()[0]}, "
+        f"best of {repeat} runs). Times in seconds.",
+        "",
+        "| Case | Total | Slowest packages |",
+        "|---|---:|---|",
+    ]
+    for case, code in CASES.items():
+        best = None
+        for _ in range(repeat):
+            total, packages = measure(code)
+            if best is None or total < best[0]:
+                best = (total, packages)
+        total, packages = best
+        slowest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+        summary = ", ".join(f"{name} {seconds:.2f}" for name, seconds in slowest)
+        print(f"{case:<12} {total:6.2f}s  {summary}")
+        lines.append(f"| `{case}` | {total:.2f} | {summary} |")
+    return "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case (the fastest is kept).")
+    parser.add_argument("--top", type=int, default=8, help="Packages listed per case.")
+    args = parser.parse_args()
+
+    report = run(args.repeat, args.top)
+    output = HERE / "import_time.md"
+    output.write_text(report)
+    print(f"Summary written to {output}")
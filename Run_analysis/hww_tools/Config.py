@@ -103,6 +103,25 @@ stage_names = [
     # 'CR_tau_0jet', 'CR_tau_1jet', 'CR_tau_2jet'
 ]
 
+# N-1 distributions (see cut_registry.py)
+# For every cut on an observable in these regions, the distribution of that
+# observable with all the other cuts of the region applied.
+# Booked with booking.HistogramBooking.request_n_minus_one().
+n_minus_one_regions = [
+    'SR_0jet', 'SR_1jet', 'SR_2jet',
+    'CR_top_0jet', 'CR_top_1jet', 'CR_top_2jet',
+]
+# Format: cut name in cut_registry -> variable in Plots_config.variables_to_plots
+n_minus_one_variables = {
+    'met_pt': 'met',
+    'ptll': 'ptll',
+    'mll': 'mass',
+    'mll_50': 'mass',
+    'mt_higgs': 'mt_higgs',
+    'mt_l2_met': 'mt_l2_met',
+    'mjj_window': 'mjj',
+}
+
 # Stage info mapping for Cutflow Tables
 # Format: (internal_variable_name, display_name_for_tables)
 # Used by cutflow_utils.py to generate human-readable column headers in CSVs.
@@ -8,9 +8,6 @@ It defines:
 - Plot settings (log scale, limits) for Signal and Control regions
 """
 
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-import mplhep as hep
 import hist
 from hist import Hist
 import numpy as np
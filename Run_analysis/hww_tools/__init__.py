@@ -1,25 +1,113 @@
-# Import everything from the sub-modules into the top-level package
-from .Config import *
-from .Efficiency_data import *
-from .Physics_selection import *
-from .Plots_config import *
-from .calculations import *
-from .cross_section import *
-from .cutflow_utils import * 
-from .cuts import *
-from .helper import *
-from .json_validation import *
-from .dask_utils import *
-from .plotting import *
-from .run_analysis import *
+"""
+hww_tools
 
-# Feedback on import
+The sub-modules are imported lazily (PEP 562): `hww_tools.helper` or a flat
+name such as `hww_tools.get_client` imports its module on first access, so
+importing the package itself is nearly free. A Dask worker or a command line
+run only pays for the modules it actually uses (event processing never needs
+matplotlib, and a process pool never needs Dask).
+
+The flat names are the same as with the previous `from .X import *` of every
+module: the public top-level names of each module, a later module of
+`_modules` taking precedence when two define the same name. The two names
+the star imports exposed as a side effect (`mpatches` and `as_completed`)
+are mapped explicitly. `from hww_tools import *` still imports everything.
+
+Set the environment variable HWW_TOOLS_QUIET=1 to silence the banner.
+See benchmarks/import_time.py for the import times.
+"""
+
+import ast
+import importlib
+import os
+from pathlib import Path
+
+# Sub-modules, in the order of the former star imports
 _modules = [
-    "Config", "Efficiency_data", "Physics_selection", "Plots_config", 
-    "calculations", "cross_section", "cutflow_utils", "cuts", 
-    "helper", "json_validation", "dask_utils", "plotting", "run_analysis"
+    "Config", "Efficiency_data", "Physics_selection", "Plots_config",
+    "calculations", "cross_section", "cutflow_utils", "cuts",
+    "helper", "json_validation", "dask_utils", "plotting", "run_analysis",
+    "checkpoint", "result_cache", "manifest", "booking", "root_io", "dense_store",
+    "histogram_store", "ntuple", "query", "cut_scan",
+    "cut_registry", "weights", "executors", "shared_store", "scheduling",
+    "processor", "batch", "merging"
 ]
 
-print(f"hww_tools loaded successfully.")
-for module in _modules:
-    print(f"- {module}")
\ No newline at end of file
+# Flat name -> module defining it (built on first use, see _public_names)
+_NAME_TO_MODULE = None
+
+# Names the former star imports also put on the package but that no module
+# defines any more: flat name -> (module, attribute or None for the module itself)
+_LEGACY_IMPORTS = {
+    "mpatches": ("matplotlib.patches", None),            # Plots_config
+    "as_completed": ("dask.distributed", "as_completed"),  # run_analysis
+}
+
+def _top_level_names(tree):
+    """Names bound by the top-level statements of a module (including under if/try)."""
+    names = []
+    for node in tree.body:
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                names.append(node.name)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    if alias.name != "*":
+                        names.append(alias.asname or alias.name.split(".")[0])
+            elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    names.extend(n.id for n in ast.walk(target) if isinstance(n, ast.Name))
+            elif isinstance(node, (ast.If, ast.Try, ast.With)):
+                stack.extend(node.body + getattr(node, "orelse", []) + getattr(node, "finalbody", []))
+                for handler in getattr(node, "handlers", []):
+                    stack.extend(handler.body)
+    return names
+
+def _public_names():
+    """
+    Maps every flat name to its module by reading the module sources (without
+    importing them), with the same result as the star imports.
+    """
+    global _NAME_TO_MODULE
+    if _NAME_TO_MODULE is None:
+        mapping = {}
+        here = Path(__file__).parent
+        for module in _modules:
+            source = (here / f"{module}.py").read_bytes()
+            for name in _top_level_names(ast.parse(source)):
+                if not name.startswith("_"):
+                    mapping[name] = module
+        _NAME_TO_MODULE = mapping
+    return _NAME_TO_MODULE
+
+def _legacy_name(name):
+    module_name, attribute = _LEGACY_IMPORTS[name]
+    module = importlib.import_module(module_name)
+    return module if attribute is None else getattr(module, attribute)
+
+def __getattr__(name):
+    if name in _modules:
+        return importlib.import_module(f".{name}", __name__)
+    if name == "__all__":
+        return sorted(set(_modules) | set(_public_names()) | set(_LEGACY_IMPORTS))
+    module = _public_names().get(name)
+    if module is not None:
+        value = getattr(importlib.import_module(f".{module}", __name__), name)
+    elif name in _LEGACY_IMPORTS:
+        value = _legacy_name(name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_modules) | set(_public_names()) | set(_LEGACY_IMPORTS))
+
+# Feedback on import
+if os.environ.get("HWW_TOOLS_QUIET", "") in ("", "0"):
+    print(f"hww_tools loaded successfully.")
+    for _name in _modules:
+        print(f"- {_name}")
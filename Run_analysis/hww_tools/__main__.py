@@ -0,0 +1,91 @@
+"""
+Command line entry point of hww_tools (see batch.py).
+
+Run from the directory containing hww_tools (Run_analysis):
+
+    # Everything on a local process pool
+    python -m hww_tools run run.json
+
+    # Array job: shard k of N (k from 0 to N-1), e.g. SLURM with --array=0-49
+    python -m hww_tools run run.json --shard $SLURM_ARRAY_TASK_ID/50
+
+    # Combine the partial outputs once every shard has finished
+    python -m hww_tools merge --config run.json
+
+    # Sum any partial outputs (directories, ROOT files, checkpoints), like hadd
+    python -m hww_tools hadd -o merged/ part1/ part2/ checkpoint.pkl -j 8
+
+`run.json` holds the keys of batch.RUN_DEFAULTS, e.g.
+{"executor": "processes", "n_workers": 8, "processor": {"batch_size": 500000}}.
+The exit status is 1 if no input files were found or files failed (run), or
+the partial outputs are incomplete or inconsistent (merge, hadd).
+"""
+
+import argparse
+import sys
+
+from . import batch
+
+def _parse_shard(text):
+    """'k/N' -> (k, N)."""
+    try:
+        shard, n_shards = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N (e.g. 3/50), got '{text}'") from None
+    if n_shards < 1 or not 0 <= shard < n_shards:
+        raise argparse.ArgumentTypeError(f"shard {shard} of {n_shards}: expected 0 <= K < N")
+    return shard, n_shards
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m hww_tools",
+                                     description="Headless H->WW analysis runs and merging of shards.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Process all the files, or one shard of them.")
+    run.add_argument("config", nargs="?", help="Run configuration (JSON, keys of batch.RUN_DEFAULTS).")
+    run.add_argument("--shard", type=_parse_shard, default=(0, 1), metavar="K/N",
+                     help="Process shard K of N (K from 0 to N-1). Defaults to 0/1 (everything).")
+    run.add_argument("--output-dir", help="Overrides 'output_dir' of the configuration.")
+    run.add_argument("--executor", help="Overrides 'executor': 'processes', 'serial' or a Dask scheduler address.")
+    run.add_argument("--dry-run", action="store_true", help="Only list the files of the shard.")
+
+    merge = commands.add_parser("merge", help="Combine the partial outputs of the shards.")
+    merge.add_argument("shard_dirs", nargs="*", help="Partial output directories (default: all under OUTPUT_DIR/shards).")
+    merge.add_argument("--config", help="Run configuration (for 'output_dir' and 'root_options').")
+    merge.add_argument("--output-dir", help="Overrides 'output_dir' of the configuration.")
+    merge.add_argument("--allow-missing", action="store_true",
+                       help="Merge even if shards or files are missing.")
+    merge.add_argument("-j", "--jobs", type=int, help="Merge processes (default: one per CPU).")
+
+    hadd = commands.add_parser("hadd", help="Sum any partial outputs (see merging.py).")
+    hadd.add_argument("inputs", nargs="+", help="Output directories, dense stores, ROOT files, checkpoints or manifests.")
+    hadd.add_argument("-o", "--output-dir", required=True, help="Directory of the merged outputs.")
+    hadd.add_argument("-j", "--jobs", type=int, help="Merge processes (default: one per CPU).")
+    hadd.add_argument("--fan-in", type=int, default=8, help="Inputs summed per task of the tree reduction.")
+    hadd.add_argument("--no-root", action="store_true", help="Only write the dense store, cutflows and manifest.")
+    hadd.add_argument("--allow-overlap", action="store_true",
+                      help="Sum the inputs even if a file appears in more than one of them.")
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "run":
+            config = batch.load_run_config(args.config, output_dir=args.output_dir, executor=args.executor)
+            shard, n_shards = args.shard
+            missing = batch.run_shard(config, shard, n_shards, dry_run=args.dry_run)
+            return 1 if missing and not args.dry_run else 0
+        if args.command == "hadd":
+            from .merging import merge_outputs
+            merge_outputs(args.inputs, args.output_dir, n_workers=args.jobs, fan_in=args.fan_in,
+                          write_root=not args.no_root, allow_overlap=args.allow_overlap)
+        else:
+            config = batch.load_run_config(args.config, output_dir=args.output_dir)
+            batch.merge_shards(config['output_dir'], args.shard_dirs, allow_missing=args.allow_missing,
+                               root_options=config['root_options'], n_workers=args.jobs)
+    except (FileNotFoundError, RuntimeError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
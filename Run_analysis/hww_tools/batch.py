@@ -0,0 +1,367 @@
+"""
+batch.py
+
+This module runs the analysis without the notebook and without a shared
+Dask scheduler, e.g. as the array jobs of a SLURM/HTCondor batch farm, from
+cron or on a few independent machines (command line: `python -m hww_tools`,
+see __main__.py).
+
+A run is described by a JSON run configuration (`load_run_config`, keys and
+defaults in `RUN_DEFAULTS`). Its work units are the (sample, file URL) pairs
+of `helper.load_all_files`, sorted, and `shard_units` deals them out to N
+shards round-robin. Every job computes the same split from the same file
+lists, so a job only needs to know its shard number `k` (0 to N-1).
+
+- `run_shard`: Processes shard k of N with `execute_analysis` into its own
+  partial output directory, `<output_dir>/shards/shard_<k>_of_<N>` (ROOT
+  file, dense store, cutflows, manifest), plus `HWW_shard.json` describing
+  the shard (a run with a single shard writes the final outputs directly).
+  Running the same shard again only processes its files that have
+  no result yet (incremental update), so failed jobs can simply be resubmitted.
+- `merge_shards`: Checks that the partial outputs come from the same file
+  lists and code, sums them and writes the usual `HWW_analysis_output.root`,
+  dense store, cutflow CSVs and manifest to the output directory.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+from . import Config
+
+SHARD_INFO_NAME = "HWW_shard.json"
+SHARDS_DIR_NAME = "shards"
+
+# Keys of the run configuration and their defaults
+RUN_DEFAULTS = {
+    'data_dir': None,           # Config.DATA_DIR
+    'mc_dir': None,             # Config.MC_DIR
+    'max_per_sample': None,     # Files per sample list, e.g. for a test run
+    'samples': None,            # Sample labels to process (None: all)
+    'output_dir': None,         # Config.OUTPUT_DIR
+    'executor': 'processes',    # 'processes', 'serial' or a Dask scheduler address
+    'n_workers': None,          # Worker processes of 'processes' (None: one per CPU)
+    'processor': {},            # Keyword arguments of processor.Processor
+    'cache_dir': None,          # result_cache.ResultCache directory
+    'ntuple_dir': None,         # Event ntuples (one sub-directory per shard)
+    'root_options': {},         # Keyword arguments of helper.save_root_file
+    'max_in_flight': 'auto',
+    'memory_limit': None,
+    'speculate': 3.0,
+}
+
+# ==============================================================================
+# RUN CONFIGURATION
+# ==============================================================================
+
+def load_run_config(path=None, **overrides):
+    """
+    Reads a run configuration and fills in the defaults.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, optional
+        JSON file with any of the keys of RUN_DEFAULTS. Defaults to None
+        (only the defaults and `overrides`).
+    **overrides
+        Values replacing those of the file (None values are ignored).
+
+    Returns
+    -------
+    config : dict
+        Every key of RUN_DEFAULTS, with the directories as pathlib.Path.
+
+    Raises
+    ------
+    ValueError
+        If the configuration has unknown keys (e.g. a typo).
+    """
+    values = {}
+    if path is not None:
+        with open(path, 'r') as f:
+            values = json.load(f)
+    values.update({key: value for key, value in overrides.items() if value is not None})
+
+    unknown = sorted(set(values) - set(RUN_DEFAULTS))
+    if unknown:
+        raise ValueError(f"Unknown run configuration keys: {', '.join(unknown)} "
+                         f"(expected some of: {', '.join(RUN_DEFAULTS)})")
+
+    config = {**RUN_DEFAULTS, **values}
+    config['data_dir'] = Path(config['data_dir'] or Config.DATA_DIR)
+    config['mc_dir'] = Path(config['mc_dir'] or Config.MC_DIR)
+    config['output_dir'] = Path(config['output_dir'] or Config.OUTPUT_DIR)
+    for key in ('cache_dir', 'ntuple_dir'):
+        if config[key] is not None:
+            config[key] = Path(config[key])
+    return config
+
+def load_files(config):
+    """The {sample label: [file URLs]} of the run (helper.load_all_files, filtered by 'samples')."""
+    from .helper import load_all_files
+
+    files = load_all_files(config['data_dir'], config['mc_dir'], config['max_per_sample'])
+    if config['samples'] is not None:
+        files = {label: urls for label, urls in files.items() if label in config['samples']}
+    return files
+
+# ==============================================================================
+# SHARDING
+# ==============================================================================
+
+def work_units(files):
+    """
+    The sorted, unique (sample label, file URL) pairs of `files`.
+
+    Sorting makes the list independent of the directory listing order of the
+    machine that builds it.
+    """
+    return sorted({(label, url) for label, urls in files.items() for url in urls})
+
+def plan_hash(units):
+    """Hash of the full list of work units, shared by all the shards of a run."""
+    return hashlib.sha256(json.dumps(units).encode()).hexdigest()
+
+def shard_units(units, shard, n_shards):
+    """
+    The work units of shard `shard` (0 to n_shards - 1), dealt out
+    round-robin so every shard gets a similar mix of samples.
+    """
+    if n_shards < 1 or not 0 <= shard < n_shards:
+        raise ValueError(f"Invalid shard {shard} of {n_shards} (expected 0 <= shard < n_shards)")
+    return units[shard::n_shards]
+
+def shard_dir(output_dir, shard, n_shards):
+    """Partial output directory of a shard (zero-padded so the shards sort in order)."""
+    width = len(str(n_shards - 1))
+    return Path(output_dir) / SHARDS_DIR_NAME / f"shard_{shard:0{width}d}_of_{n_shards}"
+
+def load_shard_info(directory):
+    """Returns the HWW_shard.json of a partial output directory, or None."""
+    path = Path(directory) / SHARD_INFO_NAME
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def missing_units(directory, info=None):
+    """The work units of a shard that are not in its partial output (manifest) yet."""
+    from .manifest import load_manifest
+
+    info = info if info is not None else load_shard_info(directory)
+    manifest = load_manifest(directory)
+    done = set()
+    if manifest is not None:
+        done = {(label, url) for label, urls in manifest['samples'].items() for url in urls}
+    return [tuple(unit) for unit in info['units'] if tuple(unit) not in done]
+
+# ==============================================================================
+# RUNNING A SHARD
+# ==============================================================================
+
+def make_executor(config):
+    """
+    The executor of the run configuration, and the Dask client to close
+    afterwards (None for the local backends).
+    """
+    from .executors import as_executor
+
+    backend = config['executor']
+    if backend == 'processes':
+        return as_executor(backend, n_workers=config['n_workers']), None
+    if backend == 'serial':
+        return as_executor(backend), None
+
+    from .dask_utils import get_client
+    client = get_client(backend)
+    return as_executor(client), client
+
+def run_shard(config, shard=0, n_shards=1, dry_run=False):
+    """
+    Processes shard `shard` of `n_shards` into its partial output directory
+    (directly into the output directory when n_shards is 1).
+
+    Parameters
+    ----------
+    config : dict
+        Run configuration returned by `load_run_config`.
+    shard, n_shards : int, optional
+        The shard to run (0 to n_shards - 1). Defaults to 0 of 1 (everything).
+    dry_run : bool, optional
+        Only print the work units of the shard. Defaults to False.
+
+    Returns
+    -------
+    missing : list of tuple
+        The (sample label, file URL) units of the shard without a result
+        (failed files). Empty when the shard is complete.
+
+    Raises
+    ------
+    ValueError
+        If the run has no input files at all (wrong directories or sample
+        names), rather than writing an empty output that looks complete.
+    """
+    files = load_files(config)
+    units = work_units(files)
+    if not units:
+        samples = f" for the samples {config['samples']}" if config['samples'] is not None else ""
+        raise ValueError(f"No input files found in {config['data_dir']} and {config['mc_dir']}{samples}")
+    mine = shard_units(units, shard, n_shards)
+    # Without sharding the outputs are final: no partial directory, no merge
+    directory = config['output_dir'] if n_shards == 1 else shard_dir(config['output_dir'], shard, n_shards)
+    print(f"Shard {shard} of {n_shards}: {len(mine)} of {len(units)} files -> {directory}")
+
+    if dry_run:
+        for label, url in mine:
+            print(f"  {label:20s} {url}")
+        return mine
+
+    info = {
+        'shard': shard,
+        'n_shards': n_shards,
+        'plan_hash': plan_hash(units),
+        'n_units_total': len(units),
+        'units': mine,
+    }
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / SHARD_INFO_NAME, 'w') as f:
+        json.dump(info, f, indent=0)
+    if not mine:
+        return []
+
+    from .processor import Processor
+    from .result_cache import ResultCache
+    from .run_analysis import execute_analysis
+
+    shard_files = {}
+    for label, url in mine:
+        shard_files.setdefault(label, []).append(url)
+
+    processor = Processor(**config['processor'])
+    cache = ResultCache(config['cache_dir'], processor) if config['cache_dir'] is not None else None
+    # ntuple.prune_ntuples removes the units of other files: one directory per shard
+    ntuple_dir = config['ntuple_dir']
+    if ntuple_dir is not None and n_shards > 1:
+        ntuple_dir = ntuple_dir / directory.name
+
+    executor, client = make_executor(config)
+    try:
+        execute_analysis(
+            executor, shard_files, processor, cache=cache, incremental=True,
+            root_options=config['root_options'], ntuple_dir=ntuple_dir,
+            max_in_flight=config['max_in_flight'], memory_limit=config['memory_limit'],
+            speculate=config['speculate'], output_dir=directory,
+        )
+    finally:
+        executor.close()
+        if client is not None:
+            client.close()
+
+    missing = missing_units(directory, info)
+    if missing:
+        print(f"Shard {shard} of {n_shards}: {len(missing)} files without result, run the shard again to retry them.")
+    return missing
+
+# ==============================================================================
+# MERGING
+# ==============================================================================
+
+def find_shard_dirs(output_dir):
+    """The partial output directories under `<output_dir>/shards`, sorted."""
+    root = Path(output_dir) / SHARDS_DIR_NAME
+    if not root.is_dir():
+        return []
+    return sorted(path for path in root.iterdir() if (path / SHARD_INFO_NAME).exists())
+
+def merge_shards(output_dir=None, shard_dirs=None, allow_missing=False, root_options=None, n_workers=None):
+    """
+    Combines the partial outputs of the shards into the final outputs.
+
+    Parameters
+    ----------
+    output_dir : str or pathlib.Path, optional
+        Where the merged outputs are written. Defaults to None (Config.OUTPUT_DIR).
+    shard_dirs : list of str or pathlib.Path, optional
+        Partial output directories. Defaults to None (every shard under
+        `<output_dir>/shards`).
+    allow_missing : bool, optional
+        Merge even if shards or files are missing (the outputs are then
+        incomplete). Defaults to False.
+    root_options : dict, optional
+        Keyword arguments for helper.save_root_file. Defaults to None.
+    n_workers : int, optional
+        Processes of the merge (merging.merge_outputs). Defaults to None
+        (one per CPU).
+
+    Returns
+    -------
+    hist_store, cutflow_final, weighted_cutflow_final
+
+    Raises
+    ------
+    ValueError
+        If the partial outputs belong to different file lists or code.
+    RuntimeError
+        If shards or files are missing and `allow_missing` is False.
+    """
+    from . import scheduling
+    from . import manifest as manifest_utils
+    from .merging import merge_outputs
+
+    output_dir = Path(output_dir) if output_dir is not None else Config.OUTPUT_DIR
+    shard_dirs = [Path(d) for d in shard_dirs] if shard_dirs else find_shard_dirs(output_dir)
+    if not shard_dirs:
+        raise RuntimeError(f"No partial outputs found under {output_dir / SHARDS_DIR_NAME}")
+
+    # 1. CHECK THE SHARDS
+    infos = [load_shard_info(d) for d in shard_dirs]
+    for directory, info in zip(shard_dirs, infos):
+        if info is None:
+            raise ValueError(f"{directory} is not a shard output ({SHARD_INFO_NAME} not found)")
+    plans = {(info['plan_hash'], info['n_shards']) for info in infos}
+    if len(plans) > 1:
+        raise ValueError("The partial outputs come from different file lists or numbers of shards; "
+                         "rerun them with the same run configuration")
+    n_shards = infos[0]['n_shards']
+
+    problems = []
+    absent = sorted(set(range(n_shards)) - {info['shard'] for info in infos})
+    if absent:
+        problems.append(f"{len(absent)} of {n_shards} shards have no output: {absent}")
+
+    manifests = [manifest_utils.load_manifest(d) for d in shard_dirs]
+    run_hashes = {m['run_hash'] for m in manifests if m is not None}
+    if len(run_hashes) > 1:
+        raise ValueError("The partial outputs were produced with different code or configuration; "
+                         "rerun the outdated shards")
+    for directory, info in zip(shard_dirs, infos):
+        missing = missing_units(directory, info)
+        if missing:
+            problems.append(f"shard {info['shard']}: {len(missing)} of {len(info['units'])} files without result")
+    if problems:
+        message = "Incomplete partial outputs:\n  " + "\n  ".join(problems)
+        if not allow_missing:
+            raise RuntimeError(message + "\nRerun the listed shards, or merge with allow_missing=True.")
+        print(f"WARNING: {message}")
+
+    # 2. SUM THE PARTIAL OUTPUTS (see merging.py)
+    inputs = [d for d, m in zip(shard_dirs, manifests) if m is not None and m['samples']]
+    if not inputs:
+        raise RuntimeError("The partial outputs hold no results")
+    print(f"Merging {len(inputs)} partial outputs into {output_dir}...")
+    hist_store, cutflow_final, weighted_cutflow_final = merge_outputs(
+        inputs, output_dir, n_workers=n_workers, root_options=root_options
+    )
+
+    # Task times of all the shards, for the submission order of later runs
+    history = scheduling.load_task_history(output_dir)
+    for directory in shard_dirs:
+        history.update(scheduling.load_task_history(directory))
+    if history:
+        scheduling.update_task_history(output_dir, history, [], {})
+
+    n_files = sum(len(urls) for m in manifests if m is not None for urls in m['samples'].values())
+    total_events = sum(counts.get('total', 0) for counts in cutflow_final.values())
+    print(f"Merged {n_files} files of {len(hist_store.samples)} samples ({total_events:,} events).")
+    return hist_store, cutflow_final, weighted_cutflow_final
@@ -0,0 +1,202 @@
+"""
+booking.py
+
+This module decides which histograms are allocated and filled.
+
+By default every variable is filled for every stage and every systematic
+variation (11 stages x 9 variables x 7 variations = 693 histograms per sample),
+although most of them are never looked at:
+- The stacked plots (`Plots_config.PLOT_SETTINGS`) only use the SR/CR stages,
+  with the nominal and the trigger/electron/muon up/down variations.
+- The shape plots (`plotting.create_superimposed_plots`) only use the nominal
+  variation at 'before_cuts', 'global' and the jet-bin stages.
+- The datacard builder (`prepare_combine.py`) only uses one variable in a few regions.
+
+A `HistogramBooking` collects the (stage, variable, variation) combinations
+requested by these consumers, and `helper.initialize_stage_histograms` and
+`helper.fill_stage_histograms` then only allocate and fill those.
+The "book everything" mode is kept for exploratory runs.
+"""
+
+import time
+import numpy as np
+
+from . import Config
+
+# Systematic sources used by the plotting and datacard code. Each source
+# expands to the '<source>_up' and '<source>_down' variations.
+SYST_SOURCES = ['trigger', 'ele_id', 'mu_id']
+
+# Stages used by plotting.create_superimposed_plots
+SHAPE_PLOT_STAGES = ['before_cuts', 'global', '0jet', '1jet', '2jet']
+
+# Regions and variable read by prepare_combine.py
+DATACARD_REGIONS = ['SR_0jet', 'CR_top_0jet']
+DATACARD_VARIABLE = 'mass'
+
+def _expand_systematics(syst_sources):
+    variations = ['nominal']
+    for source in syst_sources:
+        variations += [f"{source}_up", f"{source}_down"]
+    return variations
+
+class HistogramBooking:
+    """
+    Set of (stage, variable, variation) histograms that a run should produce.
+
+    Parameters
+    ----------
+    stages : list of str, optional
+        All available stages. Defaults to Config.stage_names.
+    variables : list of str, optional
+        All available variables. Defaults to the keys of Plots_config.variables_to_plots.
+    variations : list of str, optional
+        All available variations. Defaults to Config.VARIATIONS.
+    book_all : bool, optional
+        If True, every combination is booked ("book everything" mode). Defaults to False.
+    """
+
+    def __init__(self, stages=None, variables=None, variations=None, book_all=False):
+        if variables is None:
+            from .Plots_config import variables_to_plots
+            variables = list(variables_to_plots.keys())
+
+        self.stages = list(stages if stages is not None else Config.stage_names)
+        self.variables = list(variables)
+        self.variations = list(variations if variations is not None else Config.VARIATIONS)
+        self.book_all = book_all
+        self._booked = set()
+
+    # ---------------------------------------------------------
+    # Requests
+    # ---------------------------------------------------------
+    def request(self, stages, variables, variations=('nominal',)):
+        """
+        Books every combination of the given stages, variables and variations.
+        Names that are not part of the analysis are ignored with a warning.
+        """
+        for stage in stages:
+            if stage not in self.stages:
+                print(f"  Booking: unknown stage '{stage}' ignored")
+                continue
+            for var in variables:
+                if var not in self.variables:
+                    print(f"  Booking: unknown variable '{var}' ignored")
+                    continue
+                for syst in variations:
+                    if syst in self.variations:
+                        self._booked.add((stage, var, syst))
+        return self
+
+    def request_plot_settings(self, plot_settings=None, syst_sources=SYST_SOURCES):
+        """Books what `plotting.create_stacked_plots` needs for each plot group."""
+        if plot_settings is None:
+            from .Plots_config import PLOT_SETTINGS
+            plot_settings = PLOT_SETTINGS
+
+        variations = _expand_systematics(syst_sources)
+        for config in plot_settings.values():
+            stages = [stage_key for stage_key, _ in config['stages']]
+            self.request(stages, config['variables'].keys(), variations)
+        return self
+
+    def request_shape_plots(self, stages=SHAPE_PLOT_STAGES, variables=None):
+        """Books the nominal histograms used by `plotting.create_superimposed_plots`."""
+        self.request(stages, variables if variables is not None else self.variables, ['nominal'])
+        return self
+
+    def request_datacards(self, regions=DATACARD_REGIONS, variable=DATACARD_VARIABLE,
+                          syst_sources=SYST_SOURCES):
+        """Books the shapes that `prepare_combine.py` turns into datacard inputs."""
+        self.request(regions, [variable], _expand_systematics(syst_sources))
+        return self
+
+    def request_n_minus_one(self, regions=None):
+        """
+        Books the nominal N-1 histograms of the SR/CR cuts (see
+        cut_registry.n_minus_one_stages), adding their stages to `self.stages`.
+        """
+        from .cut_registry import n_minus_one_stages
+
+        for stage, (_, _, variable) in n_minus_one_stages(regions).items():
+            if stage not in self.stages:
+                self.stages.append(stage)
+            self.request([stage], [variable], ['nominal'])
+        return self
+
+    # ---------------------------------------------------------
+    # Queries
+    # ---------------------------------------------------------
+    def is_booked(self, stage, variable, variation):
+        if self.book_all:
+            return stage in self.stages and variable in self.variables and variation in self.variations
+        return (stage, variable, variation) in self._booked
+
+    def __contains__(self, item):
+        return self.is_booked(*item)
+
+    def layout(self):
+        """
+        Returns the booked combinations as {stage: {variable: [variations]}},
+        keeping the configured order. Stages or variables without any booked
+        variation are omitted.
+        """
+        layout = {}
+        for stage in self.stages:
+            for var in self.variables:
+                systs = [s for s in self.variations if self.is_booked(stage, var, s)]
+                if systs:
+                    layout.setdefault(stage, {})[var] = systs
+        return layout
+
+    @property
+    def n_booked(self):
+        return sum(len(systs) for vars_dict in self.layout().values() for systs in vars_dict.values())
+
+    @property
+    def n_total(self):
+        return len(self.stages) * len(self.variables) * len(self.variations)
+
+    def summary(self, n_events=200_000):
+        """
+        Prints the number of booked histograms and measures the fill time
+        saved per chunk of `n_events` events against booking everything.
+        Pass n_events=0 to skip the timing.
+        """
+        print(f"Booked histograms: {self.n_booked} / {self.n_total} per sample "
+              f"({100.0 * self.n_booked / self.n_total:.1f}%)")
+        if not n_events:
+            return
+
+        t_booked = _time_fill(self, n_events)
+        t_full = _time_fill(HistogramBooking(self.stages, self.variables, self.variations, book_all=True), n_events)
+        print(f"Fill time per {n_events:,} events (all stages): {t_booked*1e3:.1f} ms booked "
+              f"vs {t_full*1e3:.1f} ms for everything (saves {100.0 * (1 - t_booked / t_full):.0f}%)")
+
+def default_booking():
+    """Booking that covers the stacked plots, shape plots and datacards."""
+    booking = HistogramBooking()
+    booking.request_plot_settings()
+    booking.request_shape_plots()
+    booking.request_datacards()
+    return booking
+
+def book_everything():
+    """Booking of every stage, variable and variation (exploratory runs)."""
+    return HistogramBooking(book_all=True)
+
+def _time_fill(booking, n_events):
+    """Times filling every stage once with random events for the given booking."""
+    from .Plots_config import variables_to_plots
+    from .helper import initialize_stage_histograms, fill_stage_histograms
+
+    rng = np.random.default_rng(0)
+    histograms = initialize_stage_histograms(booking.stages, variables_to_plots, booking.variations, booking=booking)
+    observables = {var: rng.uniform(0, 200, n_events) for var in booking.variables}
+    weights = {syst: rng.uniform(0.5, 1.5, n_events) for syst in booking.variations}
+    mask = np.ones(n_events, dtype=bool)
+
+    start = time.perf_counter()
+    for stage in booking.stages:
+        fill_stage_histograms(histograms, stage, mask, weights, observables)
+    return time.perf_counter() - start
@@ -0,0 +1,362 @@
+"""
+cut_registry.py
+
+This module provides a declarative registry of the analysis selections.
+
+`cuts.apply_global_cuts`, `apply_signal_region_cuts` and
+`apply_control_region_cuts` each rebuild their masks from scratch, so the same
+predicates (met.pt > 20, ptll > 30, mll > 12, mt_l2_met > 30, the m_jj window)
+are evaluated several times per chunk. Here instead:
+- Every predicate (one elementary cut) is defined once, by name.
+- Every region is the AND of predicates and other regions, so shared pieces
+  such as 'global' or 'sr_base' are themselves named nodes of a DAG.
+- `CutRegistry.evaluate` returns a `CutEvaluator` that computes each node at
+  most once per chunk, in dependency order, and memoizes the masks.
+
+Because the leaf predicates of every region are known, the evaluator also
+gives sequential cutflows and N-1 masks (all cuts of a region but one)
+without extra definitions. `default_cut_registry()` reproduces the selections
+of cuts.py exactly.
+
+`apply_selection` runs the whole bookkeeping of one chunk from these shared
+masks: stage cutflows with sum of weights and sum of squared weights, the
+per-cut cutflow of every SR/CR, and the stage and N-1 histograms.
+"""
+
+import awkward as ak
+import numpy as np
+
+from . import Config
+from .calculations import apply_mjj_window
+from .cutflow_utils import accumulate_cutflow, region_cut_key
+
+# Separator of the N-1 stage names: '<region>_N-1_<cut>'
+N1_SEPARATOR = "_N-1_"
+
+# Cutflow column of a stage, where it differs from the stage name (Config.cutflow_stages)
+CUTFLOW_KEYS = {'before_cuts': 'e_mu_preselection', 'global': 'global_cuts'}
+
+class CutRegistry:
+    """
+    Named predicates and regions of the selection.
+
+    Predicates are functions of the chunk inputs (a dict such as
+    {'met': ..., 'ptlls': ..., 'bjet_info': ...}) returning a boolean mask.
+    Regions are ANDs of already registered names, which keeps the graph acyclic.
+    """
+
+    def __init__(self):
+        self.predicates = {}
+        self.regions = {}
+
+    def predicate(self, name, func, description=""):
+        """Registers an elementary cut `func(inputs) -> mask`."""
+        if name in self.predicates or name in self.regions:
+            raise ValueError(f"Cut '{name}' is already defined")
+        self.predicates[name] = (func, description)
+        return self
+
+    def region(self, name, *components):
+        """
+        Registers a region as the AND of predicates and regions, in cutflow order.
+        A region without components selects every event.
+        """
+        if name in self.predicates or name in self.regions:
+            raise ValueError(f"Cut '{name}' is already defined")
+        unknown = [c for c in components if c not in self.predicates and c not in self.regions]
+        if unknown:
+            raise KeyError(f"Region '{name}' uses undefined cuts: {unknown}")
+        self.regions[name] = tuple(components)
+        return self
+
+    def leaves(self, name):
+        """The predicates a region is built from, in cutflow order and without duplicates."""
+        if name in self.predicates:
+            return [name]
+        leaves = []
+        for component in self.regions[name]:
+            leaves.extend(leaf for leaf in self.leaves(component) if leaf not in leaves)
+        return leaves
+
+    def evaluate(self, inputs):
+        """Returns a memoizing evaluator over one chunk of events."""
+        return CutEvaluator(self, inputs)
+
+class CutEvaluator:
+    """
+    Evaluates the registry on one chunk, computing every node at most once.
+
+    Parameters
+    ----------
+    registry : CutRegistry
+        The selection definitions.
+    inputs : dict
+        Input name -> per-event array (all of the same length), plus 'bjet_info'.
+    """
+
+    def __init__(self, registry, inputs):
+        self.registry = registry
+        self.inputs = inputs
+        self.n_events = len(inputs['masses'])
+        self._masks = {}
+
+    def mask(self, name):
+        """The NumPy boolean mask of a predicate or region."""
+        mask = self._masks.get(name)
+        if mask is not None:
+            return mask
+
+        registry = self.registry
+        if name in registry.predicates:
+            func, _ = registry.predicates[name]
+            mask = np.asarray(ak.to_numpy(func(self.inputs)), dtype=bool)
+        else:
+            components = registry.regions[name]
+            if not components:
+                mask = np.ones(self.n_events, dtype=bool)
+            else:
+                mask = self.mask(components[0]).copy()
+                for component in components[1:]:
+                    mask &= self.mask(component)
+        self._masks[name] = mask
+        return mask
+
+    def masks(self, names):
+        """{name: mask} for several predicates or regions (e.g., Config.stage_names)."""
+        return {name: self.mask(name) for name in names}
+
+    def cutflow(self, region, weights=None):
+        """
+        Sequential cutflow of a region over its leaf predicates.
+
+        Returns
+        -------
+        list of (str, int, float or None)
+            (predicate, events passing it and all previous ones, sum of `weights`).
+        """
+        weights = None if weights is None else np.asarray(ak.to_numpy(weights), dtype=np.float64)
+        passed = np.ones(self.n_events, dtype=bool)
+        rows = []
+        for leaf in self.registry.leaves(region):
+            passed &= self.mask(leaf)
+            rows.append((leaf, int(np.count_nonzero(passed)),
+                         float(weights[passed].sum()) if weights is not None else None))
+        return rows
+
+    def n_minus_one(self, region):
+        """
+        N-1 masks of a region: for every leaf predicate, the AND of all the others.
+
+        Uses prefix and suffix ANDs, so a region with k cuts costs O(k) mask
+        operations instead of O(k^2).
+        """
+        leaves = self.registry.leaves(region)
+        masks = [self.mask(leaf) for leaf in leaves]
+        all_true = np.ones(self.n_events, dtype=bool)
+
+        prefix = [all_true]
+        for mask in masks[:-1]:
+            prefix.append(prefix[-1] & mask)
+        suffix = [all_true]
+        for mask in reversed(masks[1:]):
+            suffix.append(suffix[-1] & mask)
+        suffix.reverse()
+
+        return {leaf: prefix[i] & suffix[i] for i, leaf in enumerate(leaves)}
+
+    def region_cutflows(self, regions, weights):
+        """
+        Sequential per-cut cutflows of several regions, in one vectorized pass.
+
+        The cumulative masks of all regions are stacked into one matrix, so the
+        counts, sums of weights and sums of squared weights of every row come
+        from one sum and two matrix-vector products.
+
+        Returns
+        -------
+        dict
+            Region -> list of (cut, events, sumw, sumw2).
+        """
+        weights = np.asarray(ak.to_numpy(weights), dtype=np.float64)
+        rows, cumulative = [], []
+        for region in regions:
+            passed = np.ones(self.n_events, dtype=bool)
+            for leaf in self.registry.leaves(region):
+                passed = passed & self.mask(leaf)
+                rows.append((region, leaf))
+                cumulative.append(passed)
+        if not rows:
+            return {}
+
+        matrix = np.stack(cumulative).view(np.uint8)
+        counts = matrix.sum(axis=1, dtype=np.int64)
+        sumw = matrix @ weights
+        sumw2 = matrix @ (weights * weights)
+
+        cutflows = {region: [] for region in regions}
+        for i, (region, leaf) in enumerate(rows):
+            cutflows[region].append((leaf, int(counts[i]), float(sumw[i]), float(sumw2[i])))
+        return cutflows
+
+# ==============================================================================
+# N-1 STAGES AND PER-CHUNK BOOKKEEPING
+# ==============================================================================
+
+def n_minus_one_stages(regions=None, registry=None):
+    """
+    The N-1 histogram stages: one per region and cut on an observable.
+
+    Parameters
+    ----------
+    regions : list of str, optional
+        Defaults to Config.n_minus_one_regions.
+    registry : CutRegistry, optional
+        Defaults to default_cut_registry().
+
+    Returns
+    -------
+    dict
+        Stage name ('SR_0jet_N-1_mt_higgs') -> (region, cut, variable), where the
+        variable comes from Config.n_minus_one_variables.
+    """
+    regions = regions if regions is not None else Config.n_minus_one_regions
+    registry = registry if registry is not None else default_cut_registry()
+    stages = {}
+    for region in regions:
+        for cut in registry.leaves(region):
+            variable = Config.n_minus_one_variables.get(cut)
+            if variable is not None:
+                stages[f"{region}{N1_SEPARATOR}{cut}"] = (region, cut, variable)
+    return stages
+
+def apply_selection(evaluator, stage_histograms, weights_dict, observables, cutflow,
+                    weighted_cutflow, stage_names=None, regions=None):
+    """
+    Does the selection bookkeeping of one chunk from the shared masks of `evaluator`.
+
+    - Stage cutflow: for every stage, the events, sum of weights and sum of
+      squared weights ('<key>_sumw2') are added to `cutflow` and
+      `weighted_cutflow` (stage names mapped with CUTFLOW_KEYS).
+    - Per-cut cutflow: the sequential cutflow of every region of `regions`
+      under the keys '<region>/<cut>' (see
+      CutEvaluator.region_cutflows), for the efficiency table.
+    - Histograms: the stages of `stage_names` and the N-1 stages booked in
+      `stage_histograms` (see n_minus_one_stages) are filled with
+      helper.fill_histograms_from_bitmask.
+
+    Parameters
+    ----------
+    evaluator : CutEvaluator
+        Masks of this chunk.
+    stage_histograms : dict or histogram_store.HistogramStore
+        Nested histogram dictionary from helper.initialize_stage_histograms,
+        or a one-sample store (see processor.Processor).
+    weights_dict : dict
+        Variation name -> per-event weights. The cutflows use 'nominal'.
+    observables : dict
+        Variable name -> per-event values.
+    cutflow, weighted_cutflow : dict
+        Accumulators of the processing result, updated in place.
+    stage_names : list of str, optional
+        Defaults to Config.stage_names.
+    regions : list of str, optional
+        Regions with a per-cut cutflow and N-1 histograms. Defaults to
+        Config.n_minus_one_regions.
+    """
+    from .cuts import stage_bitmask, bitmask_cutflow
+    from .helper import booked_histograms, fill_histograms_from_bitmask
+
+    stage_names = stage_names if stage_names is not None else Config.stage_names
+    regions = regions if regions is not None else Config.n_minus_one_regions
+    registry = evaluator.registry
+    weights = weights_dict['nominal']
+
+    defined = [stage for stage in stage_names if stage in registry.regions or stage in registry.predicates]
+    bits = stage_bitmask(evaluator.masks(defined), evaluator.n_events, stage_names)
+    counts, sumw, sumw2 = bitmask_cutflow(bits, weights, stage_names, sumw2=True)
+    for stage in defined:
+        key = CUTFLOW_KEYS.get(stage, stage)
+        accumulate_cutflow(cutflow, weighted_cutflow, key, counts[stage], sumw[stage], sumw2[stage])
+
+    for region, rows in evaluator.region_cutflows(regions, weights).items():
+        for cut, n, w, w2 in rows:
+            accumulate_cutflow(cutflow, weighted_cutflow, region_cut_key(region, cut), n, w, w2)
+
+    fill_histograms_from_bitmask(stage_histograms, bits, weights_dict, observables, stage_names)
+
+    # N-1 stages, encoded in further bitmasks of at most 32 stages each
+    n1_stages = {
+        stage: (region, cut) for stage, (region, cut, _) in n_minus_one_stages(regions, registry).items()
+        if booked_histograms(stage_histograms, stage)
+    }
+    by_region = {region: evaluator.n_minus_one(region) for region, _ in n1_stages.values()}
+    n1_names = list(n1_stages)
+    for start in range(0, len(n1_names), 32):
+        names = n1_names[start:start + 32]
+        n1_masks = {stage: by_region[n1_stages[stage][0]][n1_stages[stage][1]] for stage in names}
+        n1_bits = stage_bitmask(n1_masks, evaluator.n_events, names)
+        fill_histograms_from_bitmask(stage_histograms, n1_bits, weights_dict, observables, names)
+
+# ==============================================================================
+# ANALYSIS SELECTIONS
+# ==============================================================================
+
+def default_cut_registry():
+    """
+    The global, jet-bin, signal and control region selections of cuts.py.
+
+    Inputs: leading, subleading, met, masses, ptlls, mt_higgs, mt_l2_met,
+    isZeroJet, isOneJet, isTwoJet, bjet_info and mjj (None for no m_jj window).
+    """
+    registry = CutRegistry()
+
+    # Elementary cuts
+    registry.predicate('met_pt', lambda ev: ev['met'].pt > 20, "Reject QCD multijet and low-MET backgrounds")
+    registry.predicate('ptll', lambda ev: ev['ptlls'] > 30, "Dilepton pT requirement")
+    registry.predicate('mll', lambda ev: ev['masses'] > 12, "Low mass resonance veto")
+    registry.predicate('mll_50', lambda ev: ev['masses'] > 50, "Removes low-mass Drell-Yan")
+    registry.predicate('mt_higgs', lambda ev: ev['mt_higgs'] > 60, "Higgs-like transverse mass")
+    registry.predicate('mt_l2_met', lambda ev: ev['mt_l2_met'] > 30, "Suppresses W+jets")
+    registry.predicate('bjet_veto', lambda ev: ev['bjet_info']['passes_bjet_veto'], "b-jet veto")
+    registry.predicate('btag_20_30', lambda ev: ev['bjet_info']['has_btag_20_30'], "Soft b-jet (20 < pT < 30 GeV)")
+    registry.predicate('btag_30', lambda ev: ev['bjet_info']['has_btag_30'], "Hard b-jet (pT > 30 GeV)")
+    registry.predicate('zero_jet', lambda ev: ev['isZeroJet'])
+    registry.predicate('one_jet', lambda ev: ev['isOneJet'])
+    registry.predicate('two_jet', lambda ev: ev['isTwoJet'])
+    registry.predicate('mjj_window', _mjj_window, "m_jj < 65 or 105 < m_jj < 120")
+
+    # Global selection and jet bins
+    registry.region('before_cuts')
+    registry.region('global_cuts', 'met_pt', 'ptll', 'mll')
+    registry.region('global', 'global_cuts', 'bjet_veto')
+    registry.region('0jet', 'global', 'zero_jet')
+    registry.region('1jet', 'global', 'one_jet')
+    registry.region('2jet', 'global', 'two_jet')
+
+    # Signal regions
+    registry.region('sr_base', 'global', 'mt_higgs', 'mt_l2_met')
+    registry.region('SR_0jet', 'sr_base', 'zero_jet')
+    registry.region('SR_1jet', 'sr_base', 'one_jet')
+    registry.region('SR_2jet', 'sr_base', 'two_jet', 'mjj_window')
+
+    # Top control regions
+    registry.region('cr_base', 'global_cuts', 'mt_l2_met')
+    registry.region('cr_top_base', 'cr_base', 'mll_50')
+    registry.region('CR_top_0jet', 'cr_top_base', 'zero_jet', 'btag_20_30')
+    registry.region('CR_top_1jet', 'cr_top_base', 'one_jet', 'btag_30')
+    registry.region('CR_top_2jet', 'cr_top_base', 'two_jet', 'mjj_window', 'btag_30')
+
+    # Tau-tau (Drell-Yan) control regions, disabled like in cuts.py
+    # registry.predicate('mt_higgs_low', lambda ev: ev['mt_higgs'] < 60)
+    # registry.predicate('mll_z_window', lambda ev: (ev['masses'] > 40) & (ev['masses'] < 80))
+    # registry.region('cr_tau_base', 'cr_base', 'mt_higgs_low', 'mll_z_window', 'bjet_veto')
+    # registry.region('CR_tau_0jet', 'cr_tau_base', 'zero_jet')
+    # registry.region('CR_tau_1jet', 'cr_tau_base', 'one_jet')
+    # registry.region('CR_tau_2jet', 'cr_tau_base', 'two_jet', 'mjj_window')
+
+    return registry
+
+def _mjj_window(ev):
+    if ev.get('mjj') is None:
+        return np.ones(len(ev['masses']), dtype=bool)
+    return apply_mjj_window(ev['mjj'])
@@ -0,0 +1,199 @@
+"""
+cut_scan.py
+
+This module scans the signal-region thresholds and finds the working point
+with the best expected significance in each jet bin.
+
+The thresholds of `cuts.apply_signal_region_cuts` (met > 20, ptll > 30,
+mt_higgs > 60, mt_l2_met > 30) are hard-coded, and testing another value means
+another full run. The scan instead reads the event ntuples once (see ntuple.py
+and query.py) and, for every jet bin:
+1. Fills one fine N-dimensional histogram of the signal and background weights,
+   whose bin edges are the scanned thresholds of each variable.
+2. Turns it into yields for every grid point at once with cumulative sums
+   along each axis (reversed for `>` cuts), i.e. an N-dimensional prefix sum.
+3. Evaluates the Asimov significance on the whole grid and reports the best point.
+
+The starting selection of each jet bin is the '0jet'/'1jet'/'2jet' stage, which
+already contains the global cuts (met > 20, ptll > 30, mll > 12, b-jet veto);
+grid points below those values are therefore equivalent to the global cut.
+The 2-jet bin also keeps the m_jj window of `calculations.apply_mjj_window`.
+"""
+
+import numpy as np
+
+from .Plots_config import SAMPLES
+
+# (variable, direction, thresholds): events pass if `variable direction threshold`
+DEFAULT_SCAN = [
+    ('met', '>', np.arange(20, 61, 5)),
+    ('ptll', '>', np.arange(30, 61, 5)),
+    ('mt_higgs', '>', np.arange(40, 131, 5)),
+    ('mt_l2_met', '>', np.arange(10, 61, 5)),
+]
+
+# Current signal region working point, reported next to the optimum
+NOMINAL_POINT = {'met': 20, 'ptll': 30, 'mt_higgs': 60, 'mt_l2_met': 30}
+
+# Starting selection of each jet bin
+JET_BINS = {
+    '0jet': "stage('0jet')",
+    '1jet': "stage('1jet')",
+    '2jet': "stage('2jet') and (mjj < 65 or 105 < mjj < 120)",
+}
+
+def asimov_significance(s, b, rel_unc=0.0):
+    """
+    Median expected discovery significance for s signal over b background
+    events, with an optional relative background uncertainty (Cowan et al.).
+    Returns 0 where b <= 0.
+    """
+    s = np.asarray(s, dtype=float)
+    b = np.asarray(b, dtype=float)
+    z = np.zeros(np.broadcast(s, b).shape)
+    ok = (b > 0) & (s >= 0)
+    s, b = np.broadcast_to(s, z.shape)[ok], np.broadcast_to(b, z.shape)[ok]
+
+    if rel_unc <= 0:
+        z[ok] = np.sqrt(2 * ((s + b) * np.log1p(s / b) - s))
+        return z
+
+    sb2 = (rel_unc * b) ** 2
+    term1 = (s + b) * np.log((s + b) * (b + sb2) / (b * b + (s + b) * sb2))
+    term2 = b * b / sb2 * np.log1p(sb2 * s / (b * (b + sb2)))
+    z[ok] = np.sqrt(np.maximum(2 * (term1 - term2), 0.0))
+    return z
+
+def _prefix_sums(grid, scan):
+    """
+    Converts per-cell sums into yields for every threshold combination.
+
+    Along a '>' axis the cell index m counts the thresholds below the value, so
+    the yield of `x > t_k` is the sum over m >= k + 1 (reversed cumulative sum).
+    Along a '<' axis m counts the thresholds at or below the value, and the
+    yield of `x < t_k` is the sum over m <= k (cumulative sum).
+    """
+    for axis, (_, direction, _) in enumerate(scan):
+        if direction == '>':
+            grid = np.flip(np.cumsum(np.flip(grid, axis), axis), axis)
+            grid = np.take(grid, np.arange(1, grid.shape[axis]), axis=axis)
+        else:
+            grid = np.cumsum(grid, axis)
+            grid = np.take(grid, np.arange(0, grid.shape[axis] - 1), axis=axis)
+    return grid
+
+def scan_thresholds(query, scan=None, jet_bins=None, signal=None, backgrounds=None,
+                    rel_unc=0.0, min_background=1.0):
+    """
+    Computes signal/background yields and significance on a threshold grid.
+
+    Parameters
+    ----------
+    query : query.NtupleQuery
+        Query engine over the event ntuples.
+    scan : list of (variable, direction, thresholds), optional
+        Scanned cuts. `direction` is '>' or '<'. Defaults to DEFAULT_SCAN.
+    jet_bins : dict, optional
+        Jet bin name -> starting cut expression. Defaults to JET_BINS.
+    signal : list of str, optional
+        Signal samples. Defaults to the samples flagged `is_signal` in Plots_config.SAMPLES.
+    backgrounds : list of str, optional
+        Background samples. Defaults to every other simulated sample.
+    rel_unc : float, optional
+        Relative background uncertainty used in the significance. Defaults to 0.
+    min_background : float, optional
+        Grid points with fewer expected background events are not considered
+        for the optimum (they are dominated by MC fluctuations). Defaults to 1.
+
+    Returns
+    -------
+    dict
+        Jet bin -> {'scan': [(variable, direction)], 'thresholds': [array per variable], 's': grid, 'b': grid,
+        'b_var': grid, 'z': grid, 'best': {...}, 'nominal': {...} or None}.
+    """
+    scan = scan if scan is not None else DEFAULT_SCAN
+    jet_bins = jet_bins if jet_bins is not None else JET_BINS
+    if signal is None:
+        signal = [s for s in query.samples if SAMPLES.get(s, {}).get('is_signal', False)]
+    if backgrounds is None:
+        backgrounds = [s for s in query.samples if s not in signal and s != 'Data']
+
+    thresholds = [np.unique(np.asarray(values, dtype=float)) for _, _, values in scan]
+    shape = tuple(len(t) + 1 for t in thresholds)
+    n_cells = int(np.prod(shape))
+    group_of = {**{s: 0 for s in signal}, **{s: 1 for s in backgrounds}}
+
+    results = {}
+    for jet_bin, base_cut in jet_bins.items():
+        def fill(ns):
+            group = group_of.get(ns.sample)
+            if group is None:
+                return None
+            mask = query.mask(ns, base_cut)
+            selected = np.nonzero(mask)[0] if mask is not None else slice(None)
+            cells = tuple(
+                np.searchsorted(t, ns[var][selected], side='left' if direction == '>' else 'right')
+                for (var, direction, _), t in zip(scan, thresholds)
+            )
+            flat = np.ravel_multi_index(cells, shape)
+            w = ns['weight_nominal'][selected].astype(np.float64)
+            return group, np.bincount(flat, weights=w, minlength=n_cells), \
+                np.bincount(flat, weights=w * w, minlength=n_cells)
+
+        sums = np.zeros((2, n_cells))
+        sums2 = np.zeros((2, n_cells))
+        for parts in query.map_partitions(fill).values():
+            for part in parts:
+                if part is None:
+                    continue
+                group, sumw, sumw2 = part
+                sums[group] += sumw
+                sums2[group] += sumw2
+
+        s = _prefix_sums(sums[0].reshape(shape), scan)
+        b = _prefix_sums(sums[1].reshape(shape), scan)
+        b_var = _prefix_sums(sums2[1].reshape(shape), scan)
+        z = asimov_significance(s, b, rel_unc)
+
+        allowed = np.where(b >= min_background, z, -np.inf)
+        best_idx = np.unravel_index(np.argmax(allowed), allowed.shape)
+        results[jet_bin] = {
+            'scan': [(var, direction) for var, direction, _ in scan],
+            'thresholds': thresholds,
+            's': s, 'b': b, 'b_var': b_var, 'z': z,
+            'best': _point(scan, thresholds, best_idx, s, b, z),
+            'nominal': _nominal_point(scan, thresholds, s, b, z),
+        }
+    return results
+
+def _point(scan, thresholds, idx, s, b, z):
+    return {
+        'cuts': {var: float(t[i]) for (var, _, _), t, i in zip(scan, thresholds, idx)},
+        's': float(s[idx]), 'b': float(b[idx]), 'z': float(z[idx]),
+    }
+
+def _nominal_point(scan, thresholds, s, b, z):
+    """The grid point of the current working point, if it is on the grid."""
+    idx = []
+    for (var, _, _), t in zip(scan, thresholds):
+        matches = np.nonzero(np.isclose(t, NOMINAL_POINT.get(var, np.nan)))[0]
+        if len(matches) == 0:
+            return None
+        idx.append(matches[0])
+    return _point(scan, thresholds, tuple(idx), s, b, z)
+
+def print_scan_report(results):
+    """Prints the best and the current working point of every jet bin."""
+    print("\n" + "="*70)
+    print("CUT SCAN: best expected significance per jet bin")
+    print("="*70)
+    for jet_bin, result in results.items():
+        n_points = result['z'].size
+        print(f"{jet_bin} ({n_points:,} working points)")
+        for name in ('nominal', 'best'):
+            point = result[name]
+            if point is None:
+                continue
+            cuts = ", ".join(f"{var} {direction} {point['cuts'][var]:g}" for var, direction in result['scan'])
+            print(f"  {name:8s}: Z = {point['z']:.3f}  (S = {point['s']:.2f}, B = {point['b']:.2f})  [{cuts}]")
+    print("="*70)
@@ -9,11 +9,31 @@ The module provides functions to:
 - Parse nested cutflow dictionaries into standard table rows.
 - Calculate total background (MC) yields.
 - Save both Raw (unweighted) and Scaled (weighted) cutflows to CSV files.
+- Save the statistical errors and the per-cut efficiencies, when the processor
+  records them (see cut_registry.apply_selection).
+
+Besides the stage keys of Config.cutflow_stages, the weighted cutflow of a
+sample may hold '<key>_sumw2' entries (sum of squared weights), and both
+cutflows may hold '<region>/<cut>' entries (sequential cutflow of a region).
 """
 
 import csv
+import math
 from . import Config
 
+SUMW2_SUFFIX = "_sumw2"
+REGION_CUT_SEPARATOR = "/"
+
+def region_cut_key(region, cut):
+    """Cutflow key of the events of `region` passing its cuts up to `cut`."""
+    return f"{region}{REGION_CUT_SEPARATOR}{cut}"
+
+def accumulate_cutflow(cutflow, weighted_cutflow, key, n, sumw, sumw2):
+    """Adds n events with these sums of weights and squared weights to `key` (created on first use)."""
+    cutflow[key] = cutflow.get(key, 0) + n
+    weighted_cutflow[key] = weighted_cutflow.get(key, 0.0) + sumw
+    weighted_cutflow[key + SUMW2_SUFFIX] = weighted_cutflow.get(key + SUMW2_SUFFIX, 0.0) + sumw2
+
 def get_cutflow_rows(cutflow_data, stage_info=None, sample_order=None):
     """
     Generates the header and rows for the cutflow table from raw tracking data.
@@ -86,7 +106,7 @@ def get_cutflow_rows(cutflow_data, stage_info=None, sample_order=None):
     return header, rows
 
 
-def save_cutflows(cutflow_final, weighted_cutflow_final, output_dir):
+def save_cutflows(cutflow_final, weighted_cutflow_final, output_dir, stage_info=None, prefix="Cutflow"):
     """
     Formats the raw numerical cutflow data and exports them as CSV files.
     
@@ -95,6 +115,8 @@ def save_cutflows(cutflow_final, weighted_cutflow_final, output_dir):
     Outputs:
     - Cutflow_Raw.csv: Exact integer counts of events.
     - Cutflow_scaled.csv: Event yields scaled by luminosity and cross-section.
+    - Cutflow_scaled_errors.csv and Cutflow_efficiency.csv, if the cutflows
+      hold sums of squared weights and per-cut entries.
     
     Parameters
     ----------
@@ -104,13 +126,17 @@ def save_cutflows(cutflow_final, weighted_cutflow_final, output_dir):
         The scaled event yields (incorporating genWeights, scale factors, etc.).
     output_dir : pathlib.Path
         The directory where the CSV files will be saved.
+    stage_info : list of tuples, optional
+        Columns as (stage key, display name). Defaults to Config.stage_info.
+    prefix : str, optional
+        File name prefix of the two CSV files. Defaults to "Cutflow".
     """
     
     # ---------------------------------------------------------
     # 1. Save Raw Events (Unweighted)
     # ---------------------------------------------------------
-    header_raw, rows_raw = get_cutflow_rows(cutflow_final)
-    raw_path = output_dir / "Cutflow_Raw.csv"
+    header_raw, rows_raw = get_cutflow_rows(cutflow_final, stage_info)
+    raw_path = output_dir / f"{prefix}_Raw.csv"
     
     formatted_rows_raw = []
     for row in rows_raw:
@@ -132,8 +158,8 @@ def save_cutflows(cutflow_final, weighted_cutflow_final, output_dir):
     # ---------------------------------------------------------
     # Only process if weighted data exists
     if weighted_cutflow_final:
-        header_w, rows_w = get_cutflow_rows(weighted_cutflow_final)
-        weighted_path = output_dir / "Cutflow_scaled.csv"
+        header_w, rows_w = get_cutflow_rows(weighted_cutflow_final, stage_info)
+        weighted_path = output_dir / f"{prefix}_scaled.csv"
         
         # Format Weighted numbers: Force exactly 2 decimal places.
         # This standardizes the table view and avoids long floating-point artifacts.
@@ -150,4 +176,85 @@ def save_cutflows(cutflow_final, weighted_cutflow_final, output_dir):
                 writer.writerows(formatted_rows_w)
             print(f"Saved Weighted Cutflow to: {weighted_path}")
         except Exception as e:
-            print(f"Failed to save Weighted CSV: {e}")
\ No newline at end of file
+            print(f"Failed to save Weighted CSV: {e}")
+
+    # ---------------------------------------------------------
+    # 3. Statistical errors and per-cut efficiencies (if recorded)
+    # ---------------------------------------------------------
+    if weighted_cutflow_final:
+        save_cutflow_errors(weighted_cutflow_final, output_dir, stage_info, prefix)
+        save_cut_efficiencies(cutflow_final, weighted_cutflow_final, output_dir, prefix)
+
+def save_cutflow_errors(weighted_cutflow_final, output_dir, stage_info=None, prefix="Cutflow"):
+    """
+    Saves the statistical error sqrt(sum of w^2) of every entry of the scaled
+    cutflow to <prefix>_scaled_errors.csv, with the same rows and columns.
+    Nothing is written if the cutflow has no '_sumw2' entries.
+    """
+    if not any(key.endswith(SUMW2_SUFFIX) for stages in weighted_cutflow_final.values() for key in stages):
+        return
+
+    sumw2_data = {
+        sample: {key[:-len(SUMW2_SUFFIX)]: val for key, val in stages.items() if key.endswith(SUMW2_SUFFIX)}
+        for sample, stages in weighted_cutflow_final.items()
+    }
+    header, rows = get_cutflow_rows(sumw2_data, stage_info)
+    errors_path = output_dir / f"{prefix}_scaled_errors.csv"
+
+    formatted_rows = []
+    for row in rows:
+        formatted_rows.append([row[0]] + [f"{math.sqrt(max(float(val), 0.0)):.2f}" for val in row[1:]])
+
+    try:
+        with open(errors_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(formatted_rows)
+        print(f"Saved Weighted Cutflow errors to: {errors_path}")
+    except Exception as e:
+        print(f"Failed to save errors CSV: {e}")
+
+def save_cut_efficiencies(cutflow_final, weighted_cutflow_final, output_dir, prefix="Cutflow"):
+    """
+    Saves the sequential per-cut cutflow of every region to <prefix>_efficiency.csv.
+
+    One row per sample, region and cut with the events, the weighted yield and
+    its error, the efficiency of the cut (yield after / before it) and the
+    cumulative efficiency with respect to the e-mu preselection.
+    Nothing is written if the cutflows have no '<region>/<cut>' entries.
+    """
+    rows = []
+    for sample in Config.sample_order:
+        if sample not in weighted_cutflow_final:
+            continue
+        raw = cutflow_final.get(sample, {})
+        weighted = weighted_cutflow_final[sample]
+        reference = weighted.get('e_mu_preselection', 0.0)
+
+        previous = {}
+        for key, sumw in weighted.items():
+            if REGION_CUT_SEPARATOR not in key or key.endswith(SUMW2_SUFFIX):
+                continue
+            region, cut = key.split(REGION_CUT_SEPARATOR, 1)
+            before = previous.get(region, reference)
+            error = math.sqrt(max(weighted.get(key + SUMW2_SUFFIX, 0.0), 0.0))
+            rows.append([
+                sample, region, cut, f"{float(raw.get(key, 0)):.0f}", f"{sumw:.2f}", f"{error:.2f}",
+                f"{sumw / before:.4f}" if before else "",
+                f"{sumw / reference:.4f}" if reference else "",
+            ])
+            previous[region] = sumw
+
+    if not rows:
+        return
+
+    efficiency_path = output_dir / f"{prefix}_efficiency.csv"
+    header = ['Sample', 'Region', 'Cut', 'Events', 'Yield', 'Yield error', 'Efficiency', 'Cumulative efficiency']
+    try:
+        with open(efficiency_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        print(f"Saved cut efficiencies to: {efficiency_path}")
+    except Exception as e:
+        print(f"Failed to save efficiency CSV: {e}")
\ No newline at end of file
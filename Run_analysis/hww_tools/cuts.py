@@ -9,6 +9,7 @@ It defines the boolean masks that filter the dataset into specific regions:
 """
 
 import awkward as ak
+import numpy as np
 from .calculations import apply_mjj_window
 
 def apply_global_cuts(leading, subleading, met, mt_higgs, mt_l2_met, ptlls, masses):
@@ -149,4 +150,118 @@ def apply_control_region_cuts(leading, subleading, met, masses, ptlls, mt_higgs,
     # cr_regions['CR_tau_1jet'] = cr_tau_base & isOneJet  
     # cr_regions['CR_tau_2jet'] = cr_tau_base & isTwoJet & mjj_window
     
-    return cr_regions
\ No newline at end of file
+    return cr_regions
+
+# =========================================================================
+# STAGE BITMASK
+# =========================================================================
+def stage_bit(stage, stage_names=None):
+    """Bit assigned to a stage: bit i is set for the i-th entry of Config.stage_names."""
+    if stage_names is None:
+        from .Config import stage_names
+    return 1 << stage_names.index(stage)
+
+def stage_bitmask(stage_masks, n_events, stage_names=None):
+    """
+    Encodes the stages passed by each event into a single integer.
+
+    Parameters
+    ----------
+    stage_masks : dict
+        Stage name -> boolean mask (awkward or NumPy) over the same events.
+        Stages missing from the dictionary are treated as failed.
+    n_events : int
+        Number of events.
+    stage_names : list of str, optional
+        Bit order. Defaults to Config.stage_names (at most 32 stages).
+
+    Returns
+    -------
+    numpy.ndarray (uint32)
+        Bit i is set if the event passed stage_names[i].
+    """
+    if stage_names is None:
+        from .Config import stage_names
+    bits = np.zeros(n_events, dtype=np.uint32)
+    for i, stage in enumerate(stage_names):
+        if stage in stage_masks:
+            bits |= ak.to_numpy(stage_masks[stage]).astype(np.uint32) << np.uint32(i)
+    return bits
+
+def region_bitmask(leading, subleading, met, masses, ptlls, mt_higgs, mt_l2_met,
+                   isZeroJet, isOneJet, isTwoJet, bjet_info, mjj=None, stage_names=None,
+                   registry=None):
+    """
+    Evaluates every stage of the analysis and returns the stage bitmask directly.
+
+    The stages are taken from `cut_registry.default_cut_registry()` (or
+    `registry`), which reproduces the processor: 'before_cuts' (all events),
+    'global' (global cuts and b-jet veto), the jet bins within 'global', and
+    the signal and control regions of apply_signal_region_cuts and
+    apply_control_region_cuts. Shared cuts are evaluated only once. A stage
+    of `stage_names` that is not defined in the registry counts as failed.
+
+    Returns
+    -------
+    numpy.ndarray (uint32)
+        Bit i is set if the event passed stage_names[i].
+    """
+    from .cut_registry import default_cut_registry
+
+    if stage_names is None:
+        from .Config import stage_names
+    registry = registry if registry is not None else default_cut_registry()
+    evaluator = registry.evaluate({
+        'leading': leading, 'subleading': subleading, 'met': met, 'masses': masses,
+        'ptlls': ptlls, 'mt_higgs': mt_higgs, 'mt_l2_met': mt_l2_met,
+        'isZeroJet': isZeroJet, 'isOneJet': isOneJet, 'isTwoJet': isTwoJet,
+        'bjet_info': bjet_info, 'mjj': mjj,
+    })
+    defined = [stage for stage in stage_names if stage in registry.regions or stage in registry.predicates]
+    return stage_bitmask(evaluator.masks(defined), evaluator.n_events, stage_names)
+
+def unpack_stage_bits(bits, n_stages):
+    """
+    Expands a stage bitmask into an (n_events, n_stages) uint8 matrix with
+    one column per stage, using a single np.unpackbits call.
+    """
+    as_bytes = np.ascontiguousarray(bits, dtype='<u4').view(np.uint8).reshape(-1, 4)
+    return np.unpackbits(as_bytes, axis=1, bitorder='little')[:, :n_stages]
+
+def bitmask_cutflow(bits, weights=None, stage_names=None, sumw2=False):
+    """
+    Counts the events passing every stage in one reduction over the bitmask.
+
+    Parameters
+    ----------
+    bits : numpy.ndarray (uint32)
+        Stage bitmask from stage_bitmask or region_bitmask.
+    weights : array, optional
+        Per-event weights (e.g., weights_dict['nominal']) for the weighted cutflow.
+    stage_names : list of str, optional
+        Bit order. Defaults to Config.stage_names.
+    sumw2 : bool, optional
+        If True, also return the sums of squared weights (statistical errors).
+
+    Returns
+    -------
+    counts : dict
+        Stage name -> number of events.
+    weighted : dict or None
+        Stage name -> sum of weights, if `weights` is given.
+    weighted_sumw2 : dict or None
+        Stage name -> sum of squared weights. Only returned if `sumw2` is True.
+    """
+    if stage_names is None:
+        from .Config import stage_names
+    matrix = unpack_stage_bits(bits, len(stage_names))
+    counts = matrix.sum(axis=0, dtype=np.int64)
+    counts = {stage: int(n) for stage, n in zip(stage_names, counts)}
+    if weights is None:
+        return (counts, None, None) if sumw2 else (counts, None)
+
+    weights = np.asarray(ak.to_numpy(weights), dtype=np.float64)
+    weighted = {stage: float(w) for stage, w in zip(stage_names, weights @ matrix)}
+    if not sumw2:
+        return counts, weighted
+    return counts, weighted, {stage: float(w) for stage, w in zip(stage_names, (weights * weights) @ matrix)}
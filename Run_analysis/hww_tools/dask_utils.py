@@ -8,13 +8,23 @@ need access to the local `hww_tools` package to execute the analysis functions.
 This module provides utilities to:
 - Establish a connection to the Dask scheduler.
 - Package the local `hww_tools` directory into a zip file.
-- Upload this zip file to all Dask workers.
-- Verify that the workers can successfully import the required modules.
+- Upload this zip file to all Dask workers (only when its content changed).
+- Import and warm up the event-processing modules on every worker, and
+  verify that the workers can successfully import them.
+- Broadcast read-only lookup data (golden JSON, cross sections, ...) to every
+  worker once, instead of inside every task (`broadcast`).
+- Install the processing task of `executors.DaskExecutor` once per worker.
+  It lives here so that `executors` can be imported without Dask.
 """
 
+import hashlib
 import os
+import pickle
 import shutil
-from dask.distributed import Client
+import time
+from dask.distributed import Client, WorkerPlugin
+
+from .executors import _setup_task, _timed_call
 
 def get_client(url="tls://localhost:8786"):
     """
@@ -33,13 +43,24 @@ def get_client(url="tls://localhost:8786"):
     client = Client(url)
     return client
 
-def prepare_workers(client, package_name="hww_tools"):
+# Modules the workers need to process events; the plotting modules are left out
+WORKER_MODULES = [
+    "Config", "Efficiency_data", "cross_section", "Physics_selection", "calculations",
+    "cuts", "cut_registry", "helper", "json_validation", "weights", "booking",
+    "histogram_store", "ntuple", "processor", "executors", "shared_store",
+]
+
+def prepare_workers(client, package_name="hww_tools", processor=None, force_upload=False, warm_up=True):
     """
     Prepares the Dask workers by distributing the local analysis code to them.
     
-    This function creates a zip archive of the specified local package, 
-    uploads it to the cluster, and runs a quick diagnostic task on every 
-    worker to ensure they can import the package successfully.
+    The package is only zipped and uploaded if its content hash differs from 
+    the copy importable on at least one worker, so re-running this cell on a 
+    cluster that already has the latest code costs a fraction of a second. 
+    Then every worker, in parallel, imports the event-processing modules 
+    (WORKER_MODULES, no plotting) and optionally warms up the processor 
+    (`Processor.warm_up`: lookup tables and the first calls into awkward, 
+    vector and hist), so the first file of each worker runs at full speed.
     
     Parameters
     ----------
@@ -48,49 +69,278 @@ def prepare_workers(client, package_name="hww_tools"):
     package_name : str, optional
         The name of the local Python package directory to distribute. 
         Defaults to "hww_tools".
+    processor : processor.Processor, optional
+        Processor to warm up on every worker. Defaults to None (imports only).
+    force_upload : bool, optional
+        Upload even if the workers already have the same code. Defaults to False.
+    warm_up : bool, optional
+        Import (and warm up) on the workers. If False, only the upload is done. 
+        Defaults to True.
+
+    Returns
+    -------
+    dict
+        Worker address -> warm-up report (`seconds`, `imports`, `processor`, 
+        `file`, `error`), empty if `warm_up` is False.
     """
+    # The functions running on the workers are defined here, so they are sent 
+    # by value: the workers do not need to import the package to run them.
+    def files_hash(location):
+        """
+        SHA-256 of the files of a package directory, or of a package inside a 
+        zip archive ('<archive>.zip/<package>'), without __pycache__.
+        """
+        import hashlib
+        import os
+        import zipfile
+
+        files = []
+        archive, _, inner = location.partition(".zip" + os.sep)
+        if inner:
+            prefix = inner.rstrip("/") + "/"
+            with zipfile.ZipFile(archive + ".zip") as zf:
+                for name in zf.namelist():
+                    if name.startswith(prefix) and not name.endswith("/") and "__pycache__" not in name:
+                        files.append((name[len(prefix):], zf.read(name)))
+        else:
+            for root, dirs, filenames in os.walk(location):
+                dirs[:] = [d for d in dirs if d != "__pycache__"]
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    with open(path, 'rb') as f:
+                        files.append((os.path.relpath(path, location).replace(os.sep, "/"), f.read()))
+
+        digest = hashlib.sha256()
+        for name, data in sorted(files):
+            digest.update(name.encode())
+            digest.update(hashlib.sha256(data).digest())
+        return digest.hexdigest()
+
+    def importable_package_hash():
+        """Hash of the package this worker would import (None if there is none), without importing it."""
+        import importlib.util
+        try:
+            spec = importlib.util.find_spec(package_name)
+        except (ImportError, ValueError):
+            return None
+        if spec is None or not spec.submodule_search_locations:
+            return None
+        return files_hash(list(spec.submodule_search_locations)[0])
+
+    def warm_up_worker(modules, processor_payload):
+        """Imports the modules and warms up the processor on this worker, timing both."""
+        import importlib
+        import os
+        import pickle
+        import time
+
+        report = {'seconds': None, 'imports': None, 'processor': None, 'file': None, 'error': None}
+        start = time.perf_counter()
+        try:
+            for module in modules:
+                importlib.import_module(f"{package_name}.{module}")
+            report['imports'] = time.perf_counter() - start
+            report['file'] = importlib.import_module(package_name).__file__
+            if processor_payload is not None:
+                report['processor'] = pickle.loads(processor_payload).warm_up()
+        except Exception as e:
+            report['error'] = f"{type(e).__name__}: {e}. CWD contents: {os.listdir('.')}"
+        report['seconds'] = time.perf_counter() - start
+        return report
+
     # ---------------------------------------------------------
-    # 1. Zip the local package
+    # 1. Compare the local package with the workers' copies
     # ---------------------------------------------------------
     # Assumes the package folder is located in the current working directory.
     cwd = os.getcwd()
-    print(f"Zipping {package_name} from {cwd}...")
-    shutil.make_archive(package_name, 'zip', cwd, package_name)
-    
-    # ---------------------------------------------------------
-    # 2. Upload to the Dask cluster
-    # ---------------------------------------------------------
-    # Send the zip file to the scheduler, which distributes it to the workers.
-    # Dask automatically extracts uploaded zip files into the workers' PYTHONPATH.
-    zip_filename = f"{package_name}.zip"
-    print(f"Uploading {zip_filename} to cluster...")
-    client.upload_file(zip_filename)
-    print(f"Upload complete. Workers can now import {package_name}.")
-    
+    local_hash = files_hash(os.path.join(cwd, package_name))
+    remote_hashes = client.run(importable_package_hash)
+    n_current = sum(h == local_hash for h in remote_hashes.values())
+
+    if n_current == len(remote_hashes) and remote_hashes and not force_upload:
+        print(f"{package_name} unchanged on all {n_current} workers ({local_hash[:12]}), skipping upload.")
+    else:
+        # ---------------------------------------------------------
+        # 2. Zip the local package and upload it to the Dask cluster
+        # ---------------------------------------------------------
+        print(f"Zipping {package_name} from {cwd} ({n_current}/{len(remote_hashes)} workers up to date)...")
+        shutil.make_archive(package_name, 'zip', cwd, package_name)
+
+        # Send the zip file to the scheduler, which distributes it to the workers.
+        # Dask automatically adds uploaded zip files to the workers' PYTHONPATH.
+        zip_filename = f"{package_name}.zip"
+        print(f"Uploading {zip_filename} to cluster...")
+        client.upload_file(zip_filename)
+        print(f"Upload complete. Workers can now import {package_name}.")
+
+    if not warm_up:
+        return {}
+
     # ---------------------------------------------------------
-    # 3. Verify imports on all workers
+    # 3. Import and warm up on all workers, in parallel
     # ---------------------------------------------------------
-    def verify_import_task():
-        """
-        A small diagnostic task that runs on each worker independently.
-        It attempts to import the package and returns the file path it was 
-        loaded from, or an error message if the import fails.
-        """
-        import sys
-        import os
-        try:
-            import hww_tools
-            return f"SUCCESS: Imported hww_tools from {hww_tools.__file__}"
-        except ImportError as e:
-            # If it fails, list the current directory contents for debugging
-            return f"FAILURE: {e}. CWD contents: {os.listdir('.')}"
+    # One task pinned to each worker, so the imports happen in the worker's
+    # task threads (like the real tasks) without blocking its event loop.
+    # The processor is pickled here and loaded after the imports.
+    print("Warming up workers...")
+    start = time.perf_counter()
+    workers = list(client.nthreads())
+    payload = pickle.dumps(processor) if processor is not None else None
+    futures = [
+        client.submit(warm_up_worker, WORKER_MODULES, payload,
+                      workers=[worker], allow_other_workers=False, pure=False)
+        for worker in workers
+    ]
+    reports = dict(zip(workers, client.gather(futures)))
 
-    print("Verifying import on workers...")
-    
-    # client.run() executes the given function on EVERY connected worker
-    # and returns a dictionary mapping worker addresses to their results.
-    results = client.run(verify_import_task)
-    
-    # Print the diagnostic results from each worker
-    for worker, result in results.items():
-        print(f"  {worker}: {result}")
\ No newline at end of file
+    for worker, report in reports.items():
+        if report['error']:
+            print(f"  {worker}: FAILURE: {report['error']}")
+        else:
+            line = f"  {worker}: {report['seconds']:.2f}s (imports {report['imports']:.2f}s"
+            if report['processor'] is not None:
+                line += f", processor {report['processor']:.2f}s"
+            print(line + f") from {report['file']}")
+    print(f"Workers ready in {time.perf_counter() - start:.2f}s.")
+    return reports
+
+# ==============================================================================
+# READ-ONLY ARTIFACTS
+# ==============================================================================
+# A function that closes over a large object (e.g., the golden JSON dict of
+# make_processor) is pickled into every task that uses it. `broadcast` instead
+# stores the object once on every worker, under the hash of its content, and
+# returns a small `Artifact` handle: pickling the handle only sends its key,
+# and `Artifact.get()` returns the worker's local copy.
+
+ARTIFACT_PLUGIN_PREFIX = "hww_tools-artifact-"
+
+# Artifacts loaded in this process (worker, or the client itself), by key
+_ARTIFACTS = {}
+_MISSING = object()
+
+class Artifact:
+    """
+    Handle of a read-only object broadcast to the workers (see `broadcast`).
+
+    Parameters
+    ----------
+    key : str
+        SHA-256 of the pickled object.
+    name : str, optional
+        Name used in messages.
+    """
+
+    def __init__(self, key, name=None):
+        self.key = key
+        self.name = name or key[:12]
+
+    def get(self):
+        """Returns the object (the local copy of this process)."""
+        value = _ARTIFACTS.get(self.key, _MISSING)
+        if value is _MISSING:
+            raise LookupError(
+                f"Artifact '{self.name}' is not loaded in this process; broadcast it "
+                f"with the client of this cluster first"
+            )
+        return value
+
+    @property
+    def plugin_name(self):
+        return ARTIFACT_PLUGIN_PREFIX + self.key[:32]
+
+    def __repr__(self):
+        return f"<Artifact '{self.name}' {self.key[:12]}>"
+
+class _ArtifactPlugin(WorkerPlugin):
+    """Worker plugin storing one artifact in the worker (also on workers that join later)."""
+
+    def __init__(self, key, payload):
+        self.key = key
+        self.payload = payload
+
+    def setup(self, worker):
+        _ARTIFACTS[self.key] = pickle.loads(self.payload)
+
+    def teardown(self, worker):
+        _ARTIFACTS.pop(self.key, None)
+
+def broadcast(client, value, name=None):
+    """
+    Stores a read-only object once on every worker and returns its Artifact.
+
+    The object is keyed by the hash of its content: broadcasting the same
+    content again (e.g., after re-running the notebook cell) sends nothing,
+    because the scheduler already holds the plugin of that key. Workers that
+    join later receive it when they start. The object is also kept in the
+    calling process, so the handle works with the serial executor and with a
+    forked process pool.
+
+    Parameters
+    ----------
+    client : dask.distributed.Client or None
+        The active Dask client. None only registers the object locally.
+    value : object
+        Picklable, read-only object (do not modify it after broadcasting).
+    name : str, optional
+        Name used in messages.
+
+    Returns
+    -------
+    artifact : Artifact
+    """
+    payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    artifact = Artifact(hashlib.sha256(payload).hexdigest(), name)
+    _ARTIFACTS.setdefault(artifact.key, value)
+    if client is None:
+        return artifact
+
+    registered = client.run_on_scheduler(_registered_artifacts)
+    if artifact.plugin_name in registered:
+        print(f"Artifact '{artifact.name}' ({len(payload) / 1e3:.1f} kB) already on the workers.")
+    else:
+        client.register_plugin(_ArtifactPlugin(artifact.key, payload), name=artifact.plugin_name)
+        print(f"Broadcast artifact '{artifact.name}' ({len(payload) / 1e3:.1f} kB) to {len(client.nthreads())} workers.")
+    return artifact
+
+def release(client, artifact):
+    """Removes a broadcast artifact from the workers."""
+    client.unregister_worker_plugin(artifact.plugin_name)
+
+def resolve(value):
+    """The object behind `value` if it is an Artifact, else `value` itself."""
+    return value.get() if isinstance(value, Artifact) else value
+
+def _registered_artifacts(dask_scheduler=None):
+    return [name for name in dask_scheduler.worker_plugins if name.startswith(ARTIFACT_PLUGIN_PREFIX)]
+
+# ==============================================================================
+# PROCESSING TASK (see executors.DaskExecutor)
+# ==============================================================================
+
+# Task functions installed in this Dask worker by _InstallTaskPlugin, by hash
+TASK_PLUGIN_NAME = "hww_tools-task"
+_INSTALLED = {}
+
+class _InstallTaskPlugin(WorkerPlugin):
+    """Dask worker plugin installing the task function of DaskExecutor."""
+
+    def __init__(self, key, payload):
+        self.key = key
+        self.payload = payload
+
+    def setup(self, worker):
+        import cloudpickle
+
+        fn = cloudpickle.loads(self.payload)
+        _setup_task(fn)
+        _INSTALLED[self.key] = fn
+
+    def teardown(self, worker):
+        _INSTALLED.pop(self.key, None)
+
+def _run_installed(key, *args):
+    fn = _INSTALLED.get(key)
+    if fn is None:
+        raise RuntimeError("The task function is not installed on this worker (replaced by another run?)")
+    return _timed_call(fn, *args)
@@ -0,0 +1,90 @@
+"""
+dense_store.py
+
+This module defines the on-disk format of the dense histogram store, an
+additional output written next to `HWW_analysis_output.root`.
+
+The ROOT file holds thousands of separate histogram objects, so every consumer
+rebuilds them one by one. The dense store instead keeps, for every variable,
+two plain arrays of shape [sample, stage, variation, bin] (bin includes the
+underflow and overflow bins):
+- `<variable>.sumw.npy`:  sum of weights
+- `<variable>.sumw2.npy`: sum of squared weights
+- `<variable>.booked.npy`: [sample, stage, variation] flags of histograms that exist
+plus a `header.json` with the axis labels and the bin edges of every variable.
+
+The `.npy` files are opened with `numpy.load(mmap_mode='r')`, so reading the
+store is zero-copy: slicing a whole region or all samples at once only touches
+the pages that are used, without constructing any histogram objects.
+
+The in-memory counterpart is `histogram_store.HistogramStore`, whose `save` and
+`load` methods use the functions below.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+DENSE_STORE_NAME = "HWW_analysis_output_dense"
+HEADER_NAME = "header.json"
+ARRAY_KINDS = ("sumw", "sumw2", "booked")
+
+def write_dense_store(store_dir, samples, stages, variations, axes, arrays):
+    """
+    Writes a dense store.
+
+    Parameters
+    ----------
+    store_dir : str or pathlib.Path
+        Output directory, created if needed.
+    samples, stages, variations : list of str
+        Labels of the first three array axes.
+    axes : dict
+        Variable name -> hist axis (provides the bin edges and label).
+    arrays : dict
+        Variable name -> {'sumw': array, 'sumw2': array, 'booked': array}.
+
+    Returns
+    -------
+    pathlib.Path
+        The store directory.
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    for var, kinds in arrays.items():
+        for kind in ARRAY_KINDS:
+            np.save(store_dir / f"{var}.{kind}.npy", np.ascontiguousarray(kinds[kind]))
+
+    # The header is written last, so a store is only picked up once complete
+    header = {
+        'samples': list(samples),
+        'stages': list(stages),
+        'variations': list(variations),
+        'variables': {
+            var: {'edges': [float(e) for e in axis.edges], 'name': axis.name, 'label': axis.label}
+            for var, axis in axes.items()
+        },
+    }
+    with open(store_dir / HEADER_NAME, 'w') as f:
+        json.dump(header, f, indent=1)
+
+    return store_dir
+
+def read_dense_header(store_dir):
+    """Returns the header of a dense store, or None if there is no complete store."""
+    path = Path(store_dir) / HEADER_NAME
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def load_dense_array(store_dir, var, kind, mmap=True):
+    """
+    Opens one array of a dense store.
+
+    With `mmap=True` the array is memory-mapped read-only (zero-copy);
+    otherwise it is loaded into memory and can be modified.
+    """
+    return np.load(Path(store_dir) / f"{var}.{kind}.npy", mmap_mode='r' if mmap else None)
@@ -0,0 +1,603 @@
+"""
+executors.py
+
+This module provides the backends that `run_analysis.execute_analysis` uses to
+run the processing task over the files.
+
+Without it the analysis always needs a `dask.distributed` scheduler, even on a
+single large machine where a plain process pool does the same job with less
+startup and per-task overhead. All backends share one interface:
+- `DaskExecutor`: Submits to an existing Dask client (the cluster setup).
+- `ProcessPoolExecutor`: A local pool of worker processes
+  (`concurrent.futures`), no scheduler needed.
+- `SerialExecutor`: Runs every task in the notebook process, one after the
+  other. Useful for debugging (tracebacks, breakpoints, print statements).
+
+The pool and Dask backends send the task function to each worker only once
+(a `processor.Processor` also builds its heavy state there), so a task only
+carries its (label, file_url, file_idx) arguments.
+
+`Executor.imap_unordered` streams the results in completion order, keeps at
+most `max_in_flight` tasks submitted at a time and retries failed tasks.
+Completed futures are pushed onto a queue by a done-callback, so waiting for
+the next result does not scan all the pending futures.
+
+Bounding the tasks in flight also bounds the memory of the results waiting to
+be merged: a new task is only submitted when a result has been taken. With a
+`memory_limit`, submission additionally pauses while the resident memory of
+the notebook process is above the limit.
+
+Every task is timed on its worker. With `speculate`, a task running much longer
+than the median of its sample (e.g., stuck on a slow XRootD server) gets a
+second copy, and the first copy to finish is used.
+"""
+
+import collections
+import gc
+import hashlib
+import os
+import queue
+import sys
+import time
+import traceback
+import numpy as np
+import psutil
+import concurrent.futures as cf
+from concurrent.futures.process import BrokenProcessPool
+
+class Executor:
+    """
+    Common interface of the execution backends.
+
+    Parameters
+    ----------
+    retries : int, optional
+        Number of times a failed task is resubmitted before its error is
+        returned. Defaults to 1.
+    """
+
+    name = "executor"
+
+    def __init__(self, retries=1):
+        self.retries = retries
+
+    def submit(self, fn, *args):
+        """
+        Submits one task and returns a future (`result()`, `exception()`,
+        `add_done_callback()`) whose result is (task time in seconds, fn(*args)).
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the resources of the backend (worker processes, ...)."""
+
+    @property
+    def n_workers(self):
+        return 1
+
+    @property
+    def n_slots(self):
+        """Number of tasks the backend runs at the same time."""
+        return self.n_workers
+
+    def default_in_flight(self):
+        """
+        Default submission window: two tasks per slot, so every slot gets its
+        next task while the previous result is being merged.
+        """
+        return 2 * max(1, self.n_slots)
+
+    def imap_unordered(self, fn, tasks, max_in_flight=None, memory_limit=None,
+                       speculate=None, groups=None, stats=None, retries=None):
+        """
+        Runs `fn(*args)` for every argument tuple in `tasks`.
+
+        Parameters
+        ----------
+        fn : callable
+            The task function (e.g., the processor made by the notebook).
+        tasks : list of tuple
+            Positional arguments of each task, in submission order.
+        max_in_flight : int or 'auto', optional
+            Maximum number of tasks submitted at the same time. New tasks are
+            submitted as results come back. 'auto' uses `default_in_flight()`.
+            Defaults to None (submit all).
+        memory_limit : float, optional
+            Resident memory (bytes) of this process above which the window
+            shrinks to one task per slot (`n_slots`) until it goes back down,
+            so no results are queued beyond what the workers are running.
+            Defaults to None (off).
+        speculate : float, optional
+            Launch a second copy of a task running longer than this multiple of
+            the median task time of its group, and keep whichever copy finishes
+            first. Defaults to None (off).
+        groups : list, optional
+            Group of each task for the speculation medians (e.g., the sample
+            label). Defaults to None (one group).
+        stats : TaskStats, optional
+            Filled with the task times and speculation counts.
+        retries : int, optional
+            Overrides the `retries` of the backend for this call (e.g., 0 for
+            tasks with side effects that must not run twice). Defaults to None.
+
+        Yields
+        ------
+        index, outcome
+            Position of the task in `tasks` and its TaskOutcome, in completion
+            order. Failed tasks are yielded after their last retry.
+        """
+        tasks = list(tasks)
+        retries = self.retries if retries is None else retries
+        if max_in_flight == 'auto':
+            max_in_flight = self.default_in_flight()
+        window = len(tasks) if not max_in_flight else max(1, int(max_in_flight))
+        n_slots = max(1, self.n_slots)
+        throttle = MemoryThrottle(memory_limit) if memory_limit else None
+        # Tasks kept running while memory is above the limit (RSS seldom goes
+        # back down after a free, so pausing completely would run one task at a time)
+        floor = min(window, n_slots)
+        stats = stats if stats is not None else TaskStats()
+        groups = groups if groups is not None else [None] * len(tasks)
+
+        done = queue.SimpleQueue()
+        running = {}                  # future -> task index
+        copies = {}                   # task index -> its live futures
+        attempts = [0] * len(tasks)
+        next_task = 0
+
+        # The backends do not report when a task starts, so the start times are
+        # estimated: the first n_slots live futures run, the others wait in
+        # submission order and start when a running one completes.
+        started_at = {}
+        waiting = collections.deque()
+        # Losing copies that could not be cancelled keep their slot until they end
+        losers = set()
+        duplicates = set()
+        speculated = set()
+
+        def submit(index):
+            future = self.submit(fn, *tasks[index])
+            running[future] = index
+            copies.setdefault(index, []).append(future)
+            waiting.append(future)
+            start_waiting()
+            future.add_done_callback(done.put)
+            return future
+
+        def start_waiting():
+            now = time.monotonic()
+            while waiting and len(started_at) + len(losers) < n_slots:
+                future = waiting.popleft()
+                if future in running:
+                    started_at[future] = now
+
+        def forget(future):
+            running.pop(future, None)
+            started_at.pop(future, None)
+
+        def launch_speculative():
+            now = time.monotonic()
+            n_live = sum(1 for future in running if future in duplicates)
+            for future, start in list(started_at.items()):
+                index = running[future]
+                if n_live >= n_slots:
+                    break
+                if index in speculated:
+                    continue
+                reference = stats.median_duration(groups[index])
+                if reference is None or now - start <= speculate * reference:
+                    continue
+                duplicates.add(submit(index))
+                speculated.add(index)
+                stats.n_speculative += 1
+                n_live += 1
+
+        while next_task < min(window, len(tasks)):
+            submit(next_task)
+            next_task += 1
+
+        poll = 1.0 if speculate else None
+        last_check = time.monotonic()
+        while running:
+            try:
+                future = done.get(timeout=poll)
+            except queue.Empty:
+                future = None
+            if speculate and time.monotonic() - last_check >= poll:
+                launch_speculative()
+                last_check = time.monotonic()
+            if future in losers:
+                losers.discard(future)
+                start_waiting()
+            if future is None or future not in running:
+                # Nothing completed, or a copy of a task that already finished
+                continue
+
+            index = running[future]
+            forget(future)
+            live = copies[index]
+            live.remove(future)
+            start_waiting()
+
+            if _failed(future):
+                if live:
+                    # Another copy is still running and may succeed
+                    continue
+                if attempts[index] < retries:
+                    attempts[index] += 1
+                    submit(index)
+                    continue
+            else:
+                # The first successful copy wins; the others are dropped
+                for other in live:
+                    if not other.cancel() and other in started_at:
+                        losers.add(other)
+                    forget(other)
+                if future in duplicates:
+                    stats.n_speculative_won += 1
+            del copies[index]
+            duplicates.discard(future)
+
+            outcome = TaskOutcome(future)
+            stats.record(index, groups[index], outcome.duration)
+            yield index, outcome
+            del future, outcome
+
+            # Top up the window, unless memory is above the limit
+            if next_task < len(tasks) and (throttle is None or len(copies) < floor or not throttle.exceeded()):
+                submit(next_task)
+                next_task += 1
+            if throttle is not None:
+                # Fill the window again once memory went back down
+                while next_task < len(tasks) and len(copies) < window and not throttle.exceeded():
+                    submit(next_task)
+                    next_task += 1
+
+        if throttle is not None and throttle.n_paused:
+            print(f"  Submission paused {throttle.n_paused} times (memory above {memory_limit / 1e9:.1f} GB, "
+                  f"peak {throttle.peak / 1e9:.1f} GB).")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self.n_workers} workers>"
+
+# =========================================================
+# BACKENDS
+# =========================================================
+
+class DaskExecutor(Executor):
+    """
+    Runs the tasks on a Dask cluster through an existing client.
+
+    The task function is serialized once and installed in every worker by a
+    worker plugin (also on workers that join or restart later), which also
+    runs its `setup()` if it has one (processor.Processor). The tasks then
+    only send their arguments instead of the whole function every time.
+
+    Parameters
+    ----------
+    client : dask.distributed.Client
+        The active Dask client (see dask_utils.get_client).
+    retries : int, optional
+        Defaults to 1.
+    """
+
+    name = "Dask cluster"
+
+    def __init__(self, client, retries=1):
+        super().__init__(retries)
+        self.client = client
+        self._fn = None
+        self._key = None
+
+    def _install(self, fn):
+        import cloudpickle
+        from .dask_utils import TASK_PLUGIN_NAME, _InstallTaskPlugin
+
+        payload = cloudpickle.dumps(fn)
+        key = hashlib.sha256(payload).hexdigest()
+        # One plugin name: installing a new function replaces the previous one
+        self.client.register_plugin(_InstallTaskPlugin(key, payload), name=TASK_PLUGIN_NAME)
+        print(f"Processing task installed on the workers ({len(payload) / 1e3:.1f} kB, sent once per worker).")
+        self._fn = fn
+        self._key = key
+
+    def submit(self, fn, *args):
+        from .dask_utils import _run_installed
+
+        if fn is not self._fn:
+            self._install(fn)
+        # pure=False: a retried task must not reuse the key of the failed one
+        return self.client.submit(_run_installed, self._key, *args, pure=False)
+
+    @property
+    def n_workers(self):
+        return len(self.client.nthreads())
+
+    @property
+    def n_slots(self):
+        return sum(self.client.nthreads().values())
+
+class ProcessPoolExecutor(Executor):
+    """
+    Runs the tasks in a pool of local worker processes.
+
+    The task function is serialized once with cloudpickle (so closures defined
+    in the notebook work) and installed in every worker when the pool starts,
+    which also runs its `setup()` if it has one (processor.Processor); each
+    task then only sends its arguments. Every worker also gets its own
+    index (see `worker_slot`). The pool is started on the first submission and
+    kept alive, so later runs with the same function reuse the warm workers. If a worker dies (e.g., killed for using too much memory),
+    the pool is restarted and the lost tasks are retried.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        Number of worker processes. Defaults to the number of usable CPUs.
+    retries : int, optional
+        Defaults to 1.
+    mp_context : str, optional
+        Multiprocessing start method. Defaults to 'fork' on Linux (fastest
+        startup, the workers inherit the imported modules) and to the Python
+        default elsewhere.
+    """
+
+    name = "local process pool"
+
+    def __init__(self, n_workers=None, retries=1, mp_context=None):
+        super().__init__(retries)
+        self._n_workers = n_workers or _usable_cpus()
+        if mp_context is None and sys.platform.startswith("linux"):
+            mp_context = "fork"
+        self.mp_context = mp_context
+        self._pool = None
+        self._fn = None
+
+    @property
+    def n_workers(self):
+        return self._n_workers
+
+    def _start(self, fn):
+        import cloudpickle
+        import multiprocessing
+
+        self.close()
+        context = multiprocessing.get_context(self.mp_context)
+        self._pool = cf.ProcessPoolExecutor(
+            max_workers=self._n_workers, mp_context=context,
+            initializer=_install_task, initargs=(cloudpickle.dumps(fn), context.Value('i', 0))
+        )
+        self._fn = fn
+
+    def submit(self, fn, *args):
+        if self._pool is None or fn is not self._fn:
+            self._start(fn)
+        try:
+            return self._pool.submit(_run_task, *args)
+        except BrokenProcessPool:
+            print("  WARNING: A worker process died, restarting the process pool.")
+            self._start(fn)
+            return self._pool.submit(_run_task, *args)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        self._pool = None
+        self._fn = None
+
+class SerialExecutor(Executor):
+    """
+    Runs every task immediately in the calling process.
+
+    Exceptions are stored in the returned future like in the other backends,
+    and their traceback is printed (set `raise_errors=True` to stop at the
+    first failure instead, e.g. to inspect it with a debugger).
+
+    Parameters
+    ----------
+    retries : int, optional
+        Defaults to 0.
+    raise_errors : bool, optional
+        Defaults to False.
+    """
+
+    name = "serial executor"
+
+    def __init__(self, retries=0, raise_errors=False):
+        super().__init__(retries)
+        self.raise_errors = raise_errors
+
+    def submit(self, fn, *args):
+        future = cf.Future()
+        try:
+            future.set_result(_timed_call(fn, *args))
+        except Exception as e:
+            if self.raise_errors:
+                raise
+            traceback.print_exc()
+            future.set_exception(e)
+        return future
+
+    def default_in_flight(self):
+        return 1
+
+    def imap_unordered(self, fn, tasks, max_in_flight=None, memory_limit=None,
+                       speculate=None, groups=None, stats=None, retries=None):
+        # One task at a time, so each result is merged before the next one runs
+        # (nothing runs concurrently, so there is nothing to speculate on)
+        return super().imap_unordered(fn, tasks, max_in_flight=1, groups=groups, stats=stats)
+
+# =========================================================
+# HELPERS
+# =========================================================
+
+def as_executor(backend, **kwargs):
+    """
+    Returns the Executor for `backend`.
+
+    Parameters
+    ----------
+    backend : Executor, dask.distributed.Client or str
+        An Executor is returned unchanged and a Dask client is wrapped in a
+        DaskExecutor. The strings 'processes' and 'serial' create a
+        ProcessPoolExecutor or a SerialExecutor with `kwargs`.
+
+    Returns
+    -------
+    executor : Executor
+    """
+    if isinstance(backend, Executor):
+        return backend
+    if isinstance(backend, str):
+        if backend == "processes":
+            return ProcessPoolExecutor(**kwargs)
+        if backend == "serial":
+            return SerialExecutor(**kwargs)
+        raise ValueError(f"Unknown executor '{backend}' (expected 'processes' or 'serial')")
+    if hasattr(backend, "submit") and hasattr(backend, "scheduler_info"):
+        return DaskExecutor(backend, **kwargs)
+    raise TypeError(f"Cannot run the analysis on {type(backend).__name__}")
+
+class TaskOutcome:
+    """
+    A completed task yielded by `Executor.imap_unordered`.
+
+    `result()` returns the task's return value or raises its exception, and
+    `duration` is the time the task took on its worker (None if it failed).
+    """
+
+    __slots__ = ("future", "duration")
+
+    def __init__(self, future):
+        self.future = future
+        self.duration = None if _failed(future) else future.result()[0]
+
+    def result(self):
+        return self.future.result()[1]
+
+    def exception(self):
+        return self.future.exception()
+
+class TaskStats:
+    """
+    Task times collected by `Executor.imap_unordered`, for the speculation
+    medians and the final report.
+    """
+
+    # Completed tasks needed before a median is used
+    MIN_TASKS = 5
+
+    def __init__(self):
+        self.durations = {}
+        self._by_group = {}
+        self.n_speculative = 0
+        self.n_speculative_won = 0
+
+    def record(self, index, group, duration):
+        if duration is None:
+            return
+        self.durations[index] = duration
+        self._by_group.setdefault(group, []).append(duration)
+
+    def median_duration(self, group=None):
+        """Median task time of `group` (of all tasks if the group has too few), or None."""
+        times = self._by_group.get(group, [])
+        if len(times) < self.MIN_TASKS:
+            times = list(self.durations.values())
+        if len(times) < self.MIN_TASKS:
+            return None
+        return float(np.median(times))
+
+    def percentiles(self):
+        """(p50, p95, max) of the task times in seconds, or None without tasks."""
+        if not self.durations:
+            return None
+        times = np.fromiter(self.durations.values(), dtype=float)
+        p50, p95 = np.percentile(times, [50, 95])
+        return float(p50), float(p95), float(times.max())
+
+class MemoryThrottle:
+    """
+    Tells whether the resident memory (RSS) of this process is above `limit`.
+
+    When the limit is first exceeded, a garbage collection is run (merged
+    results are often only waiting to be collected) before pausing.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.process = psutil.Process()
+        self.paused = False
+        self.n_paused = 0
+        self.peak = 0
+
+    def exceeded(self):
+        rss = self.process.memory_info().rss
+        self.peak = max(self.peak, rss)
+        if rss > self.limit and not self.paused:
+            gc.collect()
+            rss = self.process.memory_info().rss
+            if rss > self.limit:
+                self.n_paused += 1
+        self.paused = rss > self.limit
+        return self.paused
+
+def worker_slot():
+    """
+    Index of the current worker process in its ProcessPoolExecutor, from 0 to
+    n_workers - 1 (a restarted pool hands out the same indices again).
+    Returns 0 outside of a pool (serial execution).
+    """
+    return _WORKER_SLOT
+
+def _usable_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def _failed(future):
+    try:
+        return future.exception() is not None
+    except Exception:
+        # Cancelled futures raise instead of returning their exception
+        return True
+
+# Task function and index of a worker process, set once by the pool initializer
+_TASK = None
+_WORKER_SLOT = 0
+
+def _install_task(payload, counter):
+    import cloudpickle
+
+    global _TASK, _WORKER_SLOT
+    with counter.get_lock():
+        _WORKER_SLOT = counter.value
+        counter.value += 1
+    _TASK = cloudpickle.loads(payload)
+    _setup_task(_TASK)
+
+def _setup_task(fn):
+    """
+    Builds the once-per-worker state of a task that has one (e.g.,
+    processor.Processor.setup). A failure is left to the first task, which
+    then returns it as its error.
+    """
+    setup = getattr(fn, "setup", None)
+    if callable(setup):
+        try:
+            setup()
+        except Exception as e:
+            print(f"  WARNING: Worker setup failed: {type(e).__name__}: {e}")
+
+def _run_task(*args):
+    return _timed_call(_TASK, *args)
+
+def _timed_call(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
@@ -5,7 +5,7 @@ This module contains utility functions for data loading and handling.
 It includes:
 - Parsing text files for XRootD URLs
 - Loading event arrays from ROOT files using Uproot
-- Scale factor application with uncertainty
+- Scale factor application with uncertainty (also precompiled, `SFLookup`)
 - Histogram data extraction helper
 """
 
@@ -16,6 +16,9 @@ import awkward as ak
 import numpy as np
 import hist
 
+from .weights import Weights
+from .histogram_store import HistogramStore, bin_indices
+
 SAMPLE_MAPPING = {
     'data': 'Data',
     'higgs': 'ggH_HWW',
@@ -144,16 +147,203 @@ def load_events(file_url, batch_size= 1_000_000, timeout=600, max_retries=3, ret
             print(f"     Unexpected error on {file_name}: {str(e)[:100]}")
             raise
 
-def initialize_stage_histograms(stages_list, vars_dict, variations_list):
+def initialize_stage_histograms(stages_list, vars_dict, variations_list, booking=None):
+    """
+    Allocates the nested {stage: {variable: {variation: Hist}}} dictionary.
+    If a `booking.HistogramBooking` is given, only the booked histograms are 
+    created; stages and variables without any booked histogram are left out.
+    """
     stage_histograms = {}
     for stage in stages_list:
         stage_histograms[stage] = {}
         for var_name, axis in vars_dict.items():
             stage_histograms[stage][var_name] = {}
             for syst in variations_list:
+                if booking is not None and not booking.is_booked(stage, var_name, syst):
+                    continue
                 stage_histograms[stage][var_name][syst] = hist.Hist(axis, storage=hist.storage.Weight())
+            if not stage_histograms[stage][var_name]:
+                del stage_histograms[stage][var_name]
+        if not stage_histograms[stage]:
+            del stage_histograms[stage]
     return stage_histograms
 
+def booked_histograms(stage_histograms, stage_name):
+    """
+    Returns the {variable: [variations]} histograms of `stage_name` to fill, 
+    from a nested dictionary or a one-sample HistogramStore (empty if the 
+    stage has none).
+    """
+    if isinstance(stage_histograms, HistogramStore):
+        if stage_name not in stage_histograms.stages:
+            return {}
+        j = stage_histograms.index('stage', stage_name)
+        booked = {}
+        for var_name, flags in stage_histograms.booked.items():
+            systs = [syst for syst, flag in zip(stage_histograms.variations, flags[0, j]) if flag]
+            if systs:
+                booked[var_name] = systs
+        return booked
+    return {var_name: list(syst_dict) for var_name, syst_dict in stage_histograms.get(stage_name, {}).items()}
+
+def _histogram_axis(stage_histograms, stage_name, var_name):
+    if isinstance(stage_histograms, HistogramStore):
+        return stage_histograms.axes[var_name]
+    return next(iter(stage_histograms[stage_name][var_name].values())).axes[0]
+
+def _add_binned(stage_histograms, stage_name, var_name, syst, sumw, sumw2):
+    """Adds binned sums of weights (flow bins included) to one histogram."""
+    if isinstance(stage_histograms, HistogramStore):
+        j = stage_histograms.index('stage', stage_name)
+        k = stage_histograms.index('variation', syst)
+        stage_histograms.sumw[var_name][0, j, k] += sumw
+        stage_histograms.sumw2[var_name][0, j, k] += sumw2
+    else:
+        view = stage_histograms[stage_name][var_name][syst].view(flow=True)
+        view.value += sumw
+        view.variance += sumw2
+
+def fill_stage_histograms(stage_histograms, stage_name, mask, weights_dict, observables):
+    """
+    Fills the histograms of one stage for the events selected by `mask`.
+    
+    Only histograms present in `stage_histograms` are filled, so a dictionary 
+    created with a booking skips everything that was not requested, including 
+    the slicing of the unused arrays.
+
+    Parameters
+    ----------
+    stage_histograms : dict or histogram_store.HistogramStore
+        Nested histogram dictionary from initialize_stage_histograms, or a
+        store with one sample (filled with np.bincount, only where booked).
+    stage_name : str
+        The stage to fill.
+    mask : array of bool
+        Event selection for this stage.
+    weights_dict : dict
+        Variation name -> per-event weights. Missing variations use 'nominal'.
+    observables : dict
+        Variable name -> per-event values.
+    """
+    vars_dict = booked_histograms(stage_histograms, stage_name)
+    if not vars_dict:
+        return
+
+    mask = ak.to_numpy(mask) if not isinstance(mask, np.ndarray) else mask
+    if not np.any(mask):
+        return
+
+    # A weights.Weights container slices all the needed variations in one call
+    masked_weights = {}
+    if isinstance(weights_dict, Weights):
+        needed = {syst for systs in vars_dict.values() for syst in systs}
+        selected = weights_dict.select(mask, needed)
+        masked_weights = {syst: selected.get(syst, selected['nominal']) for syst in needed}
+
+    in_store = isinstance(stage_histograms, HistogramStore)
+    for var_name, systs in vars_dict.items():
+        values = ak.to_numpy(observables[var_name][mask])
+        if in_store:
+            axis = stage_histograms.axes[var_name]
+            bins = bin_indices(np.asarray(values, dtype=np.float64), axis)
+        for syst in systs:
+            if syst not in masked_weights:
+                w_syst = weights_dict.get(syst, weights_dict['nominal'])
+                masked_weights[syst] = ak.to_numpy(w_syst[mask])
+            w = masked_weights[syst]
+            if in_store:
+                w = np.asarray(w, dtype=np.float64)
+                _add_binned(stage_histograms, stage_name, var_name, syst,
+                            np.bincount(bins, weights=w, minlength=len(axis) + 2),
+                            np.bincount(bins, weights=w * w, minlength=len(axis) + 2))
+            else:
+                stage_histograms[stage_name][var_name][syst].fill(values, weight=w)
+
+def fill_histograms_from_bitmask(stage_histograms, bits, weights_dict, observables, stage_names=None):
+    """
+    Fills the histograms of all stages at once from a stage bitmask.
+
+    Instead of one fill per stage, the bitmask is expanded into one
+    (event, stage) pair per stage passed by each event, and every variable is
+    binned once. The combined index `stage * n_bins + bin` then fills all stages
+    with one np.bincount per variation, so extra stages cost only their
+    selected events. The result is identical to calling fill_stage_histograms
+    for every stage with the decoded masks.
+
+    Parameters
+    ----------
+    stage_histograms : dict or histogram_store.HistogramStore
+        Nested histogram dictionary from initialize_stage_histograms, or a
+        store with one sample.
+    bits : numpy.ndarray (uint32)
+        Stage bitmask from cuts.stage_bitmask or cuts.region_bitmask.
+    weights_dict : dict
+        Variation name -> per-event weights. Missing variations use 'nominal'.
+    observables : dict
+        Variable name -> per-event values.
+    stage_names : list of str, optional
+        Bit order. Defaults to Config.stage_names.
+    """
+    from .cuts import unpack_stage_bits
+
+    if stage_names is None:
+        from .Config import stage_names
+    layout = {stage: booked_histograms(stage_histograms, stage) for stage in stage_names}
+    stages = [stage for stage in stage_names if layout[stage]]
+    if not stages or len(bits) == 0:
+        return
+
+    matrix = unpack_stage_bits(bits, len(stage_names))[:, [stage_names.index(stage) for stage in stages]]
+    # Pairs ordered by stage, so the events of each stage are one contiguous slice
+    categories, events = np.nonzero(np.ascontiguousarray(matrix.T))
+    if len(events) == 0:
+        return
+    bounds = np.searchsorted(categories, np.arange(len(stages) + 1))
+
+    # A weights.Weights container gathers the pair weights of all the needed variations at once
+    gathered = isinstance(weights_dict, Weights)
+    if gathered:
+        needed = {syst for stage in stages for systs in layout[stage].values() for syst in systs}
+        weights_dict = weights_dict.select(events, needed)
+
+    pair_weights = {}
+    for var_name in dict.fromkeys(var for stage in stages for var in layout[stage]):
+        var_stages = [c for c, stage in enumerate(stages) if var_name in layout[stage]]
+        axis = _histogram_axis(stage_histograms, stages[var_stages[0]], var_name)
+        n_bins = len(axis) + 2
+        bins = bin_indices(np.asarray(ak.to_numpy(observables[var_name]), dtype=np.float64), axis)
+        flat = categories * n_bins + bins[events]
+
+        systs = dict.fromkeys(syst for c in var_stages for syst in layout[stages[c]][var_name])
+        for syst in systs:
+            if syst not in pair_weights:
+                w_syst = weights_dict.get(syst, weights_dict['nominal'])
+                w = np.asarray(ak.to_numpy(w_syst), dtype=np.float64)
+                if not gathered:
+                    w = w[events]
+                pair_weights[syst] = (w, w * w)
+            w, w2 = pair_weights[syst]
+
+            syst_stages = [c for c in var_stages if syst in layout[stages[c]][var_name]]
+            # One bincount over each run of consecutive stages (slices, no copies)
+            for run in _consecutive_runs(syst_stages):
+                lo, hi = bounds[run[0]], bounds[run[-1] + 1]
+                size = (run[-1] + 1) * n_bins
+                sumw = np.bincount(flat[lo:hi], weights=w[lo:hi], minlength=size).reshape(-1, n_bins)
+                sumw2 = np.bincount(flat[lo:hi], weights=w2[lo:hi], minlength=size).reshape(-1, n_bins)
+                for c in run:
+                    _add_binned(stage_histograms, stages[c], var_name, syst, sumw[c], sumw2[c])
+
+def _consecutive_runs(indices):
+    """Splits sorted integers into runs of consecutive values: [0, 1, 3] -> [[0, 1], [3]]."""
+    runs = []
+    for i in indices:
+        if runs and runs[-1][-1] == i - 1:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+    return runs
+
 def get_sf_with_uncertainty(eta_array, pt_array, lookup_table):
     sf_out = ak.ones_like(eta_array, dtype=float)
     err_out = ak.zeros_like(eta_array, dtype=float)
@@ -169,7 +359,57 @@ def get_sf_with_uncertainty(eta_array, pt_array, lookup_table):
         
     return sf_out, err_out
 
+class SFLookup:
+    """
+    Scale factor table compiled into a 2D grid of (|eta|, pT) cells.
+
+    `get_sf_with_uncertainty` loops over all rows of the table with two
+    `ak.where` per row for every chunk. Here the table is converted once:
+    the edges are all the eta and pT boundaries of the rows, and every cell
+    takes the value of the last row containing it (like the loop). A lookup
+    is then two np.searchsorted calls and one gather. Events outside every
+    row get 1 +- 0, as before.
+
+    Parameters
+    ----------
+    lookup_table : list of tuple
+        Rows (eta_min, eta_max, pt_min, pt_max, sf, err) of Efficiency_data.
+    """
+
+    def __init__(self, lookup_table):
+        rows = np.asarray(lookup_table, dtype=np.float64).reshape(-1, 6)
+        self.eta_edges = np.unique(rows[:, :2])
+        self.pt_edges = np.unique(rows[:, 2:4])
+        shape = (max(len(self.eta_edges) - 1, 0), max(len(self.pt_edges) - 1, 0))
+        self.sf = np.ones(shape)
+        self.err = np.zeros(shape)
+
+        # Cell (i, j) covers [eta_edges[i], eta_edges[i+1]) x [pt_edges[j], pt_edges[j+1])
+        for eta_min, eta_max, pt_min, pt_max, sf_val, err_val in rows:
+            i0, i1 = np.searchsorted(self.eta_edges, [eta_min, eta_max])
+            j0, j1 = np.searchsorted(self.pt_edges, [pt_min, pt_max])
+            self.sf[i0:i1, j0:j1] = sf_val
+            self.err[i0:i1, j0:j1] = err_val
+
+    def __call__(self, eta_array, pt_array):
+        """Returns the (scale factor, uncertainty) NumPy arrays of the given leptons."""
+        eta_abs = np.abs(np.asarray(ak.to_numpy(eta_array), dtype=np.float64))
+        pt = np.asarray(ak.to_numpy(pt_array), dtype=np.float64)
+        i = np.searchsorted(self.eta_edges, eta_abs, side='right') - 1
+        j = np.searchsorted(self.pt_edges, pt, side='right') - 1
+        inside = (i >= 0) & (i < self.sf.shape[0]) & (j >= 0) & (j < self.sf.shape[1])
+
+        sf_out = np.ones(len(pt))
+        err_out = np.zeros(len(pt))
+        sf_out[inside] = self.sf[i[inside], j[inside]]
+        err_out[inside] = self.err[i[inside], j[inside]]
+        return sf_out, err_out
+
 def get_histogram_data(hist_data, sample, stage, variable, variation='nominal'):
+    # A HistogramStore (also a loaded dense store) slices the values straight from its arrays
+    if isinstance(hist_data, HistogramStore):
+        return hist_data.get(sample, stage, variable, variation)
+
     if sample not in hist_data: return None, None, None
     if stage not in hist_data[sample]: return None, None, None
     if variable not in hist_data[sample][stage]: return None, None, None
@@ -212,13 +452,12 @@ def merge_dask_results(results, arg_urls, files_dict, stage_names, cutflow_stage
     Handles initialization of empty histograms and cutflows.
     """
     # 1. Initialize final storage
-    hist_final = {}
+    hist_store = HistogramStore(files_dict.keys(), stage_names, vars_dict, variations)
     cutflow_final = {}
     weighted_cutflow_final = {}
     
     # Create structure for all samples (even those not processed yet)
     for label in files_dict.keys():
-        hist_final[label] = initialize_stage_histograms(stage_names, vars_dict, variations)
         cutflow_final[label] = {stage: 0 for stage in cutflow_stages}
         weighted_cutflow_final[label] = {stage: 0.0 for stage in cutflow_stages}
 
@@ -229,7 +468,7 @@ def merge_dask_results(results, arg_urls, files_dict, stage_names, cutflow_stage
         if not result: continue # Skip empty/failed results that return None
         
         # Unpack result tuple from processor
-        label, stage_histograms, cutflow, weighted_cutflow, error = result
+        label, stage_histograms, cutflow, weighted_cutflow, error = result[:5]
         
         # Handle Errors
         if error:
@@ -240,55 +479,50 @@ def merge_dask_results(results, arg_urls, files_dict, stage_names, cutflow_stage
             print(f"    Reason: {error}")
             continue
 
-        # A. Merge Cutflows
+        # A. Merge Cutflows (including the sums of squared weights and
+        #    per-cut entries, see cutflow_utils.py)
         if cutflow:
             for stage, count in cutflow.items():
-                if stage in cutflow_final[label]:
-                    cutflow_final[label][stage] += count
+                cutflow_final[label][stage] = cutflow_final[label].get(stage, 0) + count
         
         if weighted_cutflow:
             for stage, count in weighted_cutflow.items():
-                if stage in weighted_cutflow_final[label]:
-                    weighted_cutflow_final[label][stage] += count
+                weighted_cutflow_final[label][stage] = weighted_cutflow_final[label].get(stage, 0.0) + count
         
-        # B. Merge Histograms
-        if stage_histograms:
-            for stage, vars_dict_res in stage_histograms.items():
-                for var, systs in vars_dict_res.items():
-                    for syst, hist_obj in systs.items():
-                        # Efficiently add histogram objects
-                        hist_final[label][stage][var][syst] += hist_obj
+        # B. Merge Histograms into the dense store (processor.Processor
+        #    already returns a one-sample store)
+        if isinstance(stage_histograms, HistogramStore):
+            hist_store += stage_histograms
+        elif stage_histograms:
+            hist_store.add(label, stage_histograms)
                         
-    return hist_final, cutflow_final, weighted_cutflow_final, error_count
+    return hist_store.to_dict(), cutflow_final, weighted_cutflow_final, error_count
 
-def save_root_file(hist_data, output_path):
+def save_root_file(hist_data, output_path, layout="hierarchical", compression="ZSTD",
+                   level=5, split_samples=False):
     """
     Saves the nested dictionary of histograms to a ROOT file using Uproot.
-    Structure: Sample_Stage_Variable_Variation
+    Structure: Sample/Stage/Variable/Variation (or Sample_Stage_Variable_Variation 
+    with layout="flat"). See root_io.write_histograms for the options.
     """
-    import uproot
+    from .root_io import write_histograms
     print(f"\nSaving histograms to ROOT file: {output_path.name}...")
+    start = time.perf_counter()
     try:
-        with uproot.recreate(output_path) as root_file:
-            for sample, stages in hist_data.items():
-                for stage, variables in stages.items():
-                    for var_name, variations in variables.items():
-                        for syst_name, hist_obj in variations.items():
-                            
-                            # Create distinct name
-                            hist_name = f"{sample}_{stage}_{var_name}_{syst_name}"
-                            hist_name = hist_name.replace(" ", "_").replace("-", "_")
-                            
-                            # Write to file
-                            root_file[hist_name] = hist_obj
-                            
-        print("  Success! ROOT file saved.")
+        paths = write_histograms(hist_data, output_path, layout=layout, compression=compression,
+                                 level=level, split_samples=split_samples)
     except Exception as e:
         print(f"  Error saving ROOT file: {e}")
+        raise
+
+    size_mb = sum(os.path.getsize(path) for path in paths) / 1e6
+    print(f"  Success! ROOT file saved ({len(paths)} file(s), {size_mb:.1f} MB, "
+          f"{time.perf_counter() - start:.1f}s).")
 
 # Append to Run_analysis/hww_tools/helper.py
 
-def restore_histograms(sample_list, stage_names, vars_dict, variations, root_file_path):
+def restore_histograms(sample_list, stage_names, vars_dict, variations, root_file_path, booking=None,
+                       lazy=False, cache_size=512):
     """
     Reconstructs the full nested dictionary of histograms from a saved ROOT file.
     
@@ -304,6 +538,15 @@ def restore_histograms(sample_list, stage_names, vars_dict, variations, root_fil
         List of systematic variations (e.g., Config.VARIATIONS).
     root_file_path : str or Path
         Path to the .root file.
+    booking : booking.HistogramBooking, optional
+        If given, only the booked histograms are restored.
+    lazy : bool, optional
+        If True, return a root_io.LazyHistograms mapping with the same nested 
+        interface that only reads each histogram on first access (the stage, 
+        variable, variation and booking arguments are then not needed, the 
+        file's own keys are used). Defaults to False.
+    cache_size : int, optional
+        Size of the LRU cache of deserialised histograms when lazy. Defaults to 512.
 
     Returns
     -------
@@ -313,34 +556,47 @@ def restore_histograms(sample_list, stage_names, vars_dict, variations, root_fil
     import uproot
     from pathlib import Path
     
+    from .root_io import find_histogram_key, resolve_sample_files
+
     path = Path(root_file_path)
-    if not path.exists():
+    # Outputs written with split_samples=True have one file per sample
+    sample_files = resolve_sample_files(path) or {}
+    if not path.exists() and not sample_files:
         print(f"CRITICAL: ROOT file not found at {path}")
         return {}
 
+    if lazy:
+        from .root_io import LazyHistograms
+        return LazyHistograms(path, samples=sample_list, cache_size=cache_size)
+
     print(f"Restoring histograms from: {path.name}")
     
     hist_data = {}
     
-    # Open file once
-    with uproot.open(path) as file:
-        # Loop through known structure to find matching keys
-        for sample in sample_list:
-            # 1. Initialize empty structure for this sample
-            hist_data[sample] = initialize_stage_histograms(stage_names, vars_dict, variations)
-            
-            # 2. Fill with data from ROOT file
-            for stage in stage_names:
-                for var in vars_dict.keys():
-                    for syst in variations:
-                        # Reconstruct the key name used during saving
-                        # Format: Sample_Stage_Variable_Variation
-                        hist_name = f"{sample}_{stage}_{var}_{syst}"
-                        hist_name = hist_name.replace(" ", "_").replace("-", "_")
+    for sample in sample_list:
+        # 1. Initialize empty structure for this sample
+        hist_data[sample] = initialize_stage_histograms(stage_names, vars_dict, variations, booking=booking)
+        
+        sample_path = sample_files.get(sample, path)
+        if not Path(sample_path).exists():
+            continue
+
+        # 2. Fill with data from ROOT file
+        with uproot.open(sample_path) as file:
+            for stage, vars_booked in hist_data[sample].items():
+                for var, systs_booked in vars_booked.items():
+                    for syst in systs_booked:
+                        # Find the key in either the hierarchical 
+                        # (Sample/Stage/Variable/Variation) or flat layout
+                        hist_name = find_histogram_key(file, sample, stage, var, syst)
                         
-                        if hist_name in file:
-                            # .to_hist() converts Uproot object back to boost_histogram
-                            hist_data[sample][stage][var][syst] = file[hist_name].to_hist()
+                        if hist_name is not None:
+                            # .to_hist() converts Uproot object back to boost_histogram.
+                            # Copy the contents (including flow bins) into the freshly 
+                            # booked histogram so it keeps the configured axis metadata 
+                            # and can be added to newly processed histograms.
+                            stored = file[hist_name].to_hist()
+                            hist_data[sample][stage][var][syst].view(flow=True)[...] = stored.view(flow=True)
                             
     print(f"Successfully restored data for {len(hist_data)} samples.")
     return hist_data
\ No newline at end of file
@@ -0,0 +1,365 @@
+"""
+histogram_store.py
+
+This module provides `HistogramStore`, a dense container for all the
+histograms of the analysis.
+
+Results used to be passed around as {sample: {stage: {var: {syst: Hist}}}}
+dictionaries, which every consumer walks with nested loops and membership
+checks. A `HistogramStore` instead keeps, for every variable, two NumPy arrays
+of shape [sample, stage, variation, bin] (sum of weights and sum of squared
+weights, flow bins included) plus a boolean array telling which histograms
+are booked. Names are mapped to integer indices once, so:
+- Looking up one histogram is a dictionary lookup and an array index.
+- Merging two stores (`+=`) is one array addition per variable. The
+  processor fills a one-sample store per file, so merging a processing result
+  is one addition per variable too.
+- Whole regions, sample lists or all variations can be sliced at once.
+
+`from_dict`/`to_dict` and `from_root`/`to_root` convert to and from the nested
+dictionary and the ROOT output, and `save`/`load` use the memory-mappable
+dense store format (see dense_store.py).
+"""
+
+import numpy as np
+import hist
+
+from . import dense_store
+
+AXIS_NAMES = ("sample", "stage", "variation")
+
+def bin_indices(values, axis):
+    """
+    Bin index of each value including flow (0 is underflow, len(axis) + 1 is 
+    overflow), following the boost-histogram conventions. Regular axes use 
+    direct arithmetic instead of a binary search.
+    """
+    if isinstance(axis, hist.axis.Regular) and not axis.traits.circular and axis.transform is None:
+        lo, hi = axis.edges[0], axis.edges[-1]
+        scaled = np.clip(np.floor((values - lo) / (hi - lo) * len(axis)), -1, len(axis))
+        # NaN goes to overflow, like in boost-histogram
+        scaled[np.isnan(scaled)] = len(axis)
+        return scaled.astype(np.int64) + 1
+    return np.digitize(values, axis.edges)
+
+class HistogramStore:
+    """
+    Dense [sample, stage, variation, bin] storage of Weight histograms.
+
+    Parameters
+    ----------
+    samples : list of str
+        Sample labels.
+    stages : list of str
+        Stage names (e.g., Config.stage_names).
+    axes : dict
+        Variable name -> hist axis (e.g., Plots_config.variables_to_plots).
+    variations : list of str
+        Systematic variations (e.g., Config.VARIATIONS).
+    booking : booking.HistogramBooking, optional
+        If given, only the booked (stage, variable, variation) combinations are
+        marked as present. Defaults to None (every combination).
+    """
+
+    __slots__ = ("samples", "stages", "variations", "axes", "sumw", "sumw2", "booked", "_index")
+
+    def __init__(self, samples, stages, axes, variations, booking=None):
+        self.samples = list(samples)
+        self.stages = list(stages)
+        self.variations = list(variations)
+        self.axes = dict(axes)
+        self._build_index()
+
+        self.sumw = {}
+        self.sumw2 = {}
+        self.booked = {}
+        for var, axis in self.axes.items():
+            shape = (len(self.samples), len(self.stages), len(self.variations), len(axis) + 2)
+            self.sumw[var] = np.zeros(shape)
+            self.sumw2[var] = np.zeros(shape)
+            booked = np.ones(shape[:3], dtype=bool)
+            if booking is not None:
+                for j, stage in enumerate(self.stages):
+                    for k, syst in enumerate(self.variations):
+                        booked[:, j, k] = booking.is_booked(stage, var, syst)
+            self.booked[var] = booked
+
+    def _build_index(self):
+        self._index = {
+            'sample': {name: i for i, name in enumerate(self.samples)},
+            'stage': {name: i for i, name in enumerate(self.stages)},
+            'variation': {name: i for i, name in enumerate(self.variations)},
+        }
+
+    # ---------------------------------------------------------
+    # Conversions
+    # ---------------------------------------------------------
+    @classmethod
+    def from_dict(cls, hist_data, stages=None, variations=None):
+        """
+        Builds a store from a nested {sample: {stage: {var: {syst: Hist}}}} dictionary.
+        Only the histograms present in the dictionary are marked as booked.
+        """
+        from . import Config
+
+        axes = {}
+        for stages_dict in hist_data.values():
+            for vars_dict in stages_dict.values():
+                for var, systs in vars_dict.items():
+                    if var not in axes and systs:
+                        axes[var] = next(iter(systs.values())).axes[0]
+
+        store = cls(list(hist_data), stages if stages is not None else Config.stage_names,
+                    axes, variations if variations is not None else Config.VARIATIONS)
+        for var in store.booked:
+            store.booked[var][...] = False
+        for sample, stage_histograms in hist_data.items():
+            store.add(sample, stage_histograms)
+        return store
+
+    def to_dict(self):
+        """Returns the nested {sample: {stage: {var: {syst: Hist}}}} dictionary of the booked histograms."""
+        hist_data = {}
+        for sample in self.samples:
+            stages_dict = {}
+            for stage in self.stages:
+                vars_dict = {}
+                for var in self.axes:
+                    systs = {
+                        syst: self.to_hist(sample, stage, var, syst)
+                        for syst in self.variations if self.is_booked(sample, stage, var, syst)
+                    }
+                    if systs:
+                        vars_dict[var] = systs
+                if vars_dict:
+                    stages_dict[stage] = vars_dict
+            hist_data[sample] = stages_dict
+        return hist_data
+
+    @classmethod
+    def from_root(cls, root_file_path, samples, stages=None, axes=None, variations=None, booking=None):
+        """Reads a saved ROOT output (any layout, single or per-sample files) into a store."""
+        from . import Config, Plots_config
+        from .helper import restore_histograms
+
+        stages = stages if stages is not None else Config.stage_names
+        axes = axes if axes is not None else Plots_config.variables_to_plots
+        variations = variations if variations is not None else Config.VARIATIONS
+        hist_data = restore_histograms(samples, stages, axes, variations, root_file_path, booking=booking)
+        return cls.from_dict(hist_data, stages, variations)
+
+    def to_root(self, output_path, **options):
+        """Writes the booked histograms to ROOT. See helper.save_root_file for the options."""
+        from .helper import save_root_file
+        save_root_file(self.to_dict(), output_path, **options)
+
+    def save(self, store_dir):
+        """Writes the store in the memory-mappable dense format."""
+        arrays = {
+            var: {'sumw': self.sumw[var], 'sumw2': self.sumw2[var], 'booked': self.booked[var]}
+            for var in self.axes
+        }
+        return dense_store.write_dense_store(store_dir, self.samples, self.stages, self.variations,
+                                             self.axes, arrays)
+
+    @classmethod
+    def load(cls, store_dir, mmap=True):
+        """
+        Opens a dense store written by `save`.
+
+        With `mmap=True` (the default) the arrays are memory-mapped read-only,
+        so opening is instantaneous and only the sliced pages are read. Use
+        `mmap=False` for a store that will be modified.
+        """
+        header = dense_store.read_dense_header(store_dir)
+        if header is None:
+            raise FileNotFoundError(f"No dense histogram store found at {store_dir}")
+
+        store = cls.__new__(cls)
+        store.samples = header['samples']
+        store.stages = header['stages']
+        store.variations = header['variations']
+        store.axes = {var: _axis_from_header(info) for var, info in header['variables'].items()}
+        store._build_index()
+
+        store.sumw, store.sumw2, store.booked = {}, {}, {}
+        for var in store.axes:
+            store.sumw[var] = dense_store.load_dense_array(store_dir, var, 'sumw', mmap)
+            store.sumw2[var] = dense_store.load_dense_array(store_dir, var, 'sumw2', mmap)
+            store.booked[var] = dense_store.load_dense_array(store_dir, var, 'booked', mmap)
+        return store
+
+    # ---------------------------------------------------------
+    # Filling and merging
+    # ---------------------------------------------------------
+    def add(self, sample, stage_histograms, scale=1.0):
+        """
+        Adds the {stage: {var: {syst: Hist}}} histograms of one processing result
+        to `sample`. Use scale=-1 to subtract them.
+        """
+        i = self._index['sample'][sample]
+        for stage, vars_dict in stage_histograms.items():
+            j = self._index['stage'][stage]
+            for var, systs in vars_dict.items():
+                sumw, sumw2, booked = self.sumw[var], self.sumw2[var], self.booked[var]
+                for syst, hist_obj in systs.items():
+                    k = self._index['variation'][syst]
+                    view = hist_obj.view(flow=True)
+                    sumw[i, j, k] += scale * view.value
+                    sumw2[i, j, k] += scale * view.variance
+                    booked[i, j, k] = True
+
+    def __iadd__(self, other):
+        """
+        Adds another store. Stores with the same labels are merged with one
+        array addition per variable, and stores with the same stages and
+        variations (e.g., the one-sample store of a processing result) with
+        one addition per sample row. Otherwise `other` is scattered into the
+        matching sample, stage and variation indices (its labels must exist here).
+        """
+        same_bins = other.stages == self.stages and other.variations == self.variations
+        same_layout = same_bins and other.samples == self.samples
+        try:
+            rows = [self._index['sample'][name] for name in other.samples]
+            if not same_bins:
+                index = np.ix_(
+                    rows,
+                    [self._index['stage'][name] for name in other.stages],
+                    [self._index['variation'][name] for name in other.variations],
+                )
+        except KeyError as e:
+            raise KeyError(f"Cannot merge stores: label {e} is not part of this store") from None
+
+        for var in other.axes:
+            if var not in self.axes:
+                raise KeyError(f"Cannot merge stores: variable '{var}' is not part of this store")
+            if same_layout:
+                self.sumw[var] += other.sumw[var]
+                self.sumw2[var] += other.sumw2[var]
+                self.booked[var] |= other.booked[var]
+            elif same_bins:
+                for r, i in enumerate(rows):
+                    self.sumw[var][i] += other.sumw[var][r]
+                    self.sumw2[var][i] += other.sumw2[var][r]
+                    self.booked[var][i] |= other.booked[var][r]
+            else:
+                self.sumw[var][index] += other.sumw[var]
+                self.sumw2[var][index] += other.sumw2[var]
+                self.booked[var][index] |= other.booked[var]
+        return self
+
+    def empty_like(self, samples=None):
+        """
+        Returns a store with the same stages, variables, variations and
+        booking, and all histograms empty. `samples` relabels the samples
+        (same number of samples).
+        """
+        samples = list(samples) if samples is not None else list(self.samples)
+        if len(samples) != len(self.samples):
+            raise ValueError(f"Expected {len(self.samples)} sample labels, got {len(samples)}")
+
+        store = HistogramStore.__new__(HistogramStore)
+        store.samples = samples
+        store.stages = list(self.stages)
+        store.variations = list(self.variations)
+        store.axes = dict(self.axes)
+        store._build_index()
+        store.sumw = {var: np.zeros(array.shape) for var, array in self.sumw.items()}
+        store.sumw2 = {var: np.zeros(array.shape) for var, array in self.sumw2.items()}
+        store.booked = {var: np.array(array, dtype=bool) for var, array in self.booked.items()}
+        return store
+
+    def reset(self, sample):
+        """Zeroes every histogram of `sample`, keeping its booking."""
+        i = self._index['sample'][sample]
+        for var in self.axes:
+            self.sumw[var][i] = 0.0
+            self.sumw2[var][i] = 0.0
+
+    # ---------------------------------------------------------
+    # Lookup and slicing
+    # ---------------------------------------------------------
+    def index(self, axis, name):
+        """Integer index of `name` along 'sample', 'stage' or 'variation'."""
+        return self._index[axis][name]
+
+    def is_booked(self, sample, stage, var, variation='nominal'):
+        try:
+            i = self._index['sample'][sample]
+            j = self._index['stage'][stage]
+            k = self._index['variation'][variation]
+            return bool(self.booked[var][i, j, k])
+        except KeyError:
+            return False
+
+    def __contains__(self, item):
+        return self.is_booked(*item)
+
+    def get(self, sample, stage, var, variation='nominal'):
+        """
+        Returns (values, variances, edges) of one histogram without flow bins,
+        like helper.get_histogram_data, or (None, None, None) if it is not booked.
+        """
+        if not self.is_booked(sample, stage, var, variation):
+            return None, None, None
+        i = self._index['sample'][sample]
+        j = self._index['stage'][stage]
+        k = self._index['variation'][variation]
+        return self.sumw[var][i, j, k, 1:-1], self.sumw2[var][i, j, k, 1:-1], self.axes[var].edges
+
+    def to_hist(self, sample, stage, var, variation='nominal'):
+        """Builds a hist.Hist with Weight storage for one histogram (including flow bins)."""
+        i = self._index['sample'][sample]
+        j = self._index['stage'][stage]
+        k = self._index['variation'][variation]
+        h = hist.Hist(self.axes[var], storage=hist.storage.Weight())
+        h.view(flow=True).value = self.sumw[var][i, j, k]
+        h.view(flow=True).variance = self.sumw2[var][i, j, k]
+        return h
+
+    def select(self, var, samples=None, stages=None, variations=None, flow=False):
+        """
+        Slices the sumw and sumw2 arrays of one variable.
+
+        Each of `samples`, `stages` and `variations` can be None (all), a single
+        name (that axis is dropped) or a list of names. Slices without lists
+        are views (memory-mapped for a loaded store); lists of names produce
+        a copy of just that subset.
+
+        Returns
+        -------
+        sumw, sumw2 : numpy.ndarray
+            Arrays with the remaining axes in [sample, stage, variation, bin] order.
+        """
+        sumw = self.sumw[var]
+        sumw2 = self.sumw2[var]
+        squeeze = []
+        # Index one axis at a time so that lists of names do not broadcast together
+        for axis, (axis_name, names) in enumerate(zip(AXIS_NAMES, (samples, stages, variations))):
+            if names is None:
+                continue
+            if isinstance(names, str):
+                i = self._index[axis_name][names]
+                idx = slice(i, i + 1)
+                squeeze.append(axis)
+            else:
+                idx = [self._index[axis_name][name] for name in names]
+            full = (slice(None),) * axis + (idx,)
+            sumw = sumw[full]
+            sumw2 = sumw2[full]
+
+        bins = slice(None) if flow else slice(1, -1)
+        return np.squeeze(sumw[..., bins], axis=tuple(squeeze)), np.squeeze(sumw2[..., bins], axis=tuple(squeeze))
+
+    def __repr__(self):
+        return (f"<HistogramStore: {len(self.samples)} samples x {len(self.stages)} stages x "
+                f"{len(self.variations)} variations, variables {list(self.axes)}>")
+
+def _axis_from_header(info):
+    """Rebuilds a hist axis from the bin edges and labels stored in a dense store header."""
+    edges = np.asarray(info['edges'])
+    name = info.get('name', '')
+    widths = np.diff(edges)
+    if np.allclose(widths, widths[0]):
+        return hist.axis.Regular(len(edges) - 1, edges[0], edges[-1], name=name, label=info['label'])
+    return hist.axis.Variable(edges, name=name, label=info['label'])
@@ -5,6 +5,8 @@ This module handles Golden JSON validation for Data.
 It includes:
 - Loading the Golden JSON file
 - Applying the JSON mask to event arrays (filtering good runs/lumis)
+- `LumiMask`: the same mask compiled once into sorted arrays, for processors
+  that apply it to many chunks
 """
 
 import json
@@ -58,4 +60,56 @@ def apply_json_mask(arrays, json_input, run_periods=None):
             run_lumi_mask |= (run_lumis >= lumi_start) & (run_lumis <= lumi_end)
         mask[run_mask] = run_lumi_mask
     
-    return ak.Array(mask)
\ No newline at end of file
+    return ak.Array(mask)
+
+class LumiMask:
+    """
+    Golden JSON compiled into sorted (run, lumi section) intervals.
+
+    `apply_json_mask` re-reads the JSON and loops over every certified run for
+    each chunk. Here the JSON is parsed once: every run and lumi section pair
+    is encoded as one integer `run << 32 | lumi`, the overlapping lumi ranges
+    of a run are merged, and each event is then looked up with a single
+    binary search (np.searchsorted). Gives the same mask as `apply_json_mask`.
+
+    Parameters
+    ----------
+    json_input : str, pathlib.Path or dict
+        Golden JSON file path or its loaded content.
+    run_periods : dict, optional
+        Only the runs inside these periods are kept (see Config.RUN_PERIODS_2016).
+    """
+
+    def __init__(self, json_input, run_periods=None):
+        if not isinstance(json_input, (str, dict)):
+            json_input = str(json_input)
+        valid_lumis = load_golden_json(json_input, run_periods)
+
+        starts, ends = [], []
+        for run in sorted(valid_lumis):
+            merged = []
+            for lumi_start, lumi_end in sorted(valid_lumis[run]):
+                if merged and lumi_start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], lumi_end)
+                else:
+                    merged.append([lumi_start, lumi_end])
+            for lumi_start, lumi_end in merged:
+                starts.append((run << 32) | lumi_start)
+                ends.append((run << 32) | lumi_end)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def mask(self, runs, lumis):
+        """Boolean NumPy mask of the certified (run, lumi section) pairs."""
+        keys = (np.asarray(runs, dtype=np.int64) << 32) | np.asarray(lumis, dtype=np.int64)
+        i = np.searchsorted(self.starts, keys, side='right') - 1
+        inside = i >= 0
+        inside[inside] = keys[inside] <= self.ends[i[inside]]
+        return inside
+
+    def __call__(self, arrays):
+        """Same as apply_json_mask(arrays, ...): an awkward boolean array."""
+        return ak.Array(self.mask(ak.to_numpy(arrays.run), ak.to_numpy(arrays.luminosityBlock)))
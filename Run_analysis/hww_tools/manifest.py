@@ -0,0 +1,135 @@
+"""
+manifest.py
+
+This module tracks which input files contributed to the saved outputs, so that
+dataset growth does not require a full rerun.
+
+After every run, `execute_analysis` writes a manifest next to
+`HWW_analysis_output.root` that records:
+- The files that were merged into the outputs, per sample.
+- The exact (unrounded) raw and weighted cutflows.
+- A hash of the code and configuration used to produce them (the same
+  task code and configuration values as the `ResultCache` keys).
+
+On an incremental run the manifest is compared against the current
+`helper.load_all_files` result. Only added files are processed and added to
+the existing outputs. Removed files are subtracted using their per-file result
+from the `ResultCache`; if that result is unavailable, the affected sample is
+reprocessed from scratch.
+"""
+
+import json
+from pathlib import Path
+
+from .histogram_store import HistogramStore
+from .result_cache import processing_hash
+
+MANIFEST_NAME = "HWW_analysis_manifest.json"
+
+def compute_run_hash(processing_task=None):
+    """
+    Hash of the code and configuration that define the content of the outputs
+    (result_cache.processing_hash). Plotting and driver code are not part of
+    it, so editing them keeps incremental runs incremental.
+    """
+    return processing_hash(processing_task)
+
+def save_manifest(output_dir, completed, cutflow_final, weighted_cutflow_final, run_hash):
+    """
+    Writes the manifest describing the current outputs.
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        Directory holding the analysis outputs.
+    completed : set of tuple
+        The (sample label, file URL) pairs that were merged into the outputs.
+    cutflow_final, weighted_cutflow_final : dict
+        The merged raw and weighted cutflows.
+    run_hash : str
+        Hash returned by `compute_run_hash`.
+    """
+    samples = {}
+    for label, file_url in sorted(completed):
+        samples.setdefault(label, []).append(file_url)
+
+    manifest = {
+        'run_hash': run_hash,
+        'samples': samples,
+        'cutflow': cutflow_final,
+        'weighted_cutflow': weighted_cutflow_final,
+    }
+    path = Path(output_dir) / MANIFEST_NAME
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1, default=_to_builtin)
+    print(f"Saved output manifest to: {path}")
+
+def _to_builtin(value):
+    """JSON fallback for NumPy scalars coming out of the processor."""
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def load_manifest(output_dir):
+    """Returns the manifest stored in `output_dir`, or None if there is none."""
+    path = Path(output_dir) / MANIFEST_NAME
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def diff_manifest(manifest, files):
+    """
+    Compares the files recorded in a manifest with the current file lists.
+
+    Parameters
+    ----------
+    manifest : dict
+        Manifest returned by `load_manifest`.
+    files : dict
+        Current dictionary of sample labels and their file URLs.
+
+    Returns
+    -------
+    added : dict
+        Sample label -> list of URLs that are not in the outputs yet.
+    removed : dict
+        Sample label -> list of URLs that are in the outputs but no longer listed.
+    """
+    recorded = manifest.get('samples', {})
+    added = {}
+    removed = {}
+
+    for label in set(files) | set(recorded):
+        current = set(files.get(label, []))
+        previous = set(recorded.get(label, []))
+        if current - previous:
+            added[label] = [url for url in files.get(label, []) if url not in previous]
+        if previous - current:
+            removed[label] = sorted(previous - current)
+
+    return added, removed
+
+def subtract_result(result, hist_data_final, cutflow_final, weighted_cutflow_final):
+    """
+    Removes one file's processing result from the merged accumulators in place.
+
+    The Weight storage does not support histogram subtraction, so the values
+    and variances are subtracted on the underlying views (including flow bins).
+    """
+    label, stage_histograms, cutflow, weighted_cutflow, error = result[:5]
+    if isinstance(stage_histograms, HistogramStore):
+        stage_histograms = stage_histograms.to_dict()[label]
+
+    for stage, count in (cutflow or {}).items():
+        cutflow_final[label][stage] = cutflow_final[label].get(stage, 0) - count
+    for stage, count in (weighted_cutflow or {}).items():
+        weighted_cutflow_final[label][stage] = weighted_cutflow_final[label].get(stage, 0.0) - count
+
+    for stage, vars_dict in (stage_histograms or {}).items():
+        for var, syst_dict in vars_dict.items():
+            for syst, hist_obj in syst_dict.items():
+                target = hist_data_final[label][stage][var][syst].view(flow=True)
+                source = hist_obj.view(flow=True)
+                target.value -= source.value
+                target.variance -= source.variance
@@ -0,0 +1,413 @@
+"""
+merging.py
+
+This module sums any number of partial analysis outputs into one, like ROOT's
+`hadd`: the partial outputs of sharded runs (batch.py), of runs over subsets
+of the samples, or checkpoints.
+
+Restoring every partial ROOT file with `helper.restore_histograms` and adding
+the dictionaries in the notebook process is slow, single-threaded and keeps
+all the inputs in memory. `merge_outputs` instead works on the dense store
+layout (dense_store.py), where every variable is independent:
+1. Inputs without a dense store (ROOT files, checkpoints) are converted to a
+   temporary dense store, one input per worker process.
+2. The headers are compared: all the inputs must have the same stages,
+   variables, variations and binning (the samples may differ).
+3. For every variable, the inputs are summed as a tree: each task adds at
+   most `fan_in` memory-mapped inputs into one accumulator and writes it to
+   disk, and the partial sums are summed again until one is left. The tasks
+   of all the variables and groups run in parallel, and a task only holds
+   one variable of one input at a time, so memory stays bounded whatever the
+   number of inputs.
+4. The cutflows of the manifests (or checkpoints) are summed exactly, and the
+   merged dense store, ROOT file, cutflow CSVs and manifest are written.
+"""
+
+import os
+import shutil
+import tempfile
+import concurrent.futures as cf
+from pathlib import Path
+
+import numpy as np
+
+from . import Config
+from .dense_store import DENSE_STORE_NAME, HEADER_NAME, ARRAY_KINDS, read_dense_header, load_dense_array
+
+ROOT_OUTPUT_NAME = "HWW_analysis_output.root"
+
+# ==============================================================================
+# INPUTS
+# ==============================================================================
+
+def describe_input(path):
+    """
+    Identifies a partial output.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        An output directory (dense store, else ROOT file, plus its manifest),
+        a dense store directory, a ROOT file, a checkpoint file or a manifest
+        (cutflows only).
+
+    Returns
+    -------
+    source : dict
+        'path', 'kind' ('dense', 'root', 'checkpoint' or 'manifest'),
+        'store_dir' (dense inputs) and 'manifest' (or None).
+
+    Raises
+    ------
+    FileNotFoundError
+        If `path` holds no analysis output.
+    """
+    from .manifest import MANIFEST_NAME, load_manifest
+    from .root_io import resolve_sample_files
+
+    path = Path(path)
+    source = {'path': path, 'kind': None, 'store_dir': None, 'manifest': None}
+    if path.is_dir():
+        source['manifest'] = load_manifest(path)
+        if (path / HEADER_NAME).exists():
+            source.update(kind='dense', store_dir=path, manifest=load_manifest(path.parent))
+        elif (path / DENSE_STORE_NAME / HEADER_NAME).exists():
+            source.update(kind='dense', store_dir=path / DENSE_STORE_NAME)
+        elif (path / ROOT_OUTPUT_NAME).exists() or resolve_sample_files(path / ROOT_OUTPUT_NAME):
+            source.update(kind='root', path=path / ROOT_OUTPUT_NAME)
+    elif path.name == MANIFEST_NAME:
+        source.update(kind='manifest', manifest=load_manifest(path.parent))
+    elif path.suffix == ".root" or resolve_sample_files(path):
+        source['kind'] = 'root'
+    elif path.exists():
+        source['kind'] = 'checkpoint'
+
+    if source['kind'] is None:
+        raise FileNotFoundError(f"No analysis output found at {path}")
+    return source
+
+def _to_dense(source, store_dir):
+    """
+    Converts a ROOT or checkpoint input to a dense store (run in a worker).
+    Returns the cutflows of a checkpoint as a manifest-like dictionary, else None.
+    """
+    if source['kind'] == 'checkpoint':
+        return _checkpoint_to_dense(source['path'], store_dir)
+    _root_to_dense(source['path'], store_dir)
+    return None
+
+def _checkpoint_to_dense(path, store_dir):
+    from .checkpoint import load_checkpoint
+    from .histogram_store import HistogramStore
+
+    state = load_checkpoint(path)
+    hist_data = state['hist_data']
+    if not isinstance(hist_data, HistogramStore):
+        hist_data = HistogramStore.from_dict(hist_data)
+    hist_data.save(store_dir)
+
+    samples = {}
+    for label, url in sorted(state['completed']):
+        samples.setdefault(label, []).append(url)
+    return {'run_hash': None, 'samples': samples,
+            'cutflow': state['cutflow'], 'weighted_cutflow': state['weighted_cutflow']}
+
+def _root_to_dense(path, store_dir):
+    """
+    Reads the arrays of every histogram directly (no Hist objects), which
+    is most of the cost of a ROOT input.
+    """
+    from .dense_store import write_dense_store
+    from .histogram_store import _axis_from_header
+    from .root_io import LazyHistograms
+
+    with LazyHistograms(path, cache_size=1) as histograms:
+        # Labels in the order of the keys (listing only, nothing is read yet)
+        keys, labels = [], {'sample': [], 'stage': [], 'variation': []}
+        for sample in histograms:
+            for stage, vars_dict in histograms[sample].items():
+                for var, systs in vars_dict.items():
+                    for syst in systs:
+                        keys.append((sample, stage, var, syst))
+                        for axis, name in zip(labels, (sample, stage, syst)):
+                            if name not in labels[axis]:
+                                labels[axis].append(name)
+        # Flat keys that cannot be attributed would silently be missing from the sum
+        if histograms.unindexed:
+            raise ValueError(f"{path}: {len(histograms.unindexed)} flat histogram names do not match a known "
+                             f"stage, variable and variation (e.g. '{histograms.unindexed[0]}'); "
+                             "write the outputs with the hierarchical layout to merge them")
+        index = {axis: {name: i for i, name in enumerate(names)} for axis, names in labels.items()}
+        lead = tuple(len(names) for names in labels.values())
+
+        # Only the histograms present in the file are booked
+        arrays, axes, first_edges = {}, {}, {}
+        for sample, stage, var, syst in keys:
+            sumw, sumw2, edges, axis = histograms.arrays(sample, stage, var, syst)
+            if var not in arrays:
+                first_edges[var] = edges
+                axes[var] = _axis_from_header({'edges': list(edges), 'name': axis.member('fName'),
+                                               'label': axis.member('fTitle')})
+                arrays[var] = {'sumw': np.zeros(lead + (len(sumw),)), 'sumw2': np.zeros(lead + (len(sumw),)),
+                               'booked': np.zeros(lead, dtype=bool)}
+            elif not np.array_equal(edges, first_edges[var]):
+                raise ValueError(f"{path}: '{var}' histograms with different binnings")
+            at = (index['sample'][sample], index['stage'][stage], index['variation'][syst])
+            arrays[var]['sumw'][at] = sumw
+            arrays[var]['sumw2'][at] = sumw2
+            arrays[var]['booked'][at] = True
+    write_dense_store(store_dir, labels['sample'], labels['stage'], labels['variation'], axes, arrays)
+
+# ==============================================================================
+# SCHEMA
+# ==============================================================================
+
+def check_schemas(headers):
+    """
+    Checks that dense store headers can be summed.
+
+    Parameters
+    ----------
+    headers : dict
+        Input name -> dense store header.
+
+    Returns
+    -------
+    samples : list of str
+        All the samples, in Config.sample_order (then first seen).
+
+    Raises
+    ------
+    ValueError
+        Listing every input whose stages, variables, variations or binning
+        differ from the first input.
+    """
+    names = list(headers)
+    reference = headers[names[0]]
+    problems = []
+    for name in names[1:]:
+        header = headers[name]
+        for key in ('stages', 'variations', 'variables'):
+            missing = [label for label in reference[key] if label not in header[key]]
+            extra = [label for label in header[key] if label not in reference[key]]
+            if missing or extra:
+                problems.append(f"{name}: {key} differ (missing {missing}, extra {extra})")
+        for var, info in header['variables'].items():
+            ref_info = reference['variables'].get(var)
+            if ref_info is not None and not np.array_equal(info['edges'], ref_info['edges']):
+                problems.append(f"{name}: binning of '{var}' differs")
+    if problems:
+        raise ValueError(f"Partial outputs incompatible with {names[0]}:\n  " + "\n  ".join(problems))
+
+    first_seen = {}
+    for header in headers.values():
+        for sample in header['samples']:
+            first_seen.setdefault(sample, len(first_seen))
+    order = Config.sample_order
+    return sorted(first_seen, key=lambda s: (order.index(s) if s in order else len(order), first_seen[s]))
+
+# ==============================================================================
+# TREE REDUCTION
+# ==============================================================================
+
+def _sum_group(var, parts, labels, n_bins, out_dir):
+    """
+    Sums one variable of the `parts` [(store_dir, (samples, stages, variations))]
+    into the `labels` layout and writes it to `out_dir` (run in a worker).
+    """
+    shape = tuple(len(axis) for axis in labels) + (n_bins,)
+    acc = {'sumw': np.zeros(shape), 'sumw2': np.zeros(shape), 'booked': np.zeros(shape[:3], dtype=bool)}
+    for store_dir, part_labels in parts:
+        index = ...
+        if part_labels != labels:
+            index = np.ix_(*[[axis.index(name) for name in names] for axis, names in zip(labels, part_labels)])
+        for kind in ARRAY_KINDS:
+            arr = load_dense_array(store_dir, var, kind, mmap=True)
+            if kind == 'booked':
+                acc[kind][index] |= arr
+            else:
+                acc[kind][index] += arr
+            del arr
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for kind in ARRAY_KINDS:
+        np.save(out_dir / f"{var}.{kind}.npy", acc[kind])
+    return str(out_dir)
+
+def _run(pool, fn, calls):
+    """Runs fn(*args) for every args in `calls` on the pool (in this process if None)."""
+    if pool is None:
+        return [fn(*args) for args in calls]
+    futures = [pool.submit(fn, *args) for args in calls]
+    return [future.result() for future in futures]
+
+def tree_sum(sources, labels, variables, store_dir, work_dir, pool=None, fan_in=8):
+    """
+    Sums the dense stores `sources` [(store_dir, header)] into `store_dir`.
+
+    Every level groups the parts of each variable by `fan_in` and sums the
+    groups in parallel; a group holding all the remaining parts of a
+    variable writes straight into `store_dir`.
+    """
+    fan_in = max(2, int(fan_in))
+    pending = {
+        var: [(str(d), (h['samples'], h['stages'], h['variations'])) for d, h in sources]
+        for var in variables
+    }
+    level = 0
+    while pending:
+        calls, final = [], {}
+        for var, parts in pending.items():
+            groups = [parts[i:i + fan_in] for i in range(0, len(parts), fan_in)]
+            final[var] = len(groups) == 1
+            for i, group in enumerate(groups):
+                out_dir = store_dir if final[var] else Path(work_dir) / f"level{level}_{var}_{i}"
+                calls.append((var, group, labels, len(variables[var]['edges']) + 1, out_dir))
+        outputs = _run(pool, _sum_group, calls)
+
+        summed = {}
+        for (var, *_), out_dir in zip(calls, outputs):
+            if not final[var]:
+                summed.setdefault(var, []).append((out_dir, labels))
+        # Partial sums of the previous level are no longer needed
+        for var, parts in pending.items():
+            for part_dir, _ in parts:
+                if level > 0 and Path(part_dir) != Path(store_dir):
+                    shutil.rmtree(part_dir, ignore_errors=True)
+        pending = summed
+        level += 1
+    return level
+
+# ==============================================================================
+# MERGE
+# ==============================================================================
+
+def _sum_cutflows(manifests):
+    cutflow_final, weighted_cutflow_final = {}, {}
+    for manifest in manifests:
+        for source_key, merged_flows in (('cutflow', cutflow_final), ('weighted_cutflow', weighted_cutflow_final)):
+            for label, counts in manifest[source_key].items():
+                merged = merged_flows.setdefault(label, {})
+                for stage, count in counts.items():
+                    merged[stage] = merged.get(stage, 0) + count
+    return cutflow_final, weighted_cutflow_final
+
+def merge_outputs(inputs, output_dir=None, n_workers=None, fan_in=8, root_options=None,
+                  write_root=True, allow_overlap=False):
+    """
+    Sums partial outputs into the usual outputs of `output_dir`.
+
+    Parameters
+    ----------
+    inputs : list of str or pathlib.Path
+        Partial outputs (see `describe_input`).
+    output_dir : str or pathlib.Path, optional
+        Destination of the dense store, ROOT file, cutflow CSVs and manifest.
+        Defaults to None (Config.OUTPUT_DIR).
+    n_workers : int, optional
+        Worker processes. Defaults to None (one per CPU); 1 runs everything
+        in this process.
+    fan_in : int, optional
+        Inputs summed by one task of the tree reduction. Defaults to 8.
+    root_options : dict, optional
+        Keyword arguments for helper.save_root_file. Defaults to None.
+    write_root : bool, optional
+        Also write HWW_analysis_output.root (from the merged dense store).
+        Defaults to True.
+    allow_overlap : bool, optional
+        Merge even if the manifests show a file in more than one input
+        (it would be counted twice). Defaults to False.
+
+    Returns
+    -------
+    hist_store : histogram_store.HistogramStore
+        The merged dense store (memory-mapped).
+    cutflow_final, weighted_cutflow_final : dict
+
+    Raises
+    ------
+    ValueError
+        If the inputs have incompatible schemas or overlapping files.
+    """
+    from . import cutflow_utils, helper
+    from . import manifest as manifest_utils
+    from .dense_store import write_dense_store
+    from .executors import _usable_cpus
+    from .histogram_store import HistogramStore, _axis_from_header
+
+    output_dir = Path(output_dir) if output_dir is not None else Config.OUTPUT_DIR
+    store_dir = output_dir / DENSE_STORE_NAME
+    sources = [describe_input(path) for path in inputs]
+    if not any(source['kind'] != 'manifest' for source in sources):
+        raise ValueError("No histogram output among the inputs")
+    if any(s['store_dir'] is not None and Path(s['store_dir']).resolve() == store_dir.resolve() for s in sources):
+        raise ValueError(f"The output directory {output_dir} is also an input")
+
+    n_workers = n_workers or _usable_cpus()
+    os.makedirs(output_dir, exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(prefix=".merge_", dir=output_dir))
+    pool = cf.ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        # 1. CONVERT THE INPUTS WITHOUT A DENSE STORE
+        to_convert = [s for s in sources if s['kind'] in ('root', 'checkpoint')]
+        if to_convert:
+            print(f"Converting {len(to_convert)} ROOT/checkpoint inputs to dense stores...")
+            converted = [(source, work_dir / f"input_{i}") for i, source in enumerate(to_convert)]
+            manifests = _run(pool, _to_dense, converted)
+            for (source, converted_dir), manifest in zip(converted, manifests):
+                source['store_dir'] = converted_dir
+                source['manifest'] = source['manifest'] or manifest
+
+        # 2. CHECK THE FILES AND SCHEMAS
+        # Files completed in several inputs would be counted twice
+        completed = set()
+        overlaps = set()
+        for source in sources:
+            for label, urls in (source['manifest'] or {}).get('samples', {}).items():
+                units = {(label, url) for url in urls}
+                overlaps |= completed & units
+                completed |= units
+        if overlaps and not allow_overlap:
+            label, url = sorted(overlaps)[0]
+            raise ValueError(f"{len(overlaps)} files are in more than one input (e.g. {label}: {url}); "
+                             "pass allow_overlap=True to sum them anyway")
+
+        dense = [s for s in sources if s['store_dir'] is not None]
+        headers = {str(s['path']): read_dense_header(s['store_dir']) for s in dense}
+        samples = check_schemas(headers)
+        reference = next(iter(headers.values()))
+        labels = (samples, reference['stages'], reference['variations'])
+        variables = reference['variables']
+
+        # 3. SUM
+        (store_dir / HEADER_NAME).unlink(missing_ok=True)
+        n_levels = tree_sum([(s['store_dir'], headers[str(s['path'])]) for s in dense], labels, variables,
+                            store_dir, work_dir, pool=pool, fan_in=fan_in)
+        axes = {var: _axis_from_header(info) for var, info in variables.items()}
+        write_dense_store(store_dir, samples, reference['stages'], reference['variations'], axes, {})
+        print(f"Summed {len(dense)} inputs x {len(variables)} variables in {n_levels} levels "
+              f"({n_workers} processes) into: {store_dir}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # 4. CUTFLOWS AND OUTPUTS
+    hist_store = HistogramStore.load(store_dir)
+    manifests = [s['manifest'] for s in sources if s['manifest'] is not None]
+    if len(manifests) < len(sources):
+        print(f"WARNING: {len(sources) - len(manifests)} inputs have no manifest, their cutflows are missing.")
+    cutflow_final, weighted_cutflow_final = _sum_cutflows(manifests)
+
+    if write_root:
+        helper.save_root_file(hist_store.to_dict(), output_dir / ROOT_OUTPUT_NAME, **(root_options or {}))
+    if manifests:
+        cutflow_utils.save_cutflows(cutflow_final, weighted_cutflow_final, output_dir)
+        # Checkpoints carry no run hash; the merged outputs only get one if all inputs agree
+        run_hashes = {m['run_hash'] for m in manifests}
+        if len(run_hashes - {None}) > 1:
+            print("WARNING: The inputs were produced with different code or configuration.")
+        manifest_utils.save_manifest(output_dir, completed, cutflow_final, weighted_cutflow_final,
+                                     run_hashes.pop() if len(run_hashes) == 1 else None)
+    return hist_store, cutflow_final, weighted_cutflow_final
@@ -0,0 +1,268 @@
+"""
+ntuple.py
+
+This module writes and reads the derived-analysis ntuples.
+
+After the e-mu preselection, the processor computes the event observables and
+the systematic weights, but only histograms leave the worker, so every new
+binning or cut needs another pass over NanoAOD. When enabled, the processor
+also keeps a compact columnar table of the preselected events:
+- The observables of `Plots_config.variables_to_plots` (mass, met, dphi, ...).
+- One weight column per systematic variation (`weight_nominal`, ...).
+- `stage_bits`: bit i is set if the event passed Config.stage_names[i]
+  (see `cuts.stage_bitmask`).
+
+The table travels back in the optional sixth element of the processing result
+(`{'ntuple': ...}`, built by `NtupleBuffer.to_extras`) and `execute_analysis(..., ntuple_dir=...)` writes it
+to disk, one directory per sample and work unit:
+
+    <ntuple_dir>/<sample>/<unit>/<column>.npy + meta.json
+
+Every column is a plain `.npy` file, so the ntuples can be memory-mapped and
+re-histogrammed on one machine in seconds (`histograms_from_ntuples`).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import awkward as ak
+import numpy as np
+
+from . import Config
+from .cuts import stage_bitmask
+
+NTUPLE_VERSION = 1
+META_NAME = "meta.json"
+BITS_COLUMN = "stage_bits"
+
+def weight_column(variation):
+    """Name of the weight column of a systematic variation."""
+    return f"weight_{variation}"
+
+def unit_name(file_url, entry_range=None):
+    """
+    Directory name of one work unit: the file name followed by a short hash of
+    the full URL (and entry range), so equal file names from different
+    datasets do not collide.
+    """
+    start, stop = entry_range if entry_range is not None else (None, None)
+    digest = hashlib.sha256(f"{file_url}|{start}|{stop}".encode()).hexdigest()[:12]
+    stem = os.path.splitext(file_url.split('/')[-1])[0]
+    return f"{stem}_{digest}"
+
+# ==============================================================================
+# BUILDING (inside the processor)
+# ==============================================================================
+
+class NtupleBuffer:
+    """
+    Collects the ntuple columns of one work unit, batch by batch.
+
+    Parameters
+    ----------
+    variables : list of str, optional
+        Observable columns. Defaults to the keys of Plots_config.variables_to_plots.
+    variations : list of str, optional
+        Systematic variations with a weight column. Defaults to Config.VARIATIONS.
+    stage_names : list of str, optional
+        Stage order of the bitmask. Defaults to Config.stage_names.
+    dtype : numpy dtype, optional
+        Floating point type of the observables and weights. Defaults to float32,
+        which halves the size and is ample for histogramming.
+    """
+
+    def __init__(self, variables=None, variations=None, stage_names=None, dtype=np.float32):
+        if variables is None:
+            from .Plots_config import variables_to_plots
+            variables = list(variables_to_plots.keys())
+        self.variables = list(variables)
+        self.variations = list(variations if variations is not None else Config.VARIATIONS)
+        self.stage_names = list(stage_names if stage_names is not None else Config.stage_names)
+        self.dtype = dtype
+        self._chunks = {name: [] for name in self.columns}
+
+    @property
+    def columns(self):
+        return self.variables + [weight_column(syst) for syst in self.variations] + [BITS_COLUMN]
+
+    def append(self, observables, weights_dict, stage_masks):
+        """
+        Adds one batch of preselected events.
+
+        Parameters
+        ----------
+        observables : dict
+            Variable name -> per-event values (awkward or NumPy).
+        weights_dict : dict
+            Variation name -> per-event weights. Missing variations use 'nominal'.
+        stage_masks : dict
+            Stage name -> per-event boolean mask. Missing stages count as failed.
+        """
+        n_events = len(weights_dict['nominal'])
+        if n_events == 0:
+            return
+
+        for var in self.variables:
+            self._chunks[var].append(ak.to_numpy(observables[var]).astype(self.dtype))
+        for syst in self.variations:
+            weights = weights_dict.get(syst, weights_dict['nominal'])
+            self._chunks[weight_column(syst)].append(ak.to_numpy(weights).astype(self.dtype))
+        self._chunks[BITS_COLUMN].append(stage_bitmask(stage_masks, n_events, self.stage_names))
+
+    def finalize(self):
+        """Returns the collected columns as {column: numpy array}."""
+        columns = {}
+        for name, chunks in self._chunks.items():
+            dtype = np.uint32 if name == BITS_COLUMN else self.dtype
+            columns[name] = np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+        return columns
+
+    def to_extras(self):
+        """The `extras` element of a processing result carrying this ntuple."""
+        return {'ntuple': {'columns': self.finalize(), 'stage_names': self.stage_names,
+                           'variations': self.variations}}
+
+# ==============================================================================
+# WRITING AND READING
+# ==============================================================================
+
+def write_ntuple(ntuple_dir, label, file_url, ntuple, entry_range=None):
+    """
+    Writes the ntuple of one work unit.
+
+    The columns are written to a temporary directory that is renamed into place,
+    so a unit directory is always complete. An existing unit is replaced.
+
+    Parameters
+    ----------
+    ntuple_dir : str or pathlib.Path
+        Root directory of the ntuples.
+    label : str
+        Sample label.
+    file_url : str
+        Input file of the work unit.
+    ntuple : dict
+        The 'ntuple' entry of the result extras (see NtupleBuffer.to_extras).
+
+    Returns
+    -------
+    pathlib.Path
+        The unit directory.
+    """
+    unit_dir = Path(ntuple_dir) / label / unit_name(file_url, entry_range)
+    tmp_dir = unit_dir.with_name(unit_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    columns = ntuple['columns']
+    for name, values in columns.items():
+        np.save(tmp_dir / f"{name}.npy", values)
+
+    meta = {
+        'version': NTUPLE_VERSION,
+        'sample': label,
+        'file_url': file_url,
+        'entry_range': list(entry_range) if entry_range is not None else None,
+        'n_events': int(len(columns[BITS_COLUMN])),
+        'columns': list(columns),
+        'stage_names': ntuple['stage_names'],
+        'variations': ntuple['variations'],
+    }
+    with open(tmp_dir / META_NAME, 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    shutil.rmtree(unit_dir, ignore_errors=True)
+    os.replace(tmp_dir, unit_dir)
+    return unit_dir
+
+def ntuple_exists(ntuple_dir, label, file_url, entry_range=None):
+    """True if the unit of this file has already been written completely."""
+    return (Path(ntuple_dir) / label / unit_name(file_url, entry_range) / META_NAME).exists()
+
+def list_units(ntuple_dir, samples=None):
+    """Returns {sample: [unit directories]} of the complete units under `ntuple_dir`."""
+    units = {}
+    ntuple_dir = Path(ntuple_dir)
+    if not ntuple_dir.exists():
+        return units
+    for sample_dir in sorted(p for p in ntuple_dir.iterdir() if p.is_dir()):
+        if samples is not None and sample_dir.name not in samples:
+            continue
+        units[sample_dir.name] = sorted(
+            p.parent for p in sample_dir.glob(f"*/{META_NAME}") if not p.parent.name.endswith(".tmp")
+        )
+    return units
+
+def read_unit(unit_dir, columns=None, mmap=True):
+    """
+    Opens the columns of one unit.
+
+    Returns
+    -------
+    meta : dict
+        The unit metadata.
+    data : dict
+        Column name -> array (memory-mapped read-only by default).
+    """
+    unit_dir = Path(unit_dir)
+    with open(unit_dir / META_NAME, 'r') as f:
+        meta = json.load(f)
+    names = meta['columns'] if columns is None else columns
+    data = {
+        name: np.load(unit_dir / f"{name}.npy", mmap_mode='r' if mmap else None)
+        for name in names
+    }
+    return meta, data
+
+def prune_ntuples(ntuple_dir, completed):
+    """
+    Removes unit directories whose (sample, file) is not in `completed`, so the
+    ntuples describe exactly the same events as the histogram outputs.
+
+    Returns
+    -------
+    int
+        The number of removed units.
+    """
+    keep = {(label, unit_name(url)) for label, url in completed}
+    removed = 0
+    for sample, unit_dirs in list_units(ntuple_dir).items():
+        for unit_dir in unit_dirs:
+            if (sample, unit_dir.name) not in keep:
+                shutil.rmtree(unit_dir, ignore_errors=True)
+                removed += 1
+    return removed
+
+# ==============================================================================
+# RE-HISTOGRAMMING
+# ==============================================================================
+
+def histograms_from_ntuples(ntuple_dir, samples=None, vars_dict=None, stages=None,
+                            variations=None, booking=None):
+    """
+    Rebuilds the histograms from the ntuples, with any binning.
+
+    Parameters
+    ----------
+    ntuple_dir : str or pathlib.Path
+        Root directory of the ntuples.
+    samples : list of str, optional
+        Samples to read. Defaults to every sample found.
+    vars_dict : dict, optional
+        Variable name -> hist axis. Defaults to Plots_config.variables_to_plots;
+        pass new axes to re-bin without reprocessing.
+    stages, variations : list of str, optional
+        Default to Config.stage_names and Config.VARIATIONS.
+    booking : booking.HistogramBooking, optional
+        If given, only the booked histograms are filled.
+
+    Returns
+    -------
+    histogram_store.HistogramStore
+    """
+    from .query import NtupleQuery
+    return NtupleQuery(ntuple_dir, samples).histograms(vars_dict, stages, variations=variations,
+                                                       booking=booking, as_store=True)
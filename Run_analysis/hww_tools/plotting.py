@@ -35,9 +35,10 @@ def create_stacked_plots(variable, hist_data_all, output_dir="plots"):
     ----------
     variable : str
         The internal name of the kinematic variable to plot (e.g., 'mass', 'met').
-    hist_data_all : dict
+    hist_data_all : dict or histogram_store.HistogramStore
         The fully populated nested dictionary containing the histogram objects.
         Format: {Sample: {Stage: {Variable: {Variation: hist.Hist}}}}
+        A HistogramStore (e.g. a loaded dense store) can be passed instead.
     output_dir : str, optional
         The directory path where the generated PNG files will be saved. 
         Defaults to "plots".
@@ -254,8 +255,9 @@ def create_superimposed_plots(variable, var_props, hist_data_all, output_dir=Non
     var_props : hist.axis / object
         An object containing the axis properties (like 'label' and 'edges') 
         used to format the x-axis limits and labels.
-    hist_data_all : dict
-        The nested dictionary containing the nominal histogram data.
+    hist_data_all : dict or histogram_store.HistogramStore
+        The nested dictionary containing the nominal histogram data, or a 
+        HistogramStore.
     output_dir : pathlib.Path or str, optional
         The directory where the resulting plot will be saved. If None, 
         the plot is not saved to disk.
@@ -287,25 +289,8 @@ def create_superimposed_plots(variable, var_props, hist_data_all, output_dir=Non
         has_data = False
         
         for sample in SAMPLES.keys():
-            if sample not in hist_data_all: continue
-            if stage not in hist_data_all[sample]: continue
-            if hist_key not in hist_data_all[sample][stage]: continue
-            
-            hist_variations = hist_data_all[sample][stage][hist_key]
-            
-            if 'nominal' not in hist_variations:
-                continue
-                
-            hist_obj = hist_variations['nominal']
-            
-            try:
-                if hasattr(hist_obj, 'to_numpy'):
-                    values, edges = hist_obj.to_numpy() 
-                else:
-                    values = hist_obj.values()
-                    edges = hist_obj.axes[0].edges
-            except Exception as e:
-                print(f"Skipping {sample} {stage}: {e}")
+            values, _, edges = get_histogram_data(hist_data_all, sample, stage, hist_key, 'nominal')
+            if values is None:
                 continue
 
             total = np.sum(values)
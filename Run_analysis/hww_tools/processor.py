@@ -0,0 +1,400 @@
+"""
+processor.py
+
+This module provides `Processor`, the event processor of the analysis: the
+`make_processor`/`processing_file` closure of the main notebook, moved into
+the package.
+
+The closure captured the whole golden JSON and cross section dictionaries, so
+they were serialized with every task, and each task re-registered `vector`,
+re-parsed the JSON for every Data chunk and looped over the scale factor
+tables row by row. A `Processor` instead only carries its configuration
+(paths, luminosity, booking, options), and the heavy state is built once per
+worker process by `setup()`:
+- The compiled lumi mask (`json_validation.LumiMask`).
+- The scale factor tables as binned lookups (`helper.SFLookup`).
+- The normalization (xsec * lumi / sum of genWeight) of every sample.
+- The histogram template (an empty one-sample `HistogramStore` with the
+  booked stage, variable and variation combinations) and the cut registry.
+
+The executors call `setup()` when they install the task in a worker: the
+local process pool in its initializer and Dask through a worker plugin (see
+executors.py), so the tasks themselves only send (label, file_url, file_idx).
+Called directly (e.g., in a notebook loop), it runs on the first task.
+
+Usage:
+
+    processor = Processor(booking=booking)
+    processor.broadcast(client)   # optional, Dask: golden JSON sent once per worker
+    execute_analysis(client, files, processor, booking=booking)
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+import awkward as ak
+import numpy as np
+
+from . import Config
+
+class Processor:
+    """
+    Processes one NanoAOD file into stage histograms and cutflows.
+
+    Calling it with (label, file_url, file_idx) returns the usual processing
+    result (label, stage_histograms, cutflow, weighted_cutflow, error), plus
+    the ntuple extras when `ntuple` is set. The histograms are a one-sample
+    `HistogramStore` filled directly by the processor, so merging them into
+    the store of execute_analysis is one array addition per variable.
+
+    Parameters
+    ----------
+    golden_json : str, pathlib.Path, dict or dask_utils.Artifact, optional
+        Golden JSON for the Data lumi mask. A path is read here, so the
+        workers do not need access to the file. Defaults to
+        Config.GOLDEN_JSON_PATH (no mask if the file does not exist).
+    run_periods : dict, optional
+        Defaults to Config.RUN_PERIODS_2016.
+    luminosity : float, optional
+        Integrated luminosity in pb^-1. Defaults to cross_section.LUMINOSITY.
+    sample_info : dict or dask_utils.Artifact, optional
+        Cross sections and sums of genWeight by sample key. Defaults to
+        cross_section.sample_info_detailed (imported on the workers).
+    booking : booking.HistogramBooking, optional
+        Histograms to fill. Must be the booking given to execute_analysis.
+        Defaults to None (every histogram of Config.stage_names).
+    ntuple : bool, optional
+        Also return the event ntuple of the file (see ntuple.py). Defaults to False.
+    batch_size : int, optional
+        Events per chunk read by helper.load_events. Defaults to 1,000,000.
+    max_file_retries : int, optional
+        Attempts to read a file before its error is returned. Defaults to 3.
+    """
+
+    def __init__(self, golden_json=None, run_periods=None, luminosity=None, sample_info=None,
+                 booking=None, ntuple=False, batch_size=1_000_000, max_file_retries=3):
+        if golden_json is None and Config.GOLDEN_JSON_PATH.exists():
+            golden_json = Config.GOLDEN_JSON_PATH
+        if isinstance(golden_json, (str, os.PathLike)):
+            with open(golden_json, 'r') as f:
+                golden_json = json.load(f)
+        self.golden_json = golden_json
+        self.run_periods = run_periods if run_periods is not None else Config.RUN_PERIODS_2016
+        self.luminosity = luminosity
+        self.sample_info = sample_info
+        self.booking = booking
+        self.ntuple = ntuple
+        self.batch_size = batch_size
+        self.max_file_retries = max_file_retries
+        self._state = None
+        self._lock = threading.Lock()
+
+    # ---------------------------------------------------------
+    # Worker state
+    # ---------------------------------------------------------
+    def setup(self):
+        """
+        Builds the heavy state of this worker process (only the first call
+        does any work) and returns it.
+        """
+        if self._state is None:
+            with self._lock:
+                if self._state is None:
+                    self._state = _build_state(self)
+        return self._state
+
+    def __getstate__(self):
+        # Only the configuration travels (installed once per worker, see
+        # executors.py); every worker builds its own state
+        state = self.__dict__.copy()
+        state['_state'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """
+        Runs setup() and processes two synthetic events (one MC and one
+        Data chunk), so the first real file of a worker does not pay for the
+        first calls into awkward, vector and hist. Returns the seconds spent.
+        """
+        start = time.perf_counter()
+        state = self.setup()
+        for is_data in (False, True):
+            cutflow = {stage: 0 for stage in Config.cutflow_stages}
+            weighted_cutflow = {stage: 0.0 for stage in Config.cutflow_stages}
+            self._process_chunk(state, _warm_up_chunk(is_data), is_data, 1.0, state.new_histograms("warm-up"),
+                                cutflow, weighted_cutflow, None, "warm-up")
+        return time.perf_counter() - start
+
+    def broadcast(self, client):
+        """
+        Replaces the golden JSON and sample info by artifacts stored once on
+        every Dask worker (see dask_utils.broadcast), so they are no longer
+        sent with the processor. Returns self.
+        """
+        from .dask_utils import broadcast
+
+        if isinstance(self.golden_json, dict):
+            self.golden_json = broadcast(client, self.golden_json, name="golden_json")
+        if isinstance(self.sample_info, dict):
+            self.sample_info = broadcast(client, self.sample_info, name="sample_info")
+        return self
+
+    def cache_token(self):
+        """
+        Identifies the code and configuration of this processor, for
+        result_cache.hash_callable.
+        """
+        golden_json = json.dumps(_resolve(self.golden_json), sort_keys=True)
+        booking = None if self.booking is None else self.booking.layout()
+        payload = repr((
+            inspect.getsource(Processor), inspect.getsource(_build_state), golden_json,
+            sorted(self.run_periods.items()), self.luminosity, _resolve(self.sample_info), booking, self.ntuple,
+        ))
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def __repr__(self):
+        status = "set up" if self._state is not None else "not set up"
+        return f"<Processor: {len(self.stage_names)} stages, ntuple={self.ntuple}, {status}>"
+
+    @property
+    def stage_names(self):
+        return self.booking.stages if self.booking is not None else Config.stage_names
+
+    # ---------------------------------------------------------
+    # Processing
+    # ---------------------------------------------------------
+    def __call__(self, label, file_url, file_idx):
+        file_name = file_url.split('/')[-1]
+        empty_cutflow = {stage: 0 for stage in Config.cutflow_stages}
+        empty_weighted = {stage: 0.0 for stage in Config.cutflow_stages}
+
+        try:
+            state = self.setup()
+            for file_attempt in range(self.max_file_retries):
+                try:
+                    return self._process_file(state, label, file_url)
+                except (OSError, IOError, ValueError) as e:
+                    if file_attempt < self.max_file_retries - 1:
+                        print(f"  {label}/{file_name}: {type(e).__name__} - Retry {file_attempt+1}/{self.max_file_retries}")
+                        time.sleep(3)
+                        continue
+                    error_msg = f"{file_name}: {type(e).__name__} after {self.max_file_retries} attempts - {str(e)[:100]}"
+                    return label, {}, empty_cutflow, empty_weighted, error_msg
+        except Exception as e:
+            error_msg = f"{file_name}: {type(e).__name__} - {str(e)[:100]}"
+            return label, {}, empty_cutflow, empty_weighted, error_msg
+
+    def _process_file(self, state, label, file_url):
+        from .helper import load_events
+
+        is_data = (label == 'Data')
+        stage_histograms = state.new_histograms(label)
+        cutflow = {stage: 0 for stage in Config.cutflow_stages}
+        weighted_cutflow = {stage: 0.0 for stage in Config.cutflow_stages}
+        buffer = state.new_ntuple_buffer() if self.ntuple else None
+
+        scale = 1.0 if is_data else state.normalization(file_url)
+        for arrays in load_events(file_url, batch_size=self.batch_size, is_data=is_data):
+            self._process_chunk(state, arrays, is_data, scale, stage_histograms, cutflow,
+                                weighted_cutflow, buffer, file_url)
+
+        result = (label, stage_histograms, cutflow, weighted_cutflow, None)
+        if buffer is not None:
+            result += (buffer.to_extras(),)
+        return result
+
+    def _process_chunk(self, state, arrays, is_data, scale, stage_histograms, cutflow,
+                       weighted_cutflow, buffer, file_url):
+        from .weights import Weights
+        from .Efficiency_data import TRIGGER_SF_VAL, TRIGGER_SF_ERR
+        from .Physics_selection import select_tight_leptons, select_e_mu_events, count_jets, apply_bjet_selections
+        from .calculations import cal_kinematic_var, calculate_mjj
+        from .cut_registry import apply_selection
+        from .cutflow_utils import accumulate_cutflow
+        from .helper import fill_stage_histograms
+
+        cutflow['total'] += len(arrays)
+
+        # SCALING & TRIGGER SF (MC ONLY)
+        if is_data:
+            weights = Weights(np.ones(len(arrays)))
+        else:
+            weights = Weights(ak.to_numpy(arrays.genWeight) * scale)
+            weights.multiply(TRIGGER_SF_VAL, 'trigger', TRIGGER_SF_VAL + TRIGGER_SF_ERR, TRIGGER_SF_VAL - TRIGGER_SF_ERR)
+        weighted_cutflow['total'] += float(weights['nominal'].sum())
+
+        # JSON MASK (DATA ONLY)
+        if is_data and state.lumi_mask is not None:
+            try:
+                json_mask = state.lumi_mask(arrays)
+                n_events_after = int(ak.sum(json_mask))
+                cutflow['after_json'] += n_events_after
+                weighted_cutflow['after_json'] += float(weights['nominal'][ak.to_numpy(json_mask)].sum())
+                if n_events_after == 0:
+                    return
+                arrays = arrays[json_mask]
+                weights = weights.select(json_mask)
+            except Exception as e:
+                print(f"Warning: JSON mask failed for {file_url.split('/')[-1]}: {e}")
+
+        # LEPTON SELECTION
+        tight_leptons, _, _ = select_tight_leptons(arrays)
+        # The chunk index rides along with MET, so the selection of
+        # select_e_mu_events gives the indices of the selected events
+        met = ak.zip({"pt": arrays.PuppiMET_pt, "phi": arrays.PuppiMET_phi, "index": np.arange(len(arrays))})
+        leading, subleading, _, met_selected = select_e_mu_events(tight_leptons, met)
+        if leading is None or len(leading) == 0:
+            return
+
+        indices_emu = ak.to_numpy(met_selected.index)
+        weights = weights.select(indices_emu)
+
+        # LEPTON SCALE FACTORS (MC ONLY)
+        if not is_data:
+            is_lead_ele = ak.to_numpy(leading.flavor == 11)
+            ele_pt = np.where(is_lead_ele, ak.to_numpy(leading.pt), ak.to_numpy(subleading.pt))
+            ele_eta = np.where(is_lead_ele, ak.to_numpy(leading.eta), ak.to_numpy(subleading.eta))
+            mu_pt = np.where(is_lead_ele, ak.to_numpy(subleading.pt), ak.to_numpy(leading.pt))
+            mu_eta = np.where(is_lead_ele, ak.to_numpy(subleading.eta), ak.to_numpy(leading.eta))
+
+            ele_sf, ele_err = state.electron_sf(ele_eta, ele_pt)
+            tight_sf, tight_err = state.muon_tight_sf(mu_eta, mu_pt)
+            iso_sf, iso_err = state.muon_iso_sf(mu_eta, mu_pt)
+
+            weights.multiply(ele_sf, 'ele_id', ele_sf + ele_err, ele_sf - ele_err)
+            weights.multiply(tight_sf * iso_sf, 'mu_id', (tight_sf + tight_err) * (iso_sf + iso_err),
+                             (tight_sf - tight_err) * (iso_sf - iso_err))
+
+        n_selected = len(leading)
+        nominal = weights['nominal']
+        accumulate_cutflow(cutflow, weighted_cutflow, 'e_mu_preselection', n_selected,
+                           float(nominal.sum()), float((nominal * nominal).sum()))
+
+        # KINEMATICS
+        masses, ptlls, dphis, mt_higgs, mt_l2_met = cal_kinematic_var(leading, subleading, met_selected)
+        n_jets, _, sorted_jets, isZeroJet, isOneJet, isTwoJet = count_jets(arrays, tight_leptons=tight_leptons)
+        mjj = ak.fill_none(calculate_mjj(sorted_jets)[indices_emu], 0.0)
+        _, bjet_info = apply_bjet_selections(arrays)
+
+        observables = {
+            'mass': masses, 'met': met_selected.pt, 'dphi': dphis, 'ptll': ptlls,
+            'mt_higgs': mt_higgs, 'mt_l2_met': mt_l2_met, 'mjj': mjj,
+            'leading_pt': leading.pt, 'subleading_pt': subleading.pt,
+        }
+        observables = {name: ak.to_numpy(values) for name, values in observables.items()}
+
+        # 'before_cuts' is filled before m_jj is known, so with m_jj = 0 (as in the notebook)
+        all_events = np.ones(n_selected, dtype=bool)
+        fill_stage_histograms(stage_histograms, 'before_cuts', all_events, weights,
+                              dict(observables, mjj=np.zeros(n_selected)))
+
+        # SELECTIONS: global cuts, jet bins, signal and control regions
+        evaluator = state.registry.evaluate({
+            'leading': leading, 'subleading': subleading, 'met': met_selected,
+            'masses': masses, 'ptlls': ptlls, 'mt_higgs': mt_higgs, 'mt_l2_met': mt_l2_met,
+            'isZeroJet': ak.to_numpy(isZeroJet[indices_emu]),
+            'isOneJet': ak.to_numpy(isOneJet[indices_emu]),
+            'isTwoJet': ak.to_numpy(isTwoJet[indices_emu]),
+            'bjet_info': {key: ak.to_numpy(value[indices_emu]) for key, value in bjet_info.items()},
+            'mjj': mjj,
+        })
+        apply_selection(evaluator, stage_histograms, weights, observables, cutflow, weighted_cutflow,
+                        stage_names=state.selection_stages)
+
+        if buffer is not None:
+            stage_masks = evaluator.masks(state.selection_stages)
+            stage_masks['before_cuts'] = all_events
+            buffer.append(observables, weights, stage_masks)
+
+def _warm_up_chunk(is_data):
+    """Two events with the columns of helper.load_events: one e-mu pair with two jets, one empty."""
+    columns = {
+        "Electron_pt": [[45.0], []], "Electron_eta": [[0.5], []], "Electron_phi": [[0.1], []],
+        "Electron_mass": [[0.0], []], "Electron_mvaFall17V2Iso_WP90": [[True], []], "Electron_charge": [[-1], []],
+        "Muon_pt": [[30.0], []], "Muon_eta": [[-1.0], []], "Muon_phi": [[2.5], []], "Muon_mass": [[0.106], []],
+        "Muon_tightId": [[True], []], "Muon_charge": [[1], []], "Muon_pfRelIso04_all": [[0.05], []],
+        "PuppiMET_pt": [40.0, 10.0], "PuppiMET_phi": [-1.0, 0.0],
+        "Jet_pt": [[60.0, 35.0], []], "Jet_eta": [[1.2, -2.0], []], "Jet_phi": [[-2.0, 1.0], []],
+        "Jet_mass": [[8.0, 5.0], []], "Jet_btagDeepFlavB": [[0.1, 0.5], []], "nJet": [2, 0],
+        "Jet_jetId": [[6, 6], []], "Jet_puId": [[7, 7], []],
+    }
+    if is_data:
+        columns.update({"run": [278820, 278820], "luminosityBlock": [1, 1]})
+    else:
+        columns["genWeight"] = [1.0, 1.0]
+    return ak.Array(columns)
+
+# =========================================================
+# WORKER STATE
+# =========================================================
+
+class _WorkerState:
+    """Heavy state of a Processor, built by `_build_state` in each worker."""
+
+    def new_histograms(self, label):
+        """Empty one-sample store of the booked histograms (a fresh one, it leaves with the result)."""
+        return self.template.empty_like([label])
+
+    def new_ntuple_buffer(self):
+        from .ntuple import NtupleBuffer
+        return NtupleBuffer()
+
+    def normalization(self, file_url):
+        """xsec * lumi / sum of genWeight of the file's sample (0 for an unknown sample)."""
+        from .helper import get_sample_key
+        return self.scales.get(get_sample_key(file_url), 0.0)
+
+def _resolve(value):
+    # dask_utils (and Dask) is only imported once an Artifact exists
+    dask_utils = sys.modules.get(__package__ + ".dask_utils")
+    return dask_utils.resolve(value) if dask_utils is not None else value
+
+def _build_state(processor):
+    import vector
+    from .Efficiency_data import ELECTRON_SF_DATA, MUON_TIGHT_DATA, MUON_ISO_DATA
+    from .Plots_config import variables_to_plots
+    from .cut_registry import default_cut_registry
+    from .helper import SFLookup
+    from .histogram_store import HistogramStore
+    from .json_validation import LumiMask
+
+    vector.register_awkward()
+    state = _WorkerState()
+
+    # Lumi mask and scale factor tables
+    state.lumi_mask = None
+    if processor.golden_json is not None:
+        state.lumi_mask = LumiMask(_resolve(processor.golden_json), run_periods=processor.run_periods)
+    state.electron_sf = SFLookup(ELECTRON_SF_DATA)
+    state.muon_tight_sf = SFLookup(MUON_TIGHT_DATA)
+    state.muon_iso_sf = SFLookup(MUON_ISO_DATA)
+
+    # Normalization of every sample
+    if processor.luminosity is None or processor.sample_info is None:
+        from . import cross_section
+    luminosity = processor.luminosity if processor.luminosity is not None else cross_section.LUMINOSITY
+    sample_info = _resolve(processor.sample_info) if processor.sample_info is not None else cross_section.sample_info_detailed
+    state.scales = {
+        key: info['xsec'] * luminosity / info['sum_genWeight'] for key, info in sample_info.items()
+    }
+
+    # Histogram template: a one-sample store with the labels of the merged
+    # store of execute_analysis, so a result is merged with one addition per variable
+    state.template = HistogramStore([None], processor.stage_names, variables_to_plots, Config.VARIATIONS,
+                                    booking=processor.booking)
+
+    # Stages of the selection bitmask; 'before_cuts' is filled separately and
+    # the N-1 stages of the booking by apply_selection (see Processor._process_chunk)
+    state.registry = default_cut_registry()
+    state.selection_stages = [stage for stage in Config.stage_names if stage != 'before_cuts']
+    return state
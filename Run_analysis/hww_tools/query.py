@@ -0,0 +1,382 @@
+"""
+query.py
+
+This module answers questions about the saved event ntuples (see ntuple.py)
+without rerunning the Dask job, e.g. "SR_0jet yields if mt_higgs > 80" or
+"mass in 40 bins".
+
+`NtupleQuery` memory-maps the per-sample ntuples and splits them into
+partitions of at most `chunk_size` events, which are evaluated in parallel
+threads (NumPy releases the GIL in the heavy loops). A cut is a string
+expression over:
+- The observables: `mass`, `met`, `dphi`, `ptll`, `mt_higgs`, `mt_l2_met`,
+  `mjj`, `leading_pt`, `subleading_pt`.
+- The weight columns: `weight_nominal`, `weight_trigger_up`, ...
+- The stages and regions passed by the event: `SR_0jet`, `CR_top_1jet`, ...
+  or `stage('0jet')` for names that are not valid identifiers (`global`).
+combined with comparisons, `&`, `|`, `~` (or `and`, `or`, `not`), chained
+comparisons such as `40 < mass < 80`, and the functions in `FUNCTIONS`.
+
+The results are `hist` objects in the usual {sample: {stage: {var: {syst}}}}
+layout (usable by `plotting.create_stacked_plots`), HistogramStores, yields,
+and cutflows in the format of `cutflow_utils.save_cutflows`.
+"""
+
+import ast
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import Config
+from .histogram_store import bin_indices
+from .ntuple import list_units, read_unit, weight_column, BITS_COLUMN
+
+# Functions available inside cut expressions
+FUNCTIONS = {
+    'abs': np.abs, 'sqrt': np.sqrt, 'log': np.log, 'exp': np.exp,
+    'cos': np.cos, 'sin': np.sin, 'minimum': np.minimum, 'maximum': np.maximum,
+    'where': np.where, 'pi': np.pi,
+}
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name,
+    ast.Load, ast.Constant, ast.BitAnd, ast.BitOr, ast.BitXor, ast.Invert, ast.USub,
+    ast.UAdd, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+    ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq,
+)
+
+# ==============================================================================
+# CUT EXPRESSIONS
+# ==============================================================================
+
+class _ElementwiseLogic(ast.NodeTransformer):
+    """Rewrites and/or/not and chained comparisons into element-wise &, |, ~."""
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = ast.BinOp(left=result, op=op, right=value)
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        parts = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            parts.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        result = parts[0]
+        for part in parts[1:]:
+            result = ast.BinOp(left=result, op=ast.BitAnd(), right=part)
+        return result
+
+def compile_cut(expression):
+    """
+    Compiles a cut expression after checking that it only uses comparisons,
+    arithmetic, logic, names and the whitelisted function calls.
+
+    Raises
+    ------
+    ValueError
+        If the expression contains anything else (attributes, subscripts, ...).
+    """
+    tree = _ElementwiseLogic().visit(ast.parse(expression, mode='eval'))
+    ast.fix_missing_locations(tree)
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError(f"Unsupported syntax in cut '{expression}': {type(node).__name__}")
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name)
+                                               and (node.func.id in FUNCTIONS or node.func.id == 'stage')):
+            raise ValueError(f"Unsupported function in cut '{expression}'")
+    return compile(tree, f"<cut: {expression}>", 'eval')
+
+class _Namespace(dict):
+    """Name lookup for one partition: columns are sliced and stage masks built on demand."""
+
+    def __init__(self, sample, data, stage_names, start, stop):
+        super().__init__()
+        self.sample = sample
+        self._data = data
+        self._stage_names = stage_names
+        self._slice = slice(start, stop)
+
+    def stage(self, name):
+        if name not in self._stage_names:
+            raise KeyError(f"Unknown stage '{name}'")
+        bit = np.uint32(1 << self._stage_names.index(name))
+        return (self._data[BITS_COLUMN][self._slice] & bit) != 0
+
+    def __missing__(self, name):
+        if name == 'stage':
+            value = self.stage
+        elif name in FUNCTIONS:
+            value = FUNCTIONS[name]
+        elif name in self._data:
+            value = np.asarray(self._data[name][self._slice])
+        elif name in self._stage_names:
+            value = self.stage(name)
+        else:
+            raise NameError(f"Unknown name '{name}' in cut (not a column, stage or function)")
+        self[name] = value
+        return value
+
+# ==============================================================================
+# QUERY ENGINE
+# ==============================================================================
+
+class NtupleQuery:
+    """
+    Vectorized, multi-threaded queries over the ntuples of `execute_analysis`.
+
+    Parameters
+    ----------
+    ntuple_dir : str or pathlib.Path
+        Root directory of the ntuples.
+    samples : list of str, optional
+        Samples to include. Defaults to every sample found.
+    n_threads : int, optional
+        Worker threads. Defaults to the number of CPUs.
+    chunk_size : int, optional
+        Maximum number of events per partition. Defaults to 2,000,000.
+    """
+
+    def __init__(self, ntuple_dir, samples=None, n_threads=None, chunk_size=2_000_000):
+        self.ntuple_dir = ntuple_dir
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._cuts = {}
+
+        # Open every unit once (memory-mapped) and split it into partitions
+        self.partitions = []
+        units = list_units(ntuple_dir, samples)
+        self.samples = list(units)
+        for sample, unit_dirs in units.items():
+            for unit_dir in unit_dirs:
+                meta, data = read_unit(unit_dir)
+                for start in range(0, meta['n_events'], chunk_size):
+                    stop = min(start + chunk_size, meta['n_events'])
+                    self.partitions.append((sample, meta, data, start, stop))
+
+    @property
+    def n_events(self):
+        return sum(stop - start for _, _, _, start, stop in self.partitions)
+
+    def _compiled(self, cut):
+        if cut not in self._cuts:
+            self._cuts[cut] = compile_cut(cut)
+        return self._cuts[cut]
+
+    def _mask(self, namespace, cut, stage):
+        """Boolean mask of a partition for a cut expression and/or a stage."""
+        mask = None
+        if stage is not None:
+            mask = namespace.stage(stage)
+        if cut is not None:
+            passed = eval(self._compiled(cut), {'__builtins__': {}}, namespace)
+            passed = np.broadcast_to(np.asarray(passed, dtype=bool), (namespace._slice.stop - namespace._slice.start,))
+            mask = passed if mask is None else mask & passed
+        return mask
+
+    def _map(self, func):
+        """Runs func(namespace) on every partition and groups the results by sample."""
+        def run(partition):
+            sample, meta, data, start, stop = partition
+            return sample, func(_Namespace(sample, data, meta['stage_names'], start, stop))
+
+        results = {sample: [] for sample in self.samples}
+        if self.n_threads == 1 or len(self.partitions) <= 1:
+            outputs = map(run, self.partitions)
+        else:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                outputs = list(pool.map(run, self.partitions))
+        for sample, output in outputs:
+            results[sample].append(output)
+        return results
+
+    def map_partitions(self, func):
+        """
+        Runs `func(namespace)` on every partition in parallel and returns 
+        {sample: [outputs]}. The namespace gives the partition's columns and 
+        stage masks by name (`ns['mass']`, `ns.stage('0jet')`) and its `sample`.
+        """
+        return self._map(func)
+
+    def mask(self, namespace, cut=None, stage=None):
+        """Boolean mask of a partition for a cut expression and/or a stage (None if neither)."""
+        return self._mask(namespace, cut, stage)
+
+    # ---------------------------------------------------------
+    # Yields and cutflows
+    # ---------------------------------------------------------
+    def yields(self, cut=None, stage=None, variations=('nominal',)):
+        """
+        Event counts and weighted yields passing a cut.
+
+        Returns
+        -------
+        dict
+            {sample: {'events': int, variation: (sumw, sumw2), ...}}
+        """
+        def partial(ns):
+            mask = self._mask(ns, cut, stage)
+            out = {'events': int(np.count_nonzero(mask)) if mask is not None else len(ns[weight_column('nominal')])}
+            for syst in variations:
+                w = ns[weight_column(syst)].astype(np.float64)
+                if mask is not None:
+                    w = w[mask]
+                out[syst] = (float(np.sum(w)), float(np.sum(w * w)))
+            return out
+
+        totals = {}
+        for sample, parts in self._map(partial).items():
+            total = {'events': sum(p['events'] for p in parts)}
+            for syst in variations:
+                total[syst] = (sum(p[syst][0] for p in parts), sum(p[syst][1] for p in parts))
+            totals[sample] = total
+        return totals
+
+    def cutflow(self, steps, stage=None):
+        """
+        Sequential cutflow: every step is applied on top of the previous ones.
+
+        Parameters
+        ----------
+        steps : list of (name, expression)
+            Ordered cut steps. An expression of None keeps all events.
+        stage : str, optional
+            Stage or region all steps start from. Defaults to every saved event.
+
+        Returns
+        -------
+        cutflow, weighted_cutflow : dict
+            {sample: {step name: value}}, the format of cutflow_utils.save_cutflows
+            (pass `stage_info=[(name, name) for name, _ in steps]` to it).
+        """
+        def partial(ns):
+            mask = self._mask(ns, None, stage)
+            w = ns[weight_column('nominal')].astype(np.float64)
+            if mask is None:
+                mask = np.ones(len(w), dtype=bool)
+            counts, weighted = [], []
+            for _, expression in steps:
+                if expression is not None:
+                    mask = mask & self._mask(ns, expression, None)
+                counts.append(int(np.count_nonzero(mask)))
+                weighted.append(float(np.sum(w[mask])))
+            return counts, weighted
+
+        cutflow, weighted_cutflow = {}, {}
+        for sample, parts in self._map(partial).items():
+            cutflow[sample] = {name: sum(p[0][i] for p in parts) for i, (name, _) in enumerate(steps)}
+            weighted_cutflow[sample] = {name: sum(p[1][i] for p in parts) for i, (name, _) in enumerate(steps)}
+        return cutflow, weighted_cutflow
+
+    # ---------------------------------------------------------
+    # Histograms
+    # ---------------------------------------------------------
+    def histograms(self, vars_dict=None, stages=None, cut=None, variations=None,
+                   booking=None, as_store=False):
+        """
+        Fills histograms for every requested stage, variable and variation.
+
+        Parameters
+        ----------
+        vars_dict : dict, optional
+            Variable name -> hist axis, e.g. {'mass': hist.axis.Regular(40, 0, 200, ...)}.
+            The observable is looked up by the variable name unless the axis
+            `name` is a column. Defaults to Plots_config.variables_to_plots.
+        stages : list of str, optional
+            Stages/regions to fill. Defaults to Config.stage_names.
+        cut : str, optional
+            Extra cut expression applied on top of every stage.
+        variations : list of str, optional
+            Defaults to Config.VARIATIONS.
+        booking : booking.HistogramBooking, optional
+            If given, only the booked histograms are filled.
+        as_store : bool, optional
+            Return a HistogramStore instead of the nested dictionary. Defaults to False.
+
+        Returns
+        -------
+        dict or histogram_store.HistogramStore
+            {sample: {stage: {var: {syst: hist.Hist}}}}
+        """
+        from .histogram_store import HistogramStore
+        from .Plots_config import variables_to_plots
+
+        vars_dict = vars_dict if vars_dict is not None else variables_to_plots
+        stages = list(stages if stages is not None else Config.stage_names)
+        variations = list(variations if variations is not None else Config.VARIATIONS)
+        store = HistogramStore(self.samples, stages, vars_dict, variations, booking=booking)
+
+        def partial(ns):
+            i = store.index('sample', ns.sample)
+            base = self._mask(ns, cut, None)
+            filled = {}
+            for j, stage in enumerate(stages):
+                if stage not in ns._stage_names:
+                    continue
+                mask = ns.stage(stage)
+                if base is not None:
+                    mask = mask & base
+                selected = np.nonzero(mask)[0]
+                if len(selected) == 0:
+                    continue
+
+                # Select the weights once per stage, they are shared by all variables
+                weights = {}
+                for k, syst in enumerate(variations):
+                    w = ns[weight_column(syst)][selected].astype(np.float64)
+                    weights[k] = (w, w * w)
+
+                for var, axis in vars_dict.items():
+                    booked_k = [k for k in weights if store.booked[var][i, j, k]]
+                    if not booked_k:
+                        continue
+                    column = var if var in ns._data else axis.name
+                    idx = bin_indices(ns[column][selected], axis)
+                    n_flow = len(axis) + 2
+                    for k in booked_k:
+                        w, w2 = weights[k]
+                        filled[(var, j, k)] = (np.bincount(idx, weights=w, minlength=n_flow),
+                                               np.bincount(idx, weights=w2, minlength=n_flow))
+            return filled
+
+        for sample, parts in self._map(partial).items():
+            i = store.index('sample', sample)
+            for filled in parts:
+                for (var, j, k), (sumw, sumw2) in filled.items():
+                    store.sumw[var][i, j, k] += sumw
+                    store.sumw2[var][i, j, k] += sumw2
+
+        return store if as_store else store.to_dict()
+
+    def histogram(self, var, axis=None, stage=None, cut=None, variations=('nominal',)):
+        """
+        One variable at one stage, e.g. histogram('mass', hist.axis.Regular(40, 0, 200), 'SR_0jet').
+
+        Returns
+        -------
+        dict
+            {sample: {variation: hist.Hist}}
+        """
+        if axis is None:
+            from .Plots_config import variables_to_plots
+            axis = variables_to_plots[var]
+        stage = stage if stage is not None else 'before_cuts'
+        hists = self.histograms({var: axis}, [stage], cut=cut, variations=list(variations))
+        return {sample: stages.get(stage, {}).get(var, {}) for sample, stages in hists.items()}
+
+    def __repr__(self):
+        return f"<NtupleQuery: {len(self.samples)} samples, {len(self.partitions)} partitions, {self.n_events:,} events>"
@@ -0,0 +1,260 @@
+"""
+result_cache.py
+
+This module provides a content-addressed cache for per-file processing results.
+
+Reprocessing all NanoAOD files takes hours, but most reruns only change a
+plotting setting or add a sample. Each work unit (one file, or an entry range
+of a file) is therefore stored on disk under a key built from:
+- The file URL and the entry range.
+- A hash of the source code that runs inside a task (PROCESSING_SOURCES:
+  the selection, weight, filling and processor code, not the driver, I/O or
+  plotting code) and, if available, of the processor itself.
+- A hash of the configuration that shapes the output: stages, cutflow stages,
+  N-1 regions and variables, systematic variations, run periods, histogram
+  binning, scale factor tables and cross sections.
+
+Changing any of these produces new keys, so stale entries are never served;
+they are simply evicted later by size or age.
+"""
+
+import ast
+import hashlib
+import inspect
+import os
+import pickle
+import time
+from pathlib import Path
+
+from .checkpoint import atomic_write_bytes
+
+# Source that runs inside a processing task: module -> None for the whole
+# module, or the top-level functions, classes and constants the task uses
+# (the rest of those modules is driver, I/O or plotting code). Config,
+# Plots_config, Efficiency_data and cross_section only contribute values,
+# which hash_configuration() captures, so a plot setting never changes the key.
+PROCESSING_SOURCES = {
+    "Physics_selection": None,
+    "calculations": None,
+    "cuts": None,
+    "cut_registry": None,
+    "weights": None,
+    "json_validation": None,
+    "booking": None,
+    "processor": None,
+    "helper": [
+        "load_events", "initialize_stage_histograms", "booked_histograms", "_histogram_axis",
+        "_add_binned", "fill_stage_histograms", "fill_histograms_from_bitmask", "_consecutive_runs",
+        "get_sf_with_uncertainty", "SFLookup", "get_sample_key",
+    ],
+    "histogram_store": ["bin_indices", "HistogramStore"],
+    "cutflow_utils": ["SUMW2_SUFFIX", "REGION_CUT_SEPARATOR", "region_cut_key", "accumulate_cutflow"],
+    "ntuple": ["NTUPLE_VERSION", "BITS_COLUMN", "weight_column", "NtupleBuffer"],
+}
+
+def _top_level_sources(source, names):
+    """Source text of the top-level definitions of `names` in a module, in the order of `names`."""
+    tree = ast.parse(source)
+    segments = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined = [node.name]
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            defined = [n.id for target in targets for n in ast.walk(target) if isinstance(n, ast.Name)]
+        else:
+            continue
+        for name in defined:
+            segments[name] = ast.get_source_segment(source, node)
+    missing = [name for name in names if name not in segments]
+    if missing:
+        raise KeyError(f"PROCESSING_SOURCES lists names that are not defined: {missing}")
+    return [segments[name] for name in names]
+
+def hash_source_modules(sources=None):
+    """
+    Returns a SHA-256 hex digest of the source code of the given `hww_tools` modules.
+
+    Parameters
+    ----------
+    sources : dict or list of str, optional
+        Module name -> None (whole module) or list of top-level names, as in
+        PROCESSING_SOURCES; a list of module names hashes whole modules.
+        Defaults to PROCESSING_SOURCES.
+    """
+    if sources is None:
+        sources = PROCESSING_SOURCES
+    if not isinstance(sources, dict):
+        sources = dict.fromkeys(sources)
+
+    package_dir = Path(__file__).resolve().parent
+    digest = hashlib.sha256()
+    for module in sorted(sources):
+        source = (package_dir / f"{module}.py").read_text()
+        digest.update(module.encode())
+        if sources[module] is None:
+            digest.update(source.encode())
+            continue
+        for name, segment in zip(sources[module], _top_level_sources(source, sources[module])):
+            digest.update(name.encode())
+            digest.update(segment.encode())
+    return digest.hexdigest()
+
+def hash_configuration():
+    """
+    Returns a SHA-256 hex digest of every configuration value that changes
+    what a processing task produces.
+    """
+    from . import Config, Plots_config, Efficiency_data, cross_section
+
+    # Axes are reduced to their name and bin edges, which fully define the binning
+    axes = {
+        name: (axis.name, [float(edge) for edge in axis.edges])
+        for name, axis in Plots_config.variables_to_plots.items()
+    }
+    sf_tables = {
+        name: value for name, value in vars(Efficiency_data).items()
+        if name.isupper()
+    }
+    payload = repr((
+        Config.stage_names,
+        Config.cutflow_stages,
+        Config.n_minus_one_regions,
+        sorted(Config.n_minus_one_variables.items()),
+        Config.VARIATIONS,
+        sorted(Config.RUN_PERIODS_2016.items()),
+        sorted(axes.items()),
+        sorted(sf_tables.items()),
+        cross_section.LUMINOSITY,
+        sorted(cross_section.sample_info_detailed.items()),
+    ))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def hash_callable(func):
+    """
+    Returns a SHA-256 hex digest identifying the code of `func`.
+
+    Uses the source text when it can be found (this works for functions defined
+    in notebook cells), otherwise falls back to the compiled bytecode and constants.
+    Objects with a `cache_token()` method (processor.Processor) provide their own.
+    """
+    cache_token = getattr(func, "cache_token", None)
+    if callable(cache_token):
+        return hashlib.sha256(cache_token().encode()).hexdigest()
+    try:
+        payload = inspect.getsource(func).encode()
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        if code is None:
+            return hashlib.sha256(repr(func).encode()).hexdigest()
+        payload = code.co_code + repr(code.co_consts).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+def processing_hash(processing_task=None):
+    """
+    Returns a SHA-256 hex digest of everything that defines the content of a
+    processing result: the task code (hash_source_modules), the configuration
+    values (hash_configuration) and, if given, the processing task itself
+    (hash_callable). Shared by the cache keys and manifest.compute_run_hash.
+    """
+    parts = [hash_source_modules(), hash_configuration()]
+    if processing_task is not None:
+        parts.append(hash_callable(processing_task))
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+class ResultCache:
+    """
+    On-disk cache of per-work-unit processing results.
+
+    Parameters
+    ----------
+    cache_dir : str or pathlib.Path
+        Directory holding the cache entries.
+    processing_task : callable, optional
+        The processor function. Its code is folded into every key, so editing
+        the event loop invalidates the cache.
+    max_bytes : int, optional
+        Maximum total size of the cache. Least recently used entries are
+        evicted first. Defaults to None (no limit).
+    max_age : float, optional
+        Entries not used for this many seconds are evicted. Defaults to None.
+    """
+
+    def __init__(self, cache_dir, processing_task=None, max_bytes=None, max_age=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.code_config_hash = processing_hash(processing_task)
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, label, file_url, entry_range=None):
+        """Builds the cache key of one work unit."""
+        start, stop = entry_range if entry_range is not None else (None, None)
+        payload = f"{label}|{file_url}|{start}|{stop}|{self.code_config_hash}"
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.pkl"
+
+    def __contains__(self, key):
+        return self._path(key).exists()
+
+    def get(self, key):
+        """Returns the cached result for `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        # Refresh the modification time so eviction treats it as recently used
+        os.utime(path)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Stores a processing result under `key`."""
+        payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        atomic_write_bytes(self._path(key), payload)
+
+    def evict(self):
+        """
+        Removes entries older than `max_age` and, if the cache is still larger
+        than `max_bytes`, the least recently used entries until it fits.
+
+        Returns
+        -------
+        int
+            The number of removed entries.
+        """
+        now = time.time()
+        entries = []
+        for path in self.cache_dir.glob("*/*.pkl"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        removed = 0
+        kept = []
+        for mtime, size, path in entries:
+            if self.max_age is not None and now - mtime > self.max_age:
+                path.unlink(missing_ok=True)
+                removed += 1
+            else:
+                kept.append((mtime, size, path))
+
+        if self.max_bytes is not None:
+            total = sum(size for _, size, _ in kept)
+            for mtime, size, path in sorted(kept):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                removed += 1
+
+        return removed
@@ -0,0 +1,403 @@
+"""
+root_io.py
+
+This module handles writing the histogram output to ROOT files.
+
+The original output stored ~6,000 histograms in one flat namespace
+(`Sample_Stage_Variable_Variation`), one key at a time and with the uproot
+default compression. This writer instead:
+- Stores histograms in a directory hierarchy: `sample/stage/variable/variation`.
+- Writes each variable directory in one batched `update` call.
+- Uses a configurable compression algorithm and level (ZSTD by default).
+- Can write every sample to its own file in parallel, together with a small
+  JSON index that maps samples to files.
+
+The flat layout is still available (`layout="flat"`) for tools expecting the
+old key names, and `find_histogram_key` resolves a histogram in either layout.
+
+For reading, `LazyHistograms` gives the usual nested-dictionary interface but
+only lists keys up front and deserialises each histogram on first access.
+"""
+
+import json
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import uproot
+
+LAYOUTS = ("hierarchical", "flat")
+
+# Initial size of each TDirectory key list. Big enough for the keys of one 
+# variable directory (seven variations), so directories are not relocated.
+DIRECTORY_BYTES = 1024
+
+COMPRESSION_ALGORITHMS = {
+    "ZSTD": uproot.ZSTD,
+    "LZ4": uproot.LZ4,
+    "ZLIB": uproot.ZLIB,
+    "LZMA": uproot.LZMA,
+}
+
+def _flat_part(name):
+    return name.replace(" ", "_").replace("-", "_")
+
+def flat_histogram_name(sample, stage, variable, variation):
+    """Key of a histogram in the flat layout: Sample_Stage_Variable_Variation."""
+    return _flat_part(f"{sample}_{stage}_{variable}_{variation}")
+
+def _split_flat_key(key, parts):
+    """
+    Splits a flat key into (sample, (variation, variable, stage)) using the
+    candidate [(flat spelling, name)] lists of `parts`, or returns None.
+    """
+    if not parts:
+        return key, ()
+    for flat, name in parts[0]:
+        if key.endswith("_" + flat) and len(key) > len(flat) + 1:
+            match = _split_flat_key(key[:-len(flat) - 1], parts[1:])
+            if match is not None:
+                return match[0], (name,) + match[1]
+    return None
+
+def histogram_key(sample, stage, variable, variation, layout="hierarchical"):
+    """Key of a histogram inside the ROOT file for the given layout."""
+    if layout == "flat":
+        return flat_histogram_name(sample, stage, variable, variation)
+    if layout == "hierarchical":
+        return f"{sample}/{stage}/{variable}/{variation}"
+    raise ValueError(f"Unknown layout '{layout}', expected one of {LAYOUTS}")
+
+def find_histogram_key(root_file, sample, stage, variable, variation):
+    """
+    Returns the key of a histogram in an open ROOT file, whichever layout it
+    was written with, or None if it is not present.
+    """
+    for layout in LAYOUTS:
+        key = histogram_key(sample, stage, variable, variation, layout)
+        if key in root_file:
+            return key
+    return None
+
+def make_compression(algorithm="ZSTD", level=5):
+    """
+    Builds an uproot compression setting.
+
+    Parameters
+    ----------
+    algorithm : str or None
+        One of 'ZSTD', 'LZ4', 'ZLIB', 'LZMA', or None for no compression.
+    level : int
+        Compression level passed to the algorithm.
+    """
+    if algorithm is None:
+        return None
+    try:
+        return COMPRESSION_ALGORITHMS[algorithm.upper()](level)
+    except KeyError:
+        raise ValueError(f"Unknown compression '{algorithm}', expected one of {list(COMPRESSION_ALGORITHMS)}")
+
+def _write_samples(hist_data, output_path, layout, compression, level):
+    """
+    Writes the given samples into one ROOT file.
+
+    In the hierarchical layout every variable directory is created once and 
+    all its variations are written with a single batched `update`, so the 
+    directory index is written once instead of once per histogram. The 
+    directories are preallocated large enough for their keys, which avoids 
+    relocating them while they fill up.
+    """
+    n_written = 0
+    with uproot.recreate(output_path, compression=make_compression(compression, level),
+                         initial_directory_bytes=DIRECTORY_BYTES) as root_file:
+        for sample, stages in hist_data.items():
+            if layout == "flat":
+                root_file.update({
+                    flat_histogram_name(sample, stage, var_name, syst_name): hist_obj
+                    for stage, variables in stages.items()
+                    for var_name, variations in variables.items()
+                    for syst_name, hist_obj in variations.items()
+                })
+                n_written += sum(len(v) for variables in stages.values() for v in variables.values())
+                continue
+
+            sample_dir = root_file.mkdir(sample)
+            for stage, variables in stages.items():
+                stage_dir = sample_dir.mkdir(stage)
+                for var_name, variations in variables.items():
+                    stage_dir.mkdir(var_name).update(variations)
+                    n_written += len(variations)
+    return n_written
+
+def index_path_for(output_path):
+    """Path of the JSON index written next to per-sample output files."""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}_index.json")
+
+def write_histograms(hist_data, output_path, layout="hierarchical", compression="ZSTD",
+                     level=5, split_samples=False, n_workers=None):
+    """
+    Writes the nested {sample: {stage: {variable: {variation: Hist}}}} dictionary to ROOT.
+
+    Parameters
+    ----------
+    hist_data : dict
+        The nested histogram dictionary.
+    output_path : str or pathlib.Path
+        Destination ROOT file. With `split_samples`, this name is used as the
+        stem of the per-sample files and of the index file.
+    layout : str, optional
+        'hierarchical' (sample/stage/variable/variation) or 'flat'. Defaults to 'hierarchical'.
+    compression : str or None, optional
+        Compression algorithm ('ZSTD', 'LZ4', 'ZLIB', 'LZMA' or None). Defaults to 'ZSTD'.
+    level : int, optional
+        Compression level. Defaults to 5.
+    split_samples : bool, optional
+        If True, write each sample to its own file in parallel and an index
+        file listing them. Defaults to False.
+    n_workers : int, optional
+        Number of writer processes with `split_samples`. Defaults to one per sample.
+
+    Returns
+    -------
+    list of pathlib.Path
+        The ROOT files that were written.
+
+    Raises
+    ------
+    Any error raised while writing; nothing is silently ignored.
+    """
+    output_path = Path(output_path)
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout '{layout}', expected one of {LAYOUTS}")
+
+    if not split_samples:
+        _write_samples(hist_data, output_path, layout, compression, level)
+        # A leftover index from an earlier split write would shadow this file
+        index_path_for(output_path).unlink(missing_ok=True)
+        return [output_path]
+
+    sample_paths = {
+        sample: output_path.with_name(f"{output_path.stem}_{sample}{output_path.suffix}")
+        for sample in hist_data
+    }
+    n_workers = n_workers or max(1, len(sample_paths))
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [
+            pool.submit(_write_samples, {sample: hist_data[sample]}, path, layout, compression, level)
+            for sample, path in sample_paths.items()
+        ]
+        for future in futures:
+            future.result()
+
+    index = {
+        'layout': layout,
+        'samples': {sample: path.name for sample, path in sample_paths.items()},
+    }
+    with open(index_path_for(output_path), 'w') as f:
+        json.dump(index, f, indent=1)
+
+    return list(sample_paths.values())
+
+def resolve_sample_files(output_path):
+    """
+    Returns {sample: path} for per-sample outputs written with `split_samples`,
+    or None if `output_path` was written as a single file.
+    """
+    index_path = index_path_for(output_path)
+    if not index_path.exists():
+        return None
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    return {sample: index_path.with_name(name) for sample, name in index['samples'].items()}
+
+# ==============================================================================
+# LAZY READING
+# ==============================================================================
+
+class _LazyLevel(Mapping):
+    """Read-only mapping over one level of the {sample: {stage: {var: {syst}}}} index."""
+
+    def __init__(self, index, loader, depth):
+        self._index = index
+        self._loader = loader
+        self._depth = depth
+
+    def __getitem__(self, name):
+        entry = self._index[name]
+        if self._depth == 0:
+            return self._loader(*entry)
+        return _LazyLevel(entry, self._loader, self._depth - 1)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return f"<lazy histograms: {list(self._index)}>"
+
+class LazyHistograms(Mapping):
+    """
+    Lazy {sample: {stage: {variable: {variation: Hist}}}} view of a saved output.
+
+    Opening only lists keys: the top level of the file when it is opened, and a 
+    sample's subtree the first time that sample is accessed. A histogram is 
+    deserialised on first access and kept in an LRU cache, so opening the 
+    output for a single plot only reads the histograms that plot uses.
+
+    Works with the hierarchical and flat layouts, and with per-sample files 
+    written with `split_samples=True`. Use as a context manager, or call 
+    `close()`, to release the open files.
+
+    Parameters
+    ----------
+    root_file_path : str or pathlib.Path
+        Path of the output ROOT file (or the stem of per-sample files).
+    samples : list of str, optional
+        Restrict the view to these samples. Defaults to every sample found.
+    cache_size : int, optional
+        Number of deserialised histograms kept in memory. Defaults to 512.
+    """
+
+    def __init__(self, root_file_path, samples=None, cache_size=512):
+        path = Path(root_file_path)
+        self._path = path
+        sample_files = resolve_sample_files(path)
+        if sample_files is None:
+            if not path.exists():
+                raise FileNotFoundError(f"ROOT file not found at {path}")
+            self._files = {None: uproot.open(path)}
+            self._sample_files = None
+        else:
+            self._files = {sample: uproot.open(p) for sample, p in sample_files.items() if p.exists()}
+            self._sample_files = self._files
+
+        self._sample_index = {}
+        # Flat keys that could not be split into sample/stage/variable/variation
+        self.unindexed = []
+        self._samples = self._list_samples(samples)
+        self._read = lru_cache(maxsize=cache_size)(self._read_uncached)
+
+    # ---------------------------------------------------------
+    # Index
+    # ---------------------------------------------------------
+    def _file_for(self, sample):
+        if self._sample_files is None:
+            return self._files[None]
+        return self._sample_files[sample]
+
+    def _list_samples(self, samples):
+        if self._sample_files is not None:
+            found = list(self._sample_files)
+        else:
+            root_file = self._files[None]
+            top = root_file.classnames(recursive=False, cycle=False)
+            if any(cls == "TDirectory" for cls in top.values()):
+                found = [name for name, cls in top.items() if cls == "TDirectory"]
+            else:
+                # Flat layout: all keys live at the top level, index them in one pass
+                self._index_flat([key for key, cls in top.items() if cls.startswith("TH1")])
+                found = list(self._sample_index)
+                if self.unindexed:
+                    print(f"WARNING: {len(self.unindexed)} histograms of {self._path} do not match a known "
+                          f"stage, variable and variation and are skipped (e.g. '{self.unindexed[0]}').")
+        if samples is not None:
+            wanted = set(samples)
+            found = [s for s in found if s in wanted]
+        return found
+
+    def _index_flat(self, keys, sample_names=None):
+        """
+        Indexes the keys of a flat file. A flat name joins its parts with '_' 
+        and replaces '-' and ' ' (see flat_histogram_name), so each key is 
+        split by matching the known variations, variables and stages 
+        (including every N-1 stage of the cut registry) from the end; the 
+        rest is the sample, so samples outside Config.sample_order are found 
+        too (`sample_names` gives the original spelling of flattened sample 
+        names; Config.sample_order by default). Keys that do not match are 
+        listed in `self.unindexed`.
+        """
+        from . import Config
+        from .Plots_config import variables_to_plots
+        from .cut_registry import default_cut_registry, n_minus_one_stages
+
+        registry = default_cut_registry()
+        stages = list(Config.stage_names) + list(n_minus_one_stages(list(registry.regions), registry))
+        # Flat spelling -> name, longest first so that e.g. an N-1 stage wins over its region
+        parts = [
+            sorted(((_flat_part(name), name) for name in names), key=lambda item: -len(item[0]))
+            for names in (Config.VARIATIONS, variables_to_plots, stages)
+        ]
+        samples = {_flat_part(sample): sample for sample in (sample_names or Config.sample_order)}
+
+        for key in keys:
+            match = _split_flat_key(key, parts)
+            if match is None:
+                self.unindexed.append(key)
+                continue
+            sample, (syst, var, stage) = match
+            sample = samples.get(sample, sample)
+            self._sample_index.setdefault(sample, {}).setdefault(stage, {}).setdefault(var, {})[syst] = (sample, key)
+
+    def _index_sample(self, sample):
+        if sample not in self._sample_index:
+            root_file = self._file_for(sample)
+            top = root_file.classnames(recursive=False, cycle=False)
+            if top.get(sample) != "TDirectory":
+                # Per-sample file written with layout="flat"
+                self._index_flat([key for key, cls in top.items() if cls.startswith("TH1")], [sample])
+                return self._sample_index.setdefault(sample, {})
+            subtree = {}
+            classnames = root_file[sample].classnames(recursive=True, cycle=False)
+            for key, cls in classnames.items():
+                parts = key.split("/")
+                if len(parts) != 3 or not cls.startswith("TH1"):
+                    continue
+                stage, var, syst = parts
+                subtree.setdefault(stage, {}).setdefault(var, {})[syst] = (sample, f"{sample}/{key}")
+            self._sample_index[sample] = subtree
+        return self._sample_index[sample]
+
+    def _read_uncached(self, sample, key):
+        return self._file_for(sample)[key].to_hist()
+
+    # ---------------------------------------------------------
+    # Mapping interface
+    # ---------------------------------------------------------
+    def __getitem__(self, sample):
+        if sample not in self._samples:
+            raise KeyError(sample)
+        return _LazyLevel(self._index_sample(sample), self._read, depth=2)
+
+    def __iter__(self):
+        return iter(self._samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def arrays(self, sample, stage, variable, variation):
+        """
+        (sumw, sumw2, edges, axis) of one histogram, including the flow bins,
+        without building a Hist (not cached). Used to merge outputs quickly.
+        """
+        _, key = self._index_sample(sample)[stage][variable][variation]
+        model = self._file_for(sample)[key]
+        return model.values(flow=True), model.variances(flow=True), model.axis().edges(), model.axis()
+
+    def cache_info(self):
+        """Hits and misses of the histogram LRU cache."""
+        return self._read.cache_info()
+
+    def close(self):
+        for root_file in self._files.values():
+            root_file.close()
+        self._read.cache_clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
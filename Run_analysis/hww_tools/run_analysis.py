@@ -1,128 +1,447 @@
 """
 run_analysis.py
 
-This module handles the Dask distributed execution loop.
+This module handles the distributed execution loop.
 It takes the mapped processing task (defined in the main notebook) and 
 orchestrates the submission, gathering, merging, and saving of results.
+The tasks run on a Dask cluster or on a local process pool (see executors.py).
 """
 
 import os
 import time
 import gc
+from pathlib import Path
 from tqdm.auto import tqdm
-from dask.distributed import as_completed
 
 # Import local configurations
 from . import Config
 from . import Plots_config
 from . import helper
 from . import cutflow_utils
+from . import checkpoint as ckpt
+from . import manifest as manifest_utils
+from . import ntuple as ntuple_utils
+from . import scheduling
+from .root_io import resolve_sample_files
+from .dense_store import DENSE_STORE_NAME
+from .histogram_store import HistogramStore
+from .executors import as_executor, ProcessPoolExecutor, SerialExecutor, TaskStats
+from .shared_store import SharedHistogramStore
 
-def execute_analysis(client, files, processing_task):
+def _merge_result(result, hist_store, cutflow_final, weighted_cutflow_final):
     """
-    Executes the distributed analysis on the Dask cluster.
+    Adds one processing result into the merged accumulators in place.
+    The histograms of the result can be a nested dictionary or a HistogramStore.
+    """
+    label, stage_histograms, cutflow, weighted_cutflow, error = result[:5]
+
+    # Entries beyond Config.cutflow_stages (sums of squared weights, per-cut
+    # cutflows, see cutflow_utils.py) are created on first use
+    if cutflow:
+        for stage, count in cutflow.items():
+            cutflow_final[label][stage] = cutflow_final[label].get(stage, 0) + count
+
+    if weighted_cutflow:
+        for stage, count in weighted_cutflow.items():
+            weighted_cutflow_final[label][stage] = weighted_cutflow_final[label].get(stage, 0.0) + count
+
+    if isinstance(stage_histograms, HistogramStore):
+        hist_store += stage_histograms
+    elif stage_histograms:
+        hist_store.add(label, stage_histograms)
+
+def _write_extras(result, file_url, ntuple_dir, skip_existing=False):
+    """
+    Writes the ntuple carried in the optional sixth element of a processing 
+    result, `{'ntuple': ...}` (see ntuple.NtupleBuffer.to_extras).
+    """
+    if ntuple_dir is None or len(result) < 6 or not result[5]:
+        return
+    ntuple = result[5].get('ntuple')
+    if ntuple is None:
+        return
+    if skip_existing and ntuple_utils.ntuple_exists(ntuple_dir, result[0], file_url):
+        return
+    ntuple_utils.write_ntuple(ntuple_dir, result[0], file_url, ntuple)
+
+def _load_previous_outputs(files, run_hash, cache, booking=None, output_dir=None):
+    """
+    Restores the accumulators of the previous run for an incremental update.
+
+    Returns empty accumulators if there is no compatible previous output.
+    Files removed from `files` are subtracted using their cached result; a 
+    sample with a removed file that is not cached is reset so it gets 
+    reprocessed completely.
+    """
+    output_dir = Path(output_dir) if output_dir is not None else Config.OUTPUT_DIR
+    root_path = output_dir / "HWW_analysis_output.root"
+    previous = manifest_utils.load_manifest(output_dir)
+
+    if previous is None or not (root_path.exists() or resolve_sample_files(root_path)):
+        print("No previous outputs found, processing all files.")
+        return {}, {}, {}, set()
+    if previous['run_hash'] != run_hash:
+        print("Code or configuration changed since the last run, processing all files.")
+        return {}, {}, {}, set()
+
+    added, removed = manifest_utils.diff_manifest(previous, files)
+    kept_samples = [label for label in previous['cutflow'] if label in files]
+
+    stage_names = booking.stages if booking is not None else Config.stage_names
+    hist_data = helper.restore_histograms(
+        kept_samples, stage_names, Plots_config.variables_to_plots, Config.VARIATIONS, root_path,
+        booking=booking
+    )
+    cutflow = {label: previous['cutflow'][label] for label in kept_samples}
+    weighted_cutflow = {label: previous['weighted_cutflow'][label] for label in kept_samples}
+    completed = {
+        (label, url) for label, urls in previous['samples'].items()
+        if label in files for url in urls
+    }
+
+    for label, urls in removed.items():
+        if label not in files:
+            print(f"  {label}: sample removed from the file lists, dropping it.")
+            continue
+
+        cached = [cache.get(cache.key(label, url)) if cache is not None else None for url in urls]
+        if any(result is None for result in cached):
+            print(f"  {label}: {len(urls)} files removed without cached results, reprocessing the sample.")
+            del hist_data[label], cutflow[label], weighted_cutflow[label]
+            completed = {unit for unit in completed if unit[0] != label}
+            continue
+
+        for url, result in zip(urls, cached):
+            manifest_utils.subtract_result(result, hist_data, cutflow, weighted_cutflow)
+            completed.discard((label, url))
+        print(f"  {label}: subtracted {len(urls)} removed files.")
+
+    n_added = sum(len(urls) for urls in added.values())
+    print(f"Incremental update: {len(completed)} files unchanged, {n_added} files added.")
+    return hist_data, cutflow, weighted_cutflow, completed
+
+def _create_shared_store(executor, hist_store, booking, cache, checkpoint_path):
+    """
+    Allocates one shared histogram slot per worker for `shared_histograms=True`.
+    Returns None (results are merged normally) if the run cannot use them.
+    """
+    if not isinstance(executor, (ProcessPoolExecutor, SerialExecutor)):
+        print("Shared histograms need a local backend ('processes'), merging results normally.")
+        return None
+    if cache is not None or checkpoint_path is not None:
+        # Cached results and checkpoints need the histograms of every file
+        print("Shared histograms are not used with a result cache or checkpoints, merging results normally.")
+        return None
+    try:
+        shared = SharedHistogramStore.create(executor.n_workers, hist_store.samples, hist_store.stages,
+                                             hist_store.axes, hist_store.variations, booking=booking)
+    except MemoryError as e:
+        print(f"{e}, merging results normally.")
+        return None
+    print(f"Workers accumulate histograms in shared memory ({shared.n_slots} slots, {shared.nbytes / 1e6:.0f} MB).")
+    return shared
+
+def execute_analysis(client, files, processing_task, checkpoint_path=None,
+                     checkpoint_every=25, checkpoint_interval=300.0, resume=False,
+                     cache=None, incremental=False, booking=None, root_options=None,
+                     dense_store=True, ntuple_dir=None, max_in_flight='auto',
+                     memory_limit=None, shared_histograms=False, order='cost',
+                     speculate=3.0, output_dir=None):
+    """
+    Executes the distributed analysis on the Dask cluster or a local process pool.
     
     Parameters
     ----------
-    client : dask.distributed.Client
-        The active Dask client.
+    client : dask.distributed.Client, executors.Executor or str
+        The active Dask client, or any backend of executors.py. The strings 
+        'processes' (local process pool, one worker per CPU) and 'serial' 
+        (in the notebook process, for debugging) create the backend for this 
+        run only.
     files : dict
         Dictionary of sample labels and their file URLs.
-    processing_task : function
-        The processor function initialized by make_processor() in the notebook.
+    processing_task : processor.Processor or function
+        The event processor (or the function initialized by make_processor() 
+        in the notebook).
+    checkpoint_path : str or pathlib.Path, optional
+        If given, the merged accumulators and the set of completed files are 
+        saved here periodically by a background writer. Defaults to None (off).
+    checkpoint_every : int, optional
+        Checkpoint after this many merged results. Defaults to 25.
+    checkpoint_interval : float, optional
+        Checkpoint after this many seconds, whichever comes first. Defaults to 300.
+    resume : bool, optional
+        If True and a checkpoint exists at `checkpoint_path`, restart from it and 
+        only submit the files that were not completed yet (including the files 
+        that failed; only the failures of this run are reported). The outputs 
+        match an uninterrupted run up to the rounding of the sums, since results 
+        are merged in completion order. Defaults to False.
+    cache : result_cache.ResultCache, optional
+        If given, files with a cached result are merged without being processed,
+        and every newly processed file is added to the cache. Defaults to None.
+    incremental : bool, optional
+        If True, start from the existing outputs and their manifest, process only 
+        the files added since the last run and subtract removed ones. Removed 
+        files can only be subtracted if their result is in `cache`; otherwise 
+        their sample is reprocessed. Defaults to False.
+    booking : booking.HistogramBooking, optional
+        Histograms to allocate for the merged output. Must match the booking 
+        used by the processor. Defaults to None (every histogram).
+    root_options : dict, optional
+        Keyword arguments for helper.save_root_file (layout, compression, level, 
+        split_samples). Defaults to None (hierarchical layout, ZSTD level 5).
+    dense_store : bool, optional
+        If True, also write the memory-mappable dense histogram store 
+        (see dense_store.py) next to the ROOT file. Defaults to True.
+    ntuple_dir : str or pathlib.Path, optional
+        If given, the event ntuples returned by the processor (the optional 
+        sixth `extras` element of its result, see ntuple.py) are written here, 
+        one directory per sample and file. Units of files that are no longer 
+        part of the outputs are removed. Defaults to None (off).
+    max_in_flight : int, 'auto' or None, optional
+        Maximum number of files submitted at the same time; the next files are 
+        submitted as results are merged, so the results waiting to be merged 
+        never pile up. 'auto' is two files per worker thread or process. 
+        None submits every file at once. Defaults to 'auto'.
+    memory_limit : float, optional
+        Resident memory of the notebook process (bytes, e.g. 16e9) above 
+        which no new files are submitted until it goes back down. 
+        Defaults to None (off).
+    shared_histograms : bool, optional
+        Local process pool only: every worker adds its histograms into its own 
+        slot of a shared memory block and only the cutflows are sent back; the 
+        slots are summed once at the end (see shared_store.py). Not used with 
+        `cache` or `checkpoint_path`. Failed tasks are not retried, and a task 
+        lost to an exception (e.g., a worker process killed) aborts the run 
+        with a RuntimeError. Defaults to False.
+    order : str or None, optional
+        'cost' submits the files by decreasing expected cost (task time of 
+        the previous runs, else file size, see scheduling.py) so the largest 
+        files do not start last. None keeps the order of `files`. 
+        Defaults to 'cost'.
+    speculate : float or None, optional
+        A file running longer than this multiple of the median task time of 
+        its sample gets a second copy, and whichever copy finishes first is 
+        used. Not used with `shared_histograms`. None disables it. 
+        Defaults to 3.0.
+    output_dir : str or pathlib.Path, optional
+        Directory of the outputs (ROOT file, dense store, cutflows, manifest, 
+        task timings). Defaults to None (Config.OUTPUT_DIR).
         
     Returns
     -------
     hist_data_final, cutflow_final, weighted_cutflow_final
     """
+    output_dir = Path(output_dir) if output_dir is not None else Config.OUTPUT_DIR
+
     print("\n" + "="*70)
     print("PROCESSING START!! ")
-    print(f"Output Directory: {Config.OUTPUT_DIR}")
+    print(f"Output Directory: {output_dir}")
     print("="*70)
 
     # 1. PREPARE ACCUMULATORS
     print("Initializing storage...")
-    stage_names = Config.stage_names
+    # A booking may add stages, e.g. the N-1 stages of request_n_minus_one()
+    stage_names = booking.stages if booking is not None else Config.stage_names
     cutflow_stages = Config.cutflow_stages
     VARIATIONS = Config.VARIATIONS
     variables_to_plots = Plots_config.variables_to_plots
 
-    hist_data_final = {}
+    previous_hists = None
     cutflow_final = {}
     weighted_cutflow_final = {}
 
+    completed = set()
+    error_count = 0
+
+    if resume and checkpoint_path is not None:
+        state = ckpt.load_checkpoint(checkpoint_path)
+        if state is not None:
+            previous_hists = state['hist_data']
+            cutflow_final = state['cutflow']
+            weighted_cutflow_final = state['weighted_cutflow']
+            completed = state['completed']
+            print(f"Resuming from checkpoint: {len(completed)} files already merged.")
+        else:
+            print(f"No checkpoint found at {checkpoint_path}, starting fresh.")
+
+    run_hash = manifest_utils.compute_run_hash(processing_task)
+    if incremental and not completed:
+        previous_hists, cutflow_final, weighted_cutflow_final, completed = _load_previous_outputs(
+            files, run_hash, cache, booking, output_dir
+        )
+
+    # All histograms are merged into one dense store, starting from the 
+    # checkpoint or previous outputs (older checkpoints hold a nested dictionary)
+    if previous_hists and not isinstance(previous_hists, HistogramStore):
+        previous_hists = HistogramStore.from_dict(previous_hists, stage_names, VARIATIONS)
+    extra_samples = [s for s in previous_hists.samples if s not in files] if previous_hists else []
+    hist_store = HistogramStore(list(files) + extra_samples, stage_names, variables_to_plots, VARIATIONS, booking=booking)
+    if previous_hists:
+        hist_store += previous_hists
+    previous_hists = None
+
     for label in files.keys():
-        hist_data_final[label] = helper.initialize_stage_histograms(stage_names, variables_to_plots, VARIATIONS)
+        if label in cutflow_final:
+            continue
         cutflow_final[label] = {stage: 0 for stage in cutflow_stages}
         weighted_cutflow_final[label] = {stage: 0.0 for stage in cutflow_stages}
 
-    # 2. SUBMIT TO CLUSTER
-    arg_labels = []
-    arg_urls = []
-    arg_indices = []
+    # 2. SERVE CACHED RESULTS
+    # Files whose result is already in the cache are merged directly, 
+    # without being sent to the cluster.
+    cache_keys = {}
+    n_cached = 0
+    if cache is not None:
+        for label, urls in files.items():
+            for file_url in urls:
+                if (label, file_url) in completed:
+                    continue
+                key = cache.key(label, file_url)
+                result = cache.get(key)
+                if result is None:
+                    cache_keys[(label, file_url)] = key
+                    continue
+                _merge_result(result, hist_store, cutflow_final, weighted_cutflow_final)
+                _write_extras(result, file_url, ntuple_dir, skip_existing=True)
+                completed.add((label, file_url))
+                n_cached += 1
+        print(f"Served {n_cached} files from the result cache.")
+
+    # 3. SUBMIT TO THE EXECUTOR
+    # Each task is (label, file_url, file_idx) for the processing task
+    tasks = []
 
     for label, urls in files.items():
         for file_idx, file_url in enumerate(urls):
-            arg_labels.append(label)
-            arg_urls.append(file_url)
-            arg_indices.append(file_idx)
+            if (label, file_url) in completed:
+                continue
+            tasks.append((label, file_url, file_idx))
+
+    task_history = scheduling.load_task_history(output_dir)
+    if order == 'cost' and len(tasks) > 1:
+        tasks = scheduling.order_tasks(tasks, task_history)
 
-    print(f"\nSubmitting {len(arg_urls)} files to the cluster...")
+    executor = as_executor(client)
+    if max_in_flight == 'auto':
+        max_in_flight = executor.default_in_flight()
+    window = f" (at most {max_in_flight} in flight)" if max_in_flight else ""
+    print(f"\nSubmitting {len(tasks)} files to the {executor.name}{window}...")
     start_time = time.perf_counter()
 
-    # Map the processing task provided by the notebook
-    futures = client.map(
-        processing_task, 
-        arg_labels, arg_urls, arg_indices,
-        retries=1  
-    )
+    shared = None
+    if shared_histograms:
+        shared = _create_shared_store(executor, hist_store, booking, cache, checkpoint_path)
+    task_fn = shared.accumulating(processing_task) if shared is not None else processing_task
+    retries = None
+    if shared is not None:
+        # Both copies of a task would add their histograms to the shared slots,
+        # and so would a retry of a task lost after it added them
+        speculate = None
+        retries = 0
+    task_stats = TaskStats()
 
-    # 3. STREAMING MERGE LOOP
+    # Map the processing task provided by the notebook; results stream back
+    # in completion order with the index of their task
+    results = executor.imap_unordered(task_fn, tasks, max_in_flight=max_in_flight,
+                                      memory_limit=memory_limit, speculate=speculate,
+                                      groups=[task[0] for task in tasks], stats=task_stats,
+                                      retries=retries)
+
+    writer = None
+    if checkpoint_path is not None:
+        writer = ckpt.CheckpointWriter(checkpoint_path, every_n=checkpoint_every,
+                                       every_seconds=checkpoint_interval)
+
+    # 4. STREAMING MERGE LOOP
     print("Processing and merging results as they arrive...")
-    error_count = 0
 
-    for future in tqdm(as_completed(futures), total=len(futures), unit="file"):
-        try:
-            result = future.result()
-            if not result: continue
+    try:
+        for task_idx, outcome in tqdm(results, total=len(tasks), unit="file"):
+            if shared is not None and outcome.exception() is not None:
+                # A task lost to an exception (e.g., a worker killed for memory,
+                # which fails every task in flight) may already have added all
+                # or part of its histograms to the shared slots: they cannot be trusted
+                if isinstance(client, str):
+                    executor.close()
+                raise RuntimeError(
+                    f"Task of {tasks[task_idx][1]} lost ({type(outcome.exception()).__name__}: {outcome.exception()}) "
+                    "and the shared histograms may hold part of the lost tasks, so the run is aborted; "
+                    "rerun it without shared_histograms (or with a memory_limit)."
+                )
+            try:
+                result = outcome.result()
+                if not result: continue
             
-            label, stage_histograms, cutflow, weighted_cutflow, error = result
-            
-            if error:
-                error_count += 1
-                print(f" ERROR: {error}")
-                continue
+                error = result[4]
+                if error:
+                    error_count += 1
+                    print(f" ERROR: {error}")
+                    continue
 
-            # A. Merge Cutflows
-            if cutflow:
-                for stage, count in cutflow.items():
-                    cutflow_final[label][stage] += count
-            
-            if weighted_cutflow:
-                for stage, count in weighted_cutflow.items():
-                    weighted_cutflow_final[label][stage] += count
-            
-            # B. Merge Histograms
-            if stage_histograms:
-                for stage, vars_dict in stage_histograms.items():
-                    for var, syst_dict in vars_dict.items():
-                        for syst, hist_obj in syst_dict.items():
-                            hist_data_final[label][stage][var][syst] += hist_obj
+                # A. Merge Cutflows and Histograms
+                _merge_result(result, hist_store, cutflow_final, weighted_cutflow_final)
+
+                # B. Store in the result cache (failed files are never cached)
+                #    and write the event ntuple if the processor produced one
+                unit = tasks[task_idx][:2]
+                if cache is not None:
+                    cache.put(cache_keys[unit], result)
+                _write_extras(result, unit[1], ntuple_dir)
             
-            del result, stage_histograms, cutflow, weighted_cutflow
+                del result
 
-        except Exception as e:
-            print(f"CRITICAL CLIENT ERROR: {e}")
-            error_count += 1
+                # C. Record progress and checkpoint if due
+                completed.add(unit)
+                if writer is not None and writer.should_checkpoint():
+                    writer.submit(ckpt.make_checkpoint_state(
+                        hist_store, cutflow_final, weighted_cutflow_final, completed
+                    ))
+
+            except Exception as e:
+                print(f"CRITICAL CLIENT ERROR: {e}")
+                error_count += 1
+
+        # Workers of the shared mode kept their histograms: one sum over their slots
+        if shared is not None:
+            hist_store += shared.reduce()
+    finally:
+        if shared is not None:
+            shared.close()
 
     elapsed = time.perf_counter() - start_time
+    # Backends created from a string only live for this run
+    if isinstance(client, str):
+        executor.close()
+
+    # Persist the final state before writing outputs, so a failure while saving 
+    # can still be recovered with resume=True.
+    if writer is not None:
+        writer.submit(ckpt.make_checkpoint_state(
+            hist_store, cutflow_final, weighted_cutflow_final, completed
+        ))
+        writer.close()
+        print(f"Checkpoint saved to: {checkpoint_path} ({writer.n_written} writes)")
+
+    if cache is not None:
+        n_evicted = cache.evict()
+        print(f"Result cache: {n_cached} hits, {len(tasks)} processed, {n_evicted} stale entries evicted.")
+
+    # 5. SAVE RESULTS 
+    os.makedirs(output_dir, exist_ok=True)
+    scheduling.update_task_history(output_dir, task_history, tasks, task_stats.durations)
+    hist_data_final = hist_store.to_dict()
+    helper.save_root_file(hist_data_final, output_dir / "HWW_analysis_output.root", **(root_options or {}))
+    if dense_store:
+        store_dir = hist_store.save(output_dir / DENSE_STORE_NAME)
+        print(f"Saved dense histogram store to: {store_dir}")
+    cutflow_utils.save_cutflows(cutflow_final, weighted_cutflow_final, output_dir)
+    if ntuple_dir is not None:
+        n_pruned = ntuple_utils.prune_ntuples(ntuple_dir, completed)
+        print(f"Event ntuples in: {ntuple_dir} ({n_pruned} stale units removed)")
 
-    # 4. SAVE RESULTS 
-    os.makedirs(Config.OUTPUT_DIR, exist_ok=True)
-    helper.save_root_file(hist_data_final, Config.OUTPUT_DIR / "HWW_analysis_output.root")
-    cutflow_utils.save_cutflows(cutflow_final, weighted_cutflow_final, Config.OUTPUT_DIR)
+    manifest_utils.save_manifest(output_dir, completed, cutflow_final, weighted_cutflow_final, run_hash)
 
-    # 5. FINAL REPORT
+    # 6. FINAL REPORT
     print("\n" + "="*70)
     print(f"{'SAMPLE':20s} | {'EVENTS':>12s}")
     print("-" * 35)
@@ -139,10 +458,11 @@ def execute_analysis(client, files, processing_task):
         print(f"\n WARNING: {error_count} files failed processing.")
 
     print(f"\nTotal Time: {elapsed:.1f}s ({elapsed/60:.1f} min)")
-    if len(futures) > 0:
+    if len(tasks) > 0:
         print(f"Rate: {total_events/elapsed:,.0f} events/sec")
+        scheduling.print_task_times(task_stats, tasks)
 
-    del futures, arg_urls, arg_labels, arg_indices
+    del results, tasks
     gc.collect()
     
     return hist_data_final, cutflow_final, weighted_cutflow_final
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""
+scheduling.py
+
+This module decides in which order `execute_analysis` submits the files.
+
+With the files submitted in the order of the dataset lists, the largest files
+of the last samples can start at the very end and stretch the tail of the run
+while most workers are idle. Submitting the most expensive files first lets
+the short ones fill the gaps at the end instead.
+
+The expected cost of a file comes from:
+1. Its measured task time in a previous run, kept in `HWW_task_timings.json`
+   next to the outputs (see `update_task_history`).
+2. Otherwise its size, converted to seconds with the median seconds per byte
+   of the files that have both.
+3. Otherwise the median cost of its sample.
+
+It also prints the tail latency of the task times at the end of a run.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+TASK_HISTORY_NAME = "HWW_task_timings.json"
+
+# ==============================================================================
+# TASK HISTORY
+# ==============================================================================
+
+def load_task_history(output_dir):
+    """Returns {file URL: {'seconds': ..., 'bytes': ...}} from the previous runs (empty if none)."""
+    path = Path(output_dir) / TASK_HISTORY_NAME
+    if not path.exists():
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def update_task_history(output_dir, history, tasks, durations):
+    """
+    Records the task time of every completed task and saves the history.
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        Directory holding the analysis outputs.
+    history : dict
+        History returned by `load_task_history` (updated in place).
+    tasks : list of tuple
+        The (label, file_url, file_idx) tasks of the run.
+    durations : dict
+        Task index -> task time in seconds (executors.TaskStats.durations).
+    """
+    for index, seconds in durations.items():
+        history.setdefault(tasks[index][1], {})['seconds'] = round(seconds, 3)
+    path = Path(output_dir) / TASK_HISTORY_NAME
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# ==============================================================================
+# FILE SIZES
+# ==============================================================================
+
+def file_size(url):
+    """Size in bytes of a local or remote (root://, via fsspec-xrootd) file, or None."""
+    try:
+        if "://" not in url:
+            return os.path.getsize(url)
+        import fsspec
+        fs, path = fsspec.core.url_to_fs(url)
+        return int(fs.size(path))
+    except Exception:
+        return None
+
+def fetch_file_sizes(urls, history, n_threads=16):
+    """
+    Looks up the size of the files that have no size in `history` yet, in
+    parallel threads, and stores them there. Returns the number of sizes found.
+    """
+    missing = [url for url in urls if history.get(url, {}).get('bytes') is None]
+    if not missing:
+        return 0
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        sizes = list(pool.map(file_size, missing))
+    n_found = 0
+    for url, size in zip(missing, sizes):
+        if size is not None:
+            history.setdefault(url, {})['bytes'] = size
+            n_found += 1
+    return n_found
+
+# ==============================================================================
+# ORDERING
+# ==============================================================================
+
+def expected_costs(tasks, history):
+    """
+    Expected task time of every (label, file_url, file_idx) task.
+
+    Returns a list of costs in seconds (in bytes if no file has both a time and
+    a size, since only the order matters), or None for a task with no
+    information at all in a sample without any.
+    """
+    times = [history.get(url, {}).get('seconds') for _, url, _ in tasks]
+    sizes = [history.get(url, {}).get('bytes') for _, url, _ in tasks]
+
+    both = [t / b for t, b in zip(times, sizes) if t is not None and b]
+    known_times = [t for t in times if t is not None]
+    if both:
+        rate = float(np.median(both))
+    elif not known_times:
+        rate = 1.0
+    else:
+        rate = None
+
+    costs = []
+    for t, b in zip(times, sizes):
+        if t is not None:
+            costs.append(t)
+        elif b is not None and rate is not None:
+            costs.append(b * rate)
+        else:
+            costs.append(None)
+
+    # Files without any information get the median of their sample
+    by_sample = {}
+    for (label, _, _), cost in zip(tasks, costs):
+        if cost is not None:
+            by_sample.setdefault(label, []).append(cost)
+    overall = [cost for cost in costs if cost is not None]
+    for i, (label, _, _) in enumerate(tasks):
+        if costs[i] is None:
+            known = by_sample.get(label) or overall
+            costs[i] = float(np.median(known)) if known else None
+    return costs
+
+def order_tasks(tasks, history, fetch_sizes=True):
+    """
+    Returns the tasks sorted by decreasing expected cost (stable, so files
+    without any information keep their original order, after the others).
+
+    Parameters
+    ----------
+    tasks : list of tuple
+        The (label, file_url, file_idx) tasks.
+    history : dict
+        History returned by `load_task_history`. Sizes looked up here are
+        added to it.
+    fetch_sizes : bool, optional
+        Look up the size of the files without a recorded task time or size.
+        Defaults to True.
+    """
+    if fetch_sizes:
+        untimed = [url for _, url, _ in tasks if history.get(url, {}).get('seconds') is None]
+        n_found = fetch_file_sizes(untimed, history)
+        if untimed:
+            print(f"File sizes: {n_found} of {len(untimed)} files without task history found.")
+
+    costs = expected_costs(tasks, history)
+    n_known = sum(cost is not None for cost in costs)
+    order = sorted(range(len(tasks)), key=lambda i: (costs[i] is None, -(costs[i] or 0.0)))
+    print(f"Ordering {len(tasks)} files by expected cost ({n_known} with timing or size information).")
+    return [tasks[i] for i in order]
+
+# ==============================================================================
+# REPORT
+# ==============================================================================
+
+def print_task_times(stats, tasks):
+    """Prints the p50/p95/max task times and the speculative copies of a run."""
+    percentiles = stats.percentiles()
+    if percentiles is None:
+        return
+    p50, p95, slowest = percentiles
+    slowest_index = max(stats.durations, key=stats.durations.get)
+    label, url = tasks[slowest_index][:2]
+    print(f"Task time: p50 {p50:.1f}s | p95 {p95:.1f}s | max {slowest:.1f}s ({label}: {os.path.basename(url)})")
+    if stats.n_speculative:
+        print(f"Speculative copies: {stats.n_speculative} launched, {stats.n_speculative_won} finished first.")
@@ -0,0 +1,220 @@
+"""
+shared_store.py
+
+This module lets the workers of a local process pool accumulate their
+histograms directly in shared memory.
+
+Normally every processed file sends its histograms back to the notebook
+process: they are pickled in the worker, unpickled in the parent and merged
+one result at a time, so with many workers the parent becomes the bottleneck.
+`SharedHistogramStore` instead allocates one `multiprocessing.shared_memory`
+block holding, for every variable, arrays of shape
+[worker slot, sample, stage, variation, bin] (the `HistogramStore` layout with
+an extra slot axis):
+- Each worker process adds its results into its own slot (see
+  `executors.worker_slot`), so no locking is needed.
+- The processing result sent back to the parent only keeps the cutflows.
+- At the end, the parent sums the slot axis once per variable (`reduce`).
+
+The slots are only complete once all the tasks have finished, so this mode
+is used without result caching or checkpoints (see run_analysis.py). A task
+adds its histograms before its result reaches the parent, so it must never
+run twice: execute_analysis disables retries and speculation, and aborts the
+run if a task is lost to an exception (a dead worker fails every task in
+flight, including those that already added their histograms).
+"""
+
+import os
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .histogram_store import HistogramStore
+
+class SharedHistogramStore:
+    """
+    One HistogramStore per worker slot, in a single shared memory block.
+
+    Use `create` in the parent process. Workers attach to the block by name
+    when they first accumulate a result (see `accumulating`).
+
+    Parameters
+    ----------
+    spec : dict
+        Layout of the block: shared memory name, number of slots, samples,
+        stages, axes and variations.
+    shm : multiprocessing.shared_memory.SharedMemory
+        The attached block.
+    """
+
+    def __init__(self, spec, shm):
+        self.spec = spec
+        self.shm = shm
+        self.n_slots = spec['n_slots']
+        self.sumw, self.sumw2, self.booked = _block_arrays(spec, shm.buf)
+
+    @classmethod
+    def create(cls, n_slots, samples, stages, axes, variations, booking=None):
+        """
+        Allocates the shared block for `n_slots` workers (zero-filled), with
+        the booking of a HistogramStore of the same labels.
+
+        Raises
+        ------
+        MemoryError
+            If the block does not fit in the shared memory filesystem.
+        """
+        spec = {
+            'name': None, 'n_slots': int(n_slots), 'samples': list(samples),
+            'stages': list(stages), 'axes': dict(axes), 'variations': list(variations),
+        }
+        size = block_size(spec)
+        _check_shm_space(size)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        spec['name'] = shm.name
+        store = cls(spec, shm)
+
+        # New shared memory is zero-filled; only the booking has to be set
+        if booking is not None:
+            template = HistogramStore(samples, stages, axes, variations, booking=booking)
+            for var in store.booked:
+                store.booked[var][:] = template.booked[var]
+        else:
+            for var in store.booked:
+                store.booked[var][:] = True
+        return store
+
+    @classmethod
+    def attach(cls, spec):
+        """Attaches to a block created by `create` (e.g., in a worker process)."""
+        return cls(spec, shared_memory.SharedMemory(name=spec['name']))
+
+    @property
+    def nbytes(self):
+        return block_size(self.spec)
+
+    def slot(self, i):
+        """HistogramStore view on slot `i` (no copy)."""
+        store = HistogramStore.__new__(HistogramStore)
+        store.samples = self.spec['samples']
+        store.stages = self.spec['stages']
+        store.variations = self.spec['variations']
+        store.axes = self.spec['axes']
+        store._build_index()
+        store.sumw = {var: arr[i] for var, arr in self.sumw.items()}
+        store.sumw2 = {var: arr[i] for var, arr in self.sumw2.items()}
+        store.booked = {var: arr[i] for var, arr in self.booked.items()}
+        return store
+
+    def reduce(self):
+        """Sums all the slots into a new (private) HistogramStore."""
+        store = HistogramStore(self.spec['samples'], self.spec['stages'], self.spec['axes'],
+                               self.spec['variations'])
+        for var in store.axes:
+            np.sum(self.sumw[var], axis=0, out=store.sumw[var])
+            np.sum(self.sumw2[var], axis=0, out=store.sumw2[var])
+            np.any(self.booked[var], axis=0, out=store.booked[var])
+        return store
+
+    def accumulating(self, processing_task):
+        """
+        Wraps a processing task so that its histograms are added to the slot
+        of the worker that ran it, and only the rest of the result is returned.
+        """
+        return _AccumulatingTask(processing_task, self.spec)
+
+    def close(self, unlink=True):
+        """Releases the arrays and the block (`unlink` frees it, parent only)."""
+        self.sumw = self.sumw2 = self.booked = None
+        # Also drop the attachment made when tasks ran in this process (serial execution)
+        attached = _ATTACHED.pop(self.spec['name'], None)
+        if attached is not None and attached is not self:
+            attached.close(unlink=False)
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+    def __repr__(self):
+        return (f"<SharedHistogramStore '{self.spec['name']}': {self.n_slots} slots, "
+                f"{self.nbytes / 1e6:.1f} MB>")
+
+class _AccumulatingTask:
+    """Processing task wrapper of SharedHistogramStore.accumulating (picklable)."""
+
+    def __init__(self, processing_task, spec):
+        self.processing_task = processing_task
+        self.spec = spec
+
+    def setup(self):
+        # Once-per-worker setup of the wrapped task (see executors._setup_task)
+        setup = getattr(self.processing_task, "setup", None)
+        if callable(setup):
+            setup()
+
+    def __call__(self, label, file_url, file_idx):
+        from .executors import worker_slot
+
+        result = self.processing_task(label, file_url, file_idx)
+        if not result or result[4] or not result[1]:
+            return result
+
+        slot = _attached(self.spec).slot(worker_slot() % self.spec['n_slots'])
+        stage_histograms = result[1]
+        if isinstance(stage_histograms, HistogramStore):
+            slot += stage_histograms
+        else:
+            slot.add(label, stage_histograms)
+        return (result[0], None) + tuple(result[2:])
+
+# =========================================================
+# LAYOUT
+# =========================================================
+
+def _layout(spec):
+    """Yields (var, kind, dtype, shape) for every array of the block, in order."""
+    lead = (spec['n_slots'], len(spec['samples']), len(spec['stages']), len(spec['variations']))
+    for var, axis in spec['axes'].items():
+        shape = lead + (len(axis) + 2,)
+        yield var, 'sumw', np.float64, shape
+        yield var, 'sumw2', np.float64, shape
+    for var in spec['axes']:
+        yield var, 'booked', np.bool_, lead
+
+def block_size(spec):
+    """Size in bytes of the shared block described by `spec`."""
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, _, dtype, shape in _layout(spec))
+
+def _block_arrays(spec, buf):
+    arrays = {'sumw': {}, 'sumw2': {}, 'booked': {}}
+    offset = 0
+    for var, kind, dtype, shape in _layout(spec):
+        arr = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        arrays[kind][var] = arr
+        offset += arr.nbytes
+    return arrays['sumw'], arrays['sumw2'], arrays['booked']
+
+def _check_shm_space(size):
+    """
+    On Linux a shared memory block larger than the free space of /dev/shm is
+    created without error but crashes the process (SIGBUS) when written, so
+    the space is checked first. Containers often mount a small /dev/shm.
+    """
+    if not sys.platform.startswith("linux") or not os.path.isdir("/dev/shm"):
+        return
+    stat = os.statvfs("/dev/shm")
+    free = stat.f_bavail * stat.f_frsize
+    if size > free:
+        raise MemoryError(
+            f"Shared histograms need {size / 1e6:.0f} MB but /dev/shm only has {free / 1e6:.0f} MB free"
+        )
+
+# Blocks attached by this worker process, by shared memory name
+_ATTACHED = {}
+
+def _attached(spec):
+    store = _ATTACHED.get(spec['name'])
+    if store is None:
+        store = _ATTACHED[spec['name']] = SharedHistogramStore.attach(spec)
+    return store
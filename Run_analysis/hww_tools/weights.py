@@ -0,0 +1,157 @@
+"""
+weights.py
+
+This module provides `Weights`, the per-event weights of all systematic
+variations in one array.
+
+The processor keeps a dictionary of seven awkward arrays (one per
+variation), so every selection step slices seven arrays and every scale
+factor is multiplied into each of them separately. `Weights` instead holds one
+contiguous NumPy array of shape [variation, event]:
+- `select(mask)` slices all variations with a single fancy-indexing call.
+- `multiply(nominal, source, up, down)` applies a correction to every
+  variation in place, using the up/down factors for the '<source>_up' and
+  '<source>_down' variations.
+- Each variation is a contiguous row, and the class behaves like the old
+  dictionary (`weights['nominal']`, `weights.get(syst, ...)`), so it can be
+  passed directly to the histogram filling functions of helper.py.
+"""
+
+from collections.abc import Mapping
+
+import awkward as ak
+import numpy as np
+
+from . import Config
+
+class Weights(Mapping):
+    """
+    Per-event weights of every systematic variation.
+
+    Parameters
+    ----------
+    nominal : array
+        Starting per-event weights (e.g., genWeight or ones for Data), used for
+        every variation.
+    variations : list of str, optional
+        Variation names, including 'nominal'. Defaults to Config.VARIATIONS.
+    dtype : numpy dtype, optional
+        Defaults to float64.
+    """
+
+    __slots__ = ("variations", "values", "_index")
+
+    def __init__(self, nominal, variations=None, dtype=np.float64):
+        self.variations = list(variations if variations is not None else Config.VARIATIONS)
+        if 'nominal' not in self.variations:
+            raise ValueError("Weights need a 'nominal' variation")
+        self._index = {name: i for i, name in enumerate(self.variations)}
+
+        nominal = np.asarray(ak.to_numpy(nominal), dtype=dtype)
+        self.values = np.empty((len(self.variations), len(nominal)), dtype=dtype)
+        self.values[:] = nominal
+
+    @classmethod
+    def from_dict(cls, weights_dict, variations=None):
+        """Builds the container from a {variation: per-event weights} dictionary."""
+        variations = list(variations if variations is not None else weights_dict.keys())
+        weights = cls(weights_dict['nominal'], variations)
+        for name in variations:
+            if name != 'nominal' and name in weights_dict:
+                weights.values[weights._index[name]] = ak.to_numpy(weights_dict[name])
+        return weights
+
+    def _new(self, values, variations=None):
+        weights = Weights.__new__(Weights)
+        weights.variations = self.variations if variations is None else variations
+        weights._index = self._index if variations is None else {name: i for i, name in enumerate(variations)}
+        weights.values = values
+        return weights
+
+    # ---------------------------------------------------------
+    # Dictionary interface
+    # ---------------------------------------------------------
+    def __getitem__(self, name):
+        return self.values[self._index[name]]
+
+    def __iter__(self):
+        return iter(self.variations)
+
+    def __len__(self):
+        return len(self.variations)
+
+    @property
+    def n_events(self):
+        return self.values.shape[1]
+
+    def to_dict(self):
+        """Returns a {variation: NumPy array} dictionary (views, no copy)."""
+        return {name: self.values[i] for i, name in enumerate(self.variations)}
+
+    # ---------------------------------------------------------
+    # Selections and corrections
+    # ---------------------------------------------------------
+    def select(self, mask, variations=None):
+        """
+        Returns the weights of the selected events (boolean mask or indices).
+
+        With `variations`, only those variations (plus 'nominal') are kept, so
+        a consumer that needs a few of them gathers just those rows.
+        """
+        if not isinstance(mask, np.ndarray):
+            mask = ak.to_numpy(mask)
+        # take() with indices along the event axis is the fastest 2D gather
+        indices = np.flatnonzero(mask) if mask.dtype == bool else mask
+        if variations is None:
+            return self._new(self.values.take(indices, axis=1))
+
+        names = ['nominal'] + [name for name in variations if name != 'nominal' and name in self._index]
+        rows = [self._index[name] for name in names]
+        if 2 * len(rows) <= len(self.variations):
+            values = self.values[rows].take(indices, axis=1)
+        else:
+            values = self.values.take(indices, axis=1)[rows]
+        return self._new(values, names)
+
+    def multiply(self, nominal, source=None, up=None, down=None):
+        """
+        Applies a multiplicative correction in place.
+
+        Every variation is multiplied by `nominal`, except '<source>_up' and
+        '<source>_down', which are multiplied by `up` and `down` (the nominal
+        factor if not given).
+
+        Parameters
+        ----------
+        nominal : array or float
+            Central per-event factor (e.g., the scale factor).
+        source : str, optional
+            Systematic source of the up/down factors (e.g., 'ele_id').
+        up, down : array or float, optional
+            Per-event factors of the up and down variations.
+        """
+        nominal = _as_factor(nominal)
+        shifted = []
+        if source is not None:
+            for suffix, factor in (('_up', up), ('_down', down)):
+                i = self._index.get(source + suffix)
+                if i is not None and factor is not None:
+                    shifted.append((i, self.values[i] * _as_factor(factor)))
+
+        self.values *= nominal
+        for i, values in shifted:
+            self.values[i] = values
+        return self
+
+    def sum(self, mask=None):
+        """Sum of the weights of every variation, optionally for the events in `mask`."""
+        values = self.values if mask is None else self.select(mask).values
+        return dict(zip(self.variations, values.sum(axis=1)))
+
+    def __repr__(self):
+        return f"<Weights: {self.n_events} events x {len(self.variations)} variations {self.variations}>"
+
+def _as_factor(factor):
+    if np.isscalar(factor):
+        return factor
+    return np.asarray(ak.to_numpy(factor), dtype=np.float64)
@@ -1,9 +1,12 @@
 import uproot
 import hist
+import json
 import os
 import numpy as np
 
 INPUT_FILE = "../Outputs/HWW_analysis_output.root"
+# Dense histogram store written next to the ROOT file (used when present)
+INPUT_STORE = "../Outputs/HWW_analysis_output_dense"
 OUTPUT_ROOT = "../Outputs/combine_input.root"
 OUTPUT_CARD = "../Outputs/hww_datacard.txt"
 
@@ -32,13 +35,63 @@ SYSTEMATICS = {
     "mu_id":   "CMS_eff_m"
 }
 
+def find_key(f_in, sample, region, variable, variation):
+    """Key of a histogram in either the hierarchical or the flat output layout."""
+    for key in (f"{sample}/{region}/{variable}/{variation}",
+                f"{sample}_{region}_{variable}_{variation}"):
+        if key in f_in:
+            return key
+    return None
+
+def read_store_region(store_dir, region, variable):
+    """
+    Reads every sample and variation of one region from the dense store.
+
+    The whole [sample, variation, bin] block of the region is sliced at once 
+    from the memory-mapped arrays; a histogram is only built for the shapes 
+    that are actually written out.
+
+    Returns
+    -------
+    dict
+        {(sample, variation): hist.Hist} for every booked histogram of the region.
+    """
+    with open(os.path.join(store_dir, "header.json"), 'r') as f:
+        header = json.load(f)
+    if region not in header['stages'] or variable not in header['variables']:
+        return {}
+
+    stage_idx = header['stages'].index(region)
+    arrays = {
+        kind: np.load(os.path.join(store_dir, f"{variable}.{kind}.npy"), mmap_mode='r')[:, stage_idx]
+        for kind in ("sumw", "sumw2", "booked")
+    }
+    edges = header['variables'][variable]['edges']
+    axis = hist.axis.Regular(len(edges) - 1, edges[0], edges[-1], name=variable,
+                             label=header['variables'][variable]['label'])
+
+    shapes = {}
+    for i, sample in enumerate(header['samples']):
+        for k, variation in enumerate(header['variations']):
+            if not arrays["booked"][i, k]:
+                continue
+            h = hist.Hist(axis, storage=hist.storage.Weight())
+            h.view(flow=True).value = arrays["sumw"][i, k]
+            h.view(flow=True).variance = arrays["sumw2"][i, k]
+            shapes[(sample, variation)] = h
+    return shapes
+
 def main():
-    print(f"Opening {INPUT_FILE}")
-    try:
-        f_in = uproot.open(INPUT_FILE)
-    except Exception as e:
-        print(f"Error: Could not open input file. {e}")
-        return
+    f_in = None
+    if os.path.exists(os.path.join(INPUT_STORE, "header.json")):
+        print(f"Opening dense store {INPUT_STORE}")
+    else:
+        print(f"Opening {INPUT_FILE}")
+        try:
+            f_in = uproot.open(INPUT_FILE)
+        except Exception as e:
+            print(f"Error: Could not open input file. {e}")
+            return
 
     f_out = uproot.recreate(OUTPUT_ROOT)
     
@@ -48,25 +101,30 @@ def main():
     
     for internal_reg, card_reg in REGIONS.items():
         print(f"Processing Region: {internal_reg} -> {card_reg}")
+
+        if f_in is None:
+            shapes = read_store_region(INPUT_STORE, internal_reg, VAR_NAME)
+            get_hist = lambda sample, variation: shapes.get((sample, variation))
+        else:
+            def get_hist(sample, variation, region=internal_reg):
+                key = find_key(f_in, sample, region, VAR_NAME, variation)
+                return f_in[key].to_hist() if key is not None else None
         
-        data_key = f"Data_{internal_reg}_{VAR_NAME}_nominal"
-        if data_key in f_in:
-            h_data = f_in[data_key].to_hist()
+        h_data = get_hist("Data", "nominal")
+        if h_data is not None:
             
             f_out[f"data_obs_{card_reg}"] = h_data
             print(f"  Saved Data: {h_data.sum().value:.0f} events")
         else:
-            print(f"  WARNING: Data histogram {data_key} not found!")
+            print(f"  WARNING: Data histogram for {internal_reg} not found!")
 
         for proc in PROCESSES:
-            nom_key = f"{proc}_{internal_reg}_{VAR_NAME}_nominal"
+            h_nom = get_hist(proc, "nominal")
             
-            if nom_key not in f_in:
+            if h_nom is None:
                 print(f"    Missing process: {proc} (skipping)")
                 rates[card_reg][proc] = 0.0
                 continue
-                
-            h_nom = f_in[nom_key].to_hist()
             
             values = h_nom.view(flow=False).value
             values[values <= 0] = 1e-4
@@ -76,13 +134,10 @@ def main():
             rates[card_reg][proc] = h_nom.sum().value
             
             for internal_syst, combine_syst in SYSTEMATICS.items():
-                up_key = f"{proc}_{internal_reg}_{VAR_NAME}_{internal_syst}_up"
-                dn_key = f"{proc}_{internal_reg}_{VAR_NAME}_{internal_syst}_down"
+                h_up = get_hist(proc, f"{internal_syst}_up")
+                h_dn = get_hist(proc, f"{internal_syst}_down")
                 
-                if up_key in f_in and dn_key in f_in:
-                    h_up = f_in[up_key].to_hist()
-                    h_dn = f_in[dn_key].to_hist()
-                    
+                if h_up is not None and h_dn is not None:
                     h_up.view(flow=False).value[h_up.view(flow=False).value <= 0] = 1e-4
                     h_dn.view(flow=False).value[h_dn.view(flow=False).value <= 0] = 1e-4
                     
@@ -90,7 +145,8 @@ def main():
                     f_out[f"{proc}_{card_reg}_{combine_syst}Down"] = h_dn
 
     f_out.close()
-    f_in.close()
+    if f_in is not None:
+        f_in.close()
     print(f"\nCreated ROOT file: {OUTPUT_ROOT}")
     
     create_datacard(rates)
@@ -34,6 +34,14 @@ SYSTEMATICS = {
     "mu_id":   "CMS_eff_m"
 }
 
+def find_key(f_in, sample, region, variable, variation):
+    """Key of a histogram in either the hierarchical or the flat output layout."""
+    for key in (f"{sample}/{region}/{variable}/{variation}",
+                f"{sample}_{region}_{variable}_{variation}"):
+        if key in f_in:
+            return key
+    return None
+
 def main():
     print(f"Opening {INPUT_FILE}")
     try:
@@ -55,8 +63,8 @@ def main():
         data_yields = {card_reg: 0.0} 
         
         # Process Data
-        data_key = f"Data_{internal_reg}_{VAR_NAME}_nominal"
-        if data_key in f_in:
+        data_key = find_key(f_in, "Data", internal_reg, VAR_NAME, "nominal")
+        if data_key is not None:
             h_data = f_in[data_key].to_hist()
             f_out[f"data_obs_{card_reg}"] = h_data
             
@@ -64,13 +72,13 @@ def main():
             data_yields[card_reg] = obs_yield
             print(f"  Saved Data: {obs_yield:.0f} events")
         else:
-            print(f"  WARNING: Data histogram {data_key} not found!")
+            print(f"  WARNING: Data histogram for {internal_reg} not found!")
 
         #  Process MC Processes
         for proc in PROCESSES:
-            nom_key = f"{proc}_{internal_reg}_{VAR_NAME}_nominal"
+            nom_key = find_key(f_in, proc, internal_reg, VAR_NAME, "nominal")
             
-            if nom_key not in f_in:
+            if nom_key is None:
                 print(f"    Missing process: {proc} (skipping)")
                 rates[card_reg][proc] = 0.0
                 continue
@@ -86,10 +94,10 @@ def main():
             
             #   Process Systematics
             for internal_syst, combine_syst in SYSTEMATICS.items():
-                up_key = f"{proc}_{internal_reg}_{VAR_NAME}_{internal_syst}_up"
-                dn_key = f"{proc}_{internal_reg}_{VAR_NAME}_{internal_syst}_down"
+                up_key = find_key(f_in, proc, internal_reg, VAR_NAME, f"{internal_syst}_up")
+                dn_key = find_key(f_in, proc, internal_reg, VAR_NAME, f"{internal_syst}_down")
                 
-                if up_key in f_in and dn_key in f_in:
+                if up_key is not None and dn_key is not None:
                     h_up = f_in[up_key].to_hist()
                     h_dn = f_in[dn_key].to_hist()
                     